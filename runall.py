@@ -4,12 +4,263 @@ import sys
 import os
 import subprocess
 import argparse
-import yaml
 import time
 import re
+import json
+import tempfile
+import shutil
+import threading
+import concurrent.futures
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'tests'))
+import specs # pylint: disable=wrong-import-position
+import corpus # pylint: disable=wrong-import-position
+import phases # pylint: disable=wrong-import-position
+import schedule # pylint: disable=wrong-import-position
+import forkserver # pylint: disable=wrong-import-position
+
+PYTHON3 = sys.executable
+# Test types whose limits depend on the machine or the Python and archiver versions, run only if asked for
+OPTIN_TYPES = ('memory', 'ingest', 'perf')
+# Applied per spec by test-bycorpus.py, so specs which differ only in these can be run together
+BYCORPUS_SPEC_ENV = ('MOCK_GMTIME', 'MOCK_AAT')
+
+
+def spec_jobs(args, spec_file):
+    """Returns the (test_type, cliargs, env) jobs for a spec file"""
+    jobs = []
+    yml = specs.load_spec(spec_file)
+    env = dict(os.environ) # always pass parent environ
+    for test_type in yml:
+        if args.ttype and test_type not in args.ttype:
+            print("Skipping test type %s due to --ttype flag" % test_type)
+            continue
+        if test_type in OPTIN_TYPES and test_type not in (args.with_types or []) + (args.ttype or []):
+            print("Skipping test type %s, use --with %s to run it" % (test_type, test_type))
+            continue
+        if test_type == 'args':
+            # Environment variable override, e.g. MOCK_GMTIME
+            env_ = yml[test_type].get("env", None)
+            if env_:
+                for key, val in env_.items():
+                    env[key] = val
+            continue
+        if args.diff:
+            if test_type not in ('parsing', 'generators'):
+                print("Skipping test type %s due to --diff flag" % test_type)
+                continue
+            cliargs = [PYTHON3, 'tests/test-diff.py', '--rootdir', args.rootdir, '--other', args.diff,
+                       '--load', spec_file, '--ttype', test_type]
+            if args.nomboxo:
+                cliargs.append('--nomboxo')
+            if args.gtype and test_type == 'generators':
+                cliargs.append('--generators')
+                cliargs.extend(args.gtype)
+            jobs.append((test_type, cliargs, env))
+            continue
+        cliargs = [PYTHON3, 'tests/test-%s.py' % test_type, '--rootdir', args.rootdir, '--load', spec_file,]
+        if args.nomboxo:
+            cliargs.append('--nomboxo')
+        if args.gtype and test_type in ('generators', 'ingest', 'perf'):
+            cliargs.append('--generators')
+            cliargs.extend(args.gtype)
+        if args.dropin and test_type == 'generators':
+            cliargs.extend(['--dropin', args.dropin])
+        if args.skipnodate and test_type == 'generators':
+            cliargs.append('--skipnodate')
+        if args.profile:
+            cliargs.extend(['--profile', args.profile])
+        if args.shards and test_type in ('parsing', 'generators'):
+            cliargs.extend(['--shards', str(args.shards)])
+        if args.budget and test_type in ('parsing', 'generators'):
+            cliargs.extend(['--budget', str(args.budget)])
+        if args.slowest is not None and test_type in ('parsing', 'generators'):
+            cliargs.extend(['--slowest', str(args.slowest)])
+        jobs.append((test_type, cliargs, env))
+    return jobs
+
+
+def bycorpus_groups(jobs):
+    """
+    Returns the parsing and generators jobs to run together with --bycorpus, as lists of
+    indexes into jobs: those of specs which use the same corpus files as another spec
+    (directly, or through a further spec) and have the same env, other than
+    BYCORPUS_SPEC_ENV. The jobs of a spec are all in the same group, or in none.
+    """
+    parent = list(range(len(jobs)))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    first = {} # first job of each spec file and corpus file
+    shared = set() # corpus files used by more than one job
+    for i, (spec_file, test_type, _, env) in enumerate(jobs):
+        if test_type not in ('parsing', 'generators'):
+            continue
+        env_key = tuple(sorted(item for item in env.items() if item[0] not in BYCORPUS_SPEC_ENV))
+        keys = [('spec', os.path.normpath(spec_file))]
+        for mboxfile in specs.load_spec(spec_file)[test_type]:
+            keys.append(('corpus', env_key, os.path.realpath(corpus.resolve_path(mboxfile))))
+        for key in keys:
+            if key in first:
+                parent[find(i)] = find(first[key])
+                if key[0] == 'corpus':
+                    shared.add(key)
+            else:
+                first[key] = i
+    roots = set(find(first[key]) for key in shared)
+    groups = {}
+    for i in range(len(jobs)):
+        if find(i) in roots:
+            groups.setdefault(find(i), []).append(i)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def bycorpus_cliargs(args, spec_files):
+    """Returns the cliargs of test-bycorpus.py for the parsing and generators tests of the spec files"""
+    cliargs = [PYTHON3, 'tests/test-bycorpus.py', '--rootdir', args.rootdir, '--load'] + spec_files
+    if args.ttype:
+        cliargs.append('--ttype')
+        cliargs.extend(test_type for test_type in args.ttype if test_type in ('parsing', 'generators'))
+    if args.nomboxo:
+        cliargs.append('--nomboxo')
+    if args.gtype:
+        cliargs.append('--generators')
+        cliargs.extend(args.gtype)
+    if args.skipnodate:
+        cliargs.append('--skipnodate')
+    if args.budget:
+        cliargs.extend(['--budget', str(args.budget)])
+    if args.slowest is not None:
+        cliargs.extend(['--slowest', str(args.slowest)])
+    return cliargs
+
+
+def read_results(filename):
+    """Returns the JSON records written by a test script with --results"""
+    records = []
+    if os.path.exists(filename):
+        with open(filename, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line))
+    return records
+
+
+def count_results(rv, records):
+    """Fetch successes, failures and skips from a spec run"""
+    for record in records:
+        if record['status'] == 'done':
+            return record['run'] - record['failed'], record['failed'], record['skipped']
+    # No result stream (e.g. the script crashed); fall back to the [DONE] line
+    m = re.search(r"^\[DONE\] (\d+) tests run, (\d+) failed\.( Skipped (\d+)\.)?", rv.decode('utf-8', 'replace'), re.MULTILINE)
+    if m:
+        return int(m.group(1)) - int(m.group(2)), int(m.group(2)), int(m.group(4) or 0)
+    return 0, 0, 0
+
+
+def job_outcomes(members, returncode, rv, records):
+    """
+    Returns (spec file, test type, passed, (successes, failures, skips)) for each of
+    the (spec file, test type) members of a job; a --bycorpus job has several.
+    """
+    if len(members) == 1:
+        spec_file, test_type = members[0]
+        return [(spec_file, test_type, returncode == 0, count_results(rv, records))]
+    outcomes = []
+    for spec_file, test_type in members:
+        own = [record for record in records if record['spec'] == spec_file and
+               record.get('type', 'parsing' if record.get('generator') is None else 'generators') == test_type]
+        done = [record for record in own if record['status'] == 'done']
+        outcomes.append((spec_file, test_type, bool(done) and not done[0]['failed'], count_results(b'', own)))
+    if returncode and all(passed for _, _, passed, _ in outcomes):
+        # it failed after checking the tests
+        outcomes = [(spec_file, test_type, False, counts) for spec_file, test_type, _, counts in outcomes]
+    return outcomes
+
+
+def job_phases(wall, records):
+    """
+    Returns the 'done' record of a job with the time spent before the test script
+    started timing itself (interpreter startup etc.) added to its startup phase,
+    or None if it did not write one.
+    """
+    for record in records:
+        if record['status'] == 'done' and 'phases' in record:
+            record = dict(record)
+            record['phases'] = dict((phase, dict(used)) for phase, used in record['phases'].items())
+            record['phases']['startup']['wall'] += max(0.0, wall - record['elapsed'])
+            record['wall'] = wall
+            return record
+    return None
+
+
+def print_phases(timings):
+    """Prints the wall time per phase of each job, and the totals of all jobs"""
+    if not timings:
+        return
+    names = ["%s (%s)" % (os.path.basename(spec_file), test_type) for spec_file, test_type, _ in timings]
+    width = max(len(name) for name in names + ['CPU total'])
+    print("Seconds by phase:")
+    print("%-*s %s %8s %8s %8s" % (width, '', ' '.join("%8s" % phase for phase in phases.PHASES), 'wall', 'cpu', 'maxrss'))
+    for name, (_, _, record) in zip(names, timings):
+        print("%-*s %s %8.2f %8.2f %8s" % (width, name, ' '.join("%8.2f" % record['phases'][phase]['wall'] for phase in phases.PHASES),
+                                           record['wall'], record['cpu'], phases.format_size(record['maxrss'])))
+    records = [record for _, _, record in timings]
+    print("%-*s %s %8.2f" % (width, 'Wall total', ' '.join("%8.2f" % sum(r['phases'][phase]['wall'] for r in records) for phase in phases.PHASES),
+                             sum(r['wall'] for r in records)))
+    print("%-*s %s %8s %8.2f" % (width, 'CPU total', ' '.join("%8.2f" % sum(r['phases'][phase]['cpu'] for r in records) for phase in phases.PHASES),
+                                 '', sum(r['cpu'] for r in records)))
+    print("%-*s %s %8s %8s %8s" % (width, 'RSS growth', ' '.join("%8s" % phases.format_size(max(r['phases'][phase]['rss'] for r in records)) for phase in phases.PHASES),
+                                   '', '', phases.format_size(max(r['maxrss'] for r in records))))
+
+
+class JobPool(object):
+    """Runs test scripts concurrently, keeping the output of each job together"""
+    def __init__(self, jobs, server=None):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        self.server = server
+        self.lock = threading.Lock()
+        self.procs = set()
+        self.cancelled = False
+
+    def _run(self, cliargs, env, on_start, forked):
+        with self.lock:
+            if self.cancelled:
+                return None, b'', b'', 0.0
+            if on_start:
+                on_start()
+            started = time.time()
+            if forked:
+                proc = self.server.run(cliargs, env)
+            else:
+                proc = subprocess.Popen(cliargs, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            self.procs.add(proc)
+        try:
+            out, err = proc.communicate()
+        finally:
+            with self.lock:
+                self.procs.discard(proc)
+        return proc.returncode, out, err, time.time() - started
+
+    def submit(self, cliargs, env, on_start=None, forked=False):
+        return self.executor.submit(self._run, cliargs, env, on_start, forked)
+
+    def cancel(self, futures):
+        """Stops queued jobs from starting and kills those already running"""
+        with self.lock:
+            self.cancelled = True
+            for future in futures:
+                future.cancel()
+            for proc in self.procs:
+                proc.kill()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
 
 if __name__ == '__main__':
-    PYTHON3 = sys.executable
     parser = argparse.ArgumentParser(description='Command line options.')
     parser.add_argument('--rootdir', dest='rootdir', type=str, required=True,
                         help="Root directory of Apache Pony Mail")
@@ -17,6 +268,8 @@ if __name__ == '__main__':
                         help="Load only specific yaml spec files instead of all test specs")
     parser.add_argument('--ttype', dest='ttype', type=str, nargs='+',
                         help="Run only specified test types (generators, parsing, etc)")
+    parser.add_argument('--with', dest='with_types', type=str, nargs='+',
+                        help="Also run these opt-in test types (%s)" % ", ".join(OPTIN_TYPES))
     parser.add_argument('--gtype', dest='gtype', type=str, nargs='+',
                         help="Run only specified generators (medium, cluster, dkim, full, etc)")
     parser.add_argument('--yamldir', dest='yamldir', type=str, action='store',
@@ -30,7 +283,34 @@ if __name__ == '__main__':
                         help="Stop running more tests if an error is encountered")
     parser.add_argument('--skipnodate', dest='skipnodate', action='store_true',
                         help="Skip generator tests with no Date: header")
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+                        help="Number of test scripts to run concurrently (default 1)")
+    parser.add_argument('--results', dest='results', type=str, action='store',
+                        help="Write the JSON result records of all tests to this file")
+    parser.add_argument('--shards', dest='shards', type=int,
+                        help="Split the tests of each parsing/generators spec into ranges of messages run by this many processes")
+    parser.add_argument('--profile', dest='profile', type=str, nargs='?', const='profile',
+                        help="Profile the tests, writing pstats files to this directory (default profile/)")
+    parser.add_argument('--budget', dest='budget', type=float,
+                        help="Fail a parsing/generators test if compute_updates takes longer than this many seconds "
+                             "(best effort: long calls into C code, e.g. regex matching, are not interrupted)")
+    parser.add_argument('--slowest', dest='slowest', type=int,
+                        help="Number of slowest messages each parsing/generators spec lists at the end (default none)")
+    parser.add_argument('--diff', dest='diff', type=str, action='store',
+                        help="Compare the parsing and generators output of --rootdir with this Apache Pony Mail "
+                             "installation, instead of checking it against the specs")
+    parser.add_argument('--forkserver', dest='forkserver', action='store_true',
+                        help="Import the archiver and the modules the tests use once, and fork a process per "
+                             "test script from there instead of starting a new interpreter")
+    parser.add_argument('--bycorpus', dest='bycorpus', action='store_true',
+                        help="Run the parsing and generators tests of specs which use the same corpus files together, "
+                             "reading and parsing each corpus file once for all of them")
+    parser.add_argument('--history', dest='history', type=str, default=schedule.HISTORY_FILE,
+                        help="File with the durations of previous runs, used to run the longest specs first "
+                             "with --jobs, or the fastest first with --fof (default .cache/history/durations.json)")
     args = parser.parse_args()
+    if args.bycorpus and (args.diff or args.dropin or args.shards or args.profile):
+        parser.error("--bycorpus cannot be combined with --diff, --dropin, --shards or --profile")
 
     yamldir = args.yamldir or "yaml"
 
@@ -41,62 +321,160 @@ if __name__ == '__main__':
 
     tests_success = 0
     tests_failure = 0
-    tests_total = 0
     sub_success = 0
     sub_failure = 0
     sub_skipped = 0
     now = time.time()
 
-    failbreak = False
+    # Each test script writes its JSON result records to a file in here
+    resultsdir = tempfile.mkdtemp(prefix='ponymail-results-')
+    all_records = []
+    timings = [] # (spec file, test type, 'done' record) of each job, for the phase summary
+
+    jobs = []
     for spec_file in spec_files:
-        with open(spec_file, 'r') as f:
-            yml = yaml.safe_load(f)
-            env = os.environ # always pass parent environ
-            for test_type in yml:
-                if args.ttype and test_type not in args.ttype:
-                    print("Skipping test type %s due to --ttype flag" % test_type)
+        for test_type, cliargs, env in spec_jobs(args, spec_file):
+            results_file = os.path.join(resultsdir, '%u.jsonl' % len(jobs))
+            cliargs.extend(['--results', results_file])
+            jobs.append((spec_file, test_type, cliargs, env))
+
+    # A job runs a test script, for one spec file and test type, or with --bycorpus for the
+    # parsing and generators tests of several specs which use the same corpus files
+    grouped = {}
+    if args.bycorpus:
+        for group in bycorpus_groups(jobs):
+            group_specs = []
+            for i in group:
+                if jobs[i][0] not in group_specs:
+                    group_specs.append(jobs[i][0])
+            cliargs = bycorpus_cliargs(args, group_specs)
+            cliargs.extend(['--results', os.path.join(resultsdir, 'bycorpus-%u.jsonl' % group[0])])
+            env = dict(jobs[group[0]][3])
+            for name in BYCORPUS_SPEC_ENV:
+                if name in os.environ:
+                    env[name] = os.environ[name]
+                else:
+                    env.pop(name, None)
+            for i in group:
+                grouped[i] = (group, cliargs, env)
+    runs = [] # (members, cliargs, env), where members are the (spec file, test type) the job checks
+    for i, (spec_file, test_type, cliargs, env) in enumerate(jobs):
+        if i not in grouped:
+            runs.append(([(spec_file, test_type)], cliargs, env))
+        elif grouped[i][0][0] == i:
+            group, cliargs, env = grouped[i]
+            runs.append(([jobs[n][:2] for n in group], cliargs, env))
+
+    def describe(members):
+        if len(members) == 1:
+            return "'%s' tests from %s" % (members[0][1], members[0][0])
+        test_types = [test_type for test_type in ('parsing', 'generators') if test_type in [m[1] for m in members]]
+        return "'%s' tests from %s by corpus" % ("', '".join(test_types), ", ".join(sorted(set(m[0] for m in members))))
+
+    def history_key(members):
+        if len(members) == 1:
+            return members[0][0], 'diff-' + members[0][1] if args.diff else members[0][1]
+        return ' '.join(sorted(set(spec_file for spec_file, _ in members))), 'bycorpus'
+
+    def timing_key(members):
+        if len(members) == 1:
+            return members[0]
+        return '%u specs' % len(set(spec_file for spec_file, _ in members)), 'by corpus'
+
+    # Run the longest jobs first so that none of them starts last, or the fastest first to fail early
+    history = schedule.History(args.history)
+    predictions = [history.get(*history_key(members)) for members, _, _ in runs]
+    if args.jobs > 1 or args.failonfail:
+        ordered = schedule.order(runs, predictions, args.failonfail)
+        runs = [runs[i] for i in ordered]
+        predictions = [predictions[i] for i in ordered]
+    eta = schedule.Eta(predictions, args.jobs)
+
+    # Must be started before any threads; --diff imports the archivers itself
+    server = None
+    if args.forkserver:
+        server = forkserver.ForkServer(resultsdir, os.path.join(args.rootdir, 'tools'), preload_archiver=not args.diff)
+
+    def finish(members, cliargs, returncode, rv, wall):
+        """Adds the results of a finished job to the totals; returns whether it failed"""
+        global tests_success, tests_failure, sub_success, sub_failure, sub_skipped # pylint: disable=global-statement
+        history.update(*history_key(members), wall)
+        records = read_results(cliargs[-1])
+        all_records.extend(records)
+        record = job_phases(wall, records)
+        if record:
+            timings.append(timing_key(members) + (record,))
+        failures = 0
+        for spec_file, test_type, passed, (ok, failed, skipped) in job_outcomes(members, returncode, rv, records):
+            if passed:
+                tests_success += 1
+            else:
+                print("FAIL: %s test from %s failed with code %d" % (test_type, spec_file, returncode), file=sys.stderr)
+                tests_failure += 1
+                failures += 1
+            sub_success += ok
+            sub_failure += failed
+            sub_skipped += skipped
+        return failures > 0
+
+    if args.jobs > 1:
+        pool = JobPool(args.jobs, server)
+        futures = {}
+        for i, (members, cliargs, env) in enumerate(runs):
+            forked = bool(server) and all(forkserver.forkable(test_type, env) for _, test_type in members)
+            futures[pool.submit(cliargs, env, lambda i=i: eta.start(i), forked)] = i
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                if future.cancelled():
                     continue
-                if test_type == 'args':
-                     # Environment variable override, e.g. MOCK_GMTIME
-                    env_ = yml[test_type].get("env", None)
-                    if env_:
-                        for key, val in env_.items():
-                            env[key] = val
+                i = futures[future]
+                members, cliargs, _ = runs[i]
+                returncode, rv, err, wall = future.result()
+                if returncode is None or pool.cancelled: # killed by --fof
                     continue
-                tests_total += 1
-                # Use stderr so appears in correct sequence in logs; flush seems to be necessary for GitHub actions
-                print("Running '%s' tests from %s..." % (test_type, spec_file), file=sys.stderr, flush=True)
-                try:
-                    cliargs = [PYTHON3, 'tests/test-%s.py' % test_type, '--rootdir', args.rootdir, '--load', spec_file,]
-                    if args.nomboxo:
-                        cliargs.append('--nomboxo')
-                    if args.gtype and test_type == 'generators':
-                        cliargs.append('--generators')
-                        cliargs.extend(args.gtype)
-                    if args.dropin:
-                        cliargs.extend(['--dropin', args.dropin])
-                    if args.skipnodate and test_type == 'generators':
-                        cliargs.append('--skipnodate')
-                    rv = subprocess.check_output(cliargs, env=env)
-                    tests_success += 1
-                except subprocess.CalledProcessError as e:
-                    rv = e.output
-                    print("FAIL: %s test from %s failed with code %d" % (test_type, spec_file, e.returncode), file=sys.stderr, flush=True)
-                    tests_failure += 1
-                    if args.failonfail:
-                        failbreak = True
-                        break
-                finally:
-                    # Fetch successes and failures from this spec run, add to total
-                    m = re.search(r"^\[DONE\] (\d+) tests run, (\d+) failed\.( Skipped (\d+)\.)?", rv.decode('ascii'), re.MULTILINE)
-                    if m:
-                        sub_success += int(m.group(1)) - int(m.group(2))
-                        sub_failure += int(m.group(2))
-                        if m.group(4) is not None:
-                            sub_skipped += int(m.group(4))
-        if failbreak:
-            break
+                eta.finish(i, wall)
+                # Print the whole of each job's output at once so the logs stay readable
+                print("Running %s..." % describe(members), file=sys.stderr)
+                sys.stderr.write(err.decode('utf-8', 'replace'))
+                failed = finish(members, cliargs, returncode, rv, wall)
+                sys.stderr.write(eta.report())
+                sys.stderr.flush()
+                if failed and args.failonfail:
+                    pool.cancel(futures)
+                    break
+        finally:
+            pool.shutdown()
+    else:
+        for i, (members, cliargs, env) in enumerate(runs):
+            # Use stderr so appears in correct sequence in logs; flush seems to be necessary for GitHub actions
+            print("Running %s..." % describe(members), file=sys.stderr, flush=True)
+            eta.start(i)
+            started = time.time()
+            if server and all(forkserver.forkable(test_type, env) for _, test_type in members):
+                proc = server.run(cliargs, env, capture_stderr=False)
+                rv, _ = proc.communicate()
+            else:
+                proc = subprocess.Popen(cliargs, env=env, stdout=subprocess.PIPE)
+                rv, _ = proc.communicate()
+            wall = time.time() - started
+            eta.finish(i, wall)
+            # Fetch successes and failures from this spec run, add to total
+            finish(members, cliargs, proc.returncode, rv, wall)
+            sys.stderr.write(eta.report())
+            sys.stderr.flush()
+            if tests_failure and args.failonfail:
+                break
+
+    if server:
+        server.close()
+    history.save()
+    shutil.rmtree(resultsdir, ignore_errors=True)
+    if args.results:
+        with open(args.results, 'w', encoding='utf-8') as f:
+            for record in all_records:
+                f.write(json.dumps(record) + "\n")
 
+    tests_total = tests_success + tests_failure
     # No need for stderr at end of run
     print("-------------------------------------")
     print("Done with %u specification%s in %.2f seconds" % (tests_total, 's' if tests_total != 1 else '', time.time() - now))
@@ -106,5 +484,6 @@ if __name__ == '__main__':
     print("Tests failed:    %4u" % sub_failure)
     print("Tests skipped:   %4u" % sub_skipped)
     print("-------------------------------------")
+    print_phases(timings)
     if tests_failure:
         sys.exit(-1)
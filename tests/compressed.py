@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Random access to gzip and xz compressed corpus files.
+
+A compressed corpus file is a series of independently compressed blocks
+(gzip members or xz streams), each holding whole messages; this is still a
+valid .gz/.xz file, so zcat, xzcat etc. work as usual.
+tools/compress-corpus.py writes files in this layout.
+
+BlockFile scans the file once to find the blocks and saves their offsets
+(compressed and uncompressed) in the cache, like the mbox index in corpus.py.
+After that, reading a message only decompresses the block that holds it.
+A file compressed in one go (e.g. by plain gzip) is a single block,
+which works, but has to be decompressed in full.
+"""
+
+import bisect
+import collections
+import lzma
+import zlib
+import corpus
+
+INDEX_VERSION = 1
+CHUNK_SIZE = 1 << 20
+CACHED_BLOCKS = 4
+
+
+def _gzip_compress(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+# suffix: (new decompressor, compress a block)
+FORMATS = {
+    '.gz': (lambda: zlib.decompressobj(wbits=31), _gzip_compress),
+    '.xz': (lzma.LZMADecompressor, lambda data: lzma.compress(data, format=lzma.FORMAT_XZ)),
+}
+
+
+def _format(path):
+    for suffix, fmt in FORMATS.items():
+        if path.endswith(suffix):
+            return fmt
+    raise ValueError("%s is not a .gz or .xz file" % path)
+
+
+def is_compressed(path):
+    return path.endswith(tuple(FORMATS))
+
+
+def compress_block(path, data):
+    """Compresses a block of data in the format given by the suffix of path"""
+    return _format(path)[1](data)
+
+
+def _scan(f, new_decompressor):
+    """Returns [compressed offset, compressed size, offset, size] for each block of the file"""
+    blocks = []
+    coffset = uoffset = size = cpos = 0
+    decompressor = new_decompressor()
+    data = f.read(CHUNK_SIZE)
+    while data:
+        size += len(decompressor.decompress(data))
+        if decompressor.eof:
+            unused = decompressor.unused_data
+            end = cpos + len(data) - len(unused)
+            blocks.append([coffset, end - coffset, uoffset, size])
+            coffset = cpos = end
+            uoffset += size
+            size = 0
+            decompressor = new_decompressor()
+            data = unused or f.read(CHUNK_SIZE)
+        else:
+            cpos += len(data)
+            data = f.read(CHUNK_SIZE)
+    if cpos > coffset:
+        raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+    return blocks
+
+
+class BlockFile(object):
+    """Read-only, seekable file object for the uncompressed content of a .gz or .xz file"""
+
+    def __init__(self, path):
+        self.name = path
+        self._new_decompressor = _format(path)[0]
+        self._file = open(path, 'rb')
+        index = corpus.load_index('blocks', path, INDEX_VERSION)
+        if index:
+            self._blocks = index['blocks']
+        else:
+            self._blocks = _scan(self._file, self._new_decompressor)
+            corpus.save_index('blocks', path, INDEX_VERSION, {'blocks': self._blocks})
+        self._starts = [block[2] for block in self._blocks]
+        self._size = self._blocks[-1][2] + self._blocks[-1][3] if self._blocks else 0
+        self._pos = 0
+        self._cache = collections.OrderedDict()
+
+    def _block(self, n):
+        """Returns the uncompressed data of a block, keeping the last few in memory"""
+        data = self._cache.get(n)
+        if data is None:
+            coffset, csize, _, _ = self._blocks[n]
+            self._file.seek(coffset)
+            data = self._new_decompressor().decompress(self._file.read(csize))
+            self._cache[n] = data
+            if len(self._cache) > CACHED_BLOCKS:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(n)
+        return data
+
+    def _chunk(self, size, line):
+        """Returns up to size bytes from the current block, stopping after a newline if line is set"""
+        n = bisect.bisect_right(self._starts, self._pos) - 1
+        data = self._block(n)
+        offset = self._pos - self._starts[n]
+        end = len(data) if size < 0 else min(len(data), offset + size)
+        if line:
+            eol = data.find(b'\n', offset, end)
+            if eol >= 0:
+                end = eol + 1
+        self._pos += end - offset
+        return data[offset:end]
+
+    def _read(self, size, line):
+        if size is None:
+            size = -1
+        chunks = []
+        while size != 0 and self._pos < self._size:
+            chunk = self._chunk(size, line)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+            if line and chunk.endswith(b'\n'):
+                break
+        return b''.join(chunks)
+
+    def read(self, size=-1):
+        return self._read(size, False)
+
+    read1 = read
+
+    def readline(self, size=-1):
+        return self._read(size, True)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self._size
+        if offset < 0:
+            raise ValueError("negative seek position %d" % offset)
+        self._pos = offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def flush(self):
+        pass
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def close(self):
+        self._cache.clear()
+        self._file.close()
@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+"""
+Opens the mbox files of the test corpus.
+
+mailbox.mbox scans the whole file for 'From ' lines the first time its keys are needed.
+IndexedMbox saves the resulting table of contents (message start/stop offsets), along
+with the message-id of each message, in a sidecar index file and reuses it for
+later runs and for the other test scripts that read the same file.
+
+The index is stored in the cache directory, which defaults to .cache/ at the top of
+this repository and can be changed with the PONYMAIL_TEST_CACHE environment variable.
+It is used if the size and mtime of the mbox file are unchanged; if only the mtime
+differs (e.g. after a fresh checkout) the SHA-256 of the content is compared instead.
+
+Corpus files may also be gzip or xz compressed (corpus/name.mbox.xz); a spec may
+name the compressed file, or the plain .mbox file if only the compressed copy exists.
+The offsets in the index are then offsets in the uncompressed content.
+
+Parsing the messages takes much longer than reading them, so IndexedMbox also keeps
+the parsed messages in a MessageCache: a pack file per corpus content (SHA-256),
+mboxo setting and Python version, in which each message is stored, as it is parsed,
+under its offset in the corpus file: the raw bytes as read() returns them, and the
+pickled mboxMessage. Later runs, and the other test scripts and generator passes
+over the same corpus, read and unpickle the message instead, a message at a time.
+The pack files together are kept under PONYMAIL_TEST_CACHE_SIZE megabytes (default
+256, 0 disables the cache) by removing the least recently used ones.
+"""
+
+import io
+import copy
+import os
+import sys
+import json
+import hashlib
+import mailbox
+import pickle
+import struct
+import zlib
+import email.parser
+
+INDEX_VERSION = 1
+MESSAGE_CACHE_VERSION = 2 # change when read() or parse() give different results, e.g. after changes to mboxo_patch.py
+MESSAGE_CACHE_SIZE = int(os.environ.get('PONYMAIL_TEST_CACHE_SIZE') or 256) << 20
+# Header of each message in a pack file: magic, offset in the corpus file, raw and pickle lengths, CRC-32 of both
+MESSAGE_RECORD = struct.Struct('<4sQIII')
+MESSAGE_MAGIC = b'PMsg'
+COMPRESSED_SUFFIXES = ('.xz', '.gz')
+CACHE_DIR = os.environ.get('PONYMAIL_TEST_CACHE') or \
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '.cache')
+
+
+def cache_path(kind, name):
+    """Returns the path of a file in a subdirectory of the cache directory"""
+    return os.path.join(CACHE_DIR, kind, name)
+
+
+def write_cache(path, data, mode='w'):
+    """Atomically writes a cache file, giving up quietly if that is not possible"""
+    tmp = "%s.%u.tmp" % (path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, mode) as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _index_path(kind, path):
+    realpath = os.path.realpath(path)
+    name = "%s-%s.json" % (os.path.basename(realpath), hashlib.sha1(realpath.encode('utf-8')).hexdigest()[:12])
+    return cache_path(kind, name)
+
+
+def load_index(kind, path, version):
+    """Returns the cached index of a file, or None if there is none or the file has changed"""
+    try:
+        with open(_index_path(kind, path), 'r') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    stat = os.stat(path)
+    if index.get('version') != version or index['size'] != stat.st_size:
+        return None
+    if index['mtime_ns'] != stat.st_mtime_ns:
+        if index['sha256'] != file_sha256(path):
+            return None
+        # Same content, just touched; remember the new mtime
+        index['mtime_ns'] = stat.st_mtime_ns
+        write_cache(_index_path(kind, path), json.dumps(index))
+    return index
+
+
+def save_index(kind, path, version, index):
+    """Saves the index of a file in the cache, along with what is needed to validate it"""
+    stat = os.stat(path)
+    index = dict(index, version=version, size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=file_sha256(path))
+    write_cache(_index_path(kind, path), json.dumps(index))
+    return index
+
+
+class MessageCache(object):
+    """
+    The parsed messages of a corpus file in an append-only pack file, by offset in the corpus file.
+    Each message is appended with a single write, so several processes can add to the same pack.
+    A record left partly written by a process which was killed is skipped when the pack is
+    scanned, and so is not in the way of the records which later runs append after it.
+    """
+
+    def __init__(self, sha256, nomboxo, limit=MESSAGE_CACHE_SIZE):
+        name = "%s-%s-py%u%u-%u.pack" % (sha256, 'nomboxo' if nomboxo else 'mboxo',
+                                         sys.version_info[0], sys.version_info[1], MESSAGE_CACHE_VERSION)
+        self.path = cache_path('messages', name)
+        self.limit = limit
+        self.entries = None # offset: (position in pack, raw length, pickle length, CRC-32)
+        self.fh = None
+        self.room = 0 # bytes which may still be added
+
+    def _scan(self):
+        """Reads the headers of the messages in the pack"""
+        self.entries = {}
+        self.room = evict_messages(self.limit, self.path)
+        try:
+            self.fh = open(self.path, 'rb')
+            os.utime(self.path) # most recently used
+        except OSError:
+            return
+        fd = self.fh.fileno()
+        size = os.fstat(fd).st_size
+        position = 0
+        last = -1 # position of the last record read
+        resyncing = False
+        while position + MESSAGE_RECORD.size <= size:
+            header = os.pread(fd, MESSAGE_RECORD.size, position)
+            magic, offset, raw_length, pickle_length, crc = MESSAGE_RECORD.unpack(header)
+            end = position + MESSAGE_RECORD.size + raw_length + pickle_length
+            valid = magic == MESSAGE_MAGIC and end <= size
+            if valid and resyncing:
+                # a record found by searching for the magic must check out in full
+                valid = zlib.crc32(os.pread(fd, raw_length + pickle_length, position + MESSAGE_RECORD.size)) == crc
+            if not valid:
+                # Partly written by a process which was killed, and perhaps followed by the records of
+                # later runs, so look for the next good record. The torn record may be the last one read,
+                # with a length which covered later records, so the search starts inside it.
+                position = self._find_magic(fd, (position if resyncing else last) + 1, size)
+                resyncing = True
+                continue
+            self.entries[offset] = (position + MESSAGE_RECORD.size, raw_length, pickle_length, crc)
+            last = position
+            position = end
+            resyncing = False
+
+    @staticmethod
+    def _find_magic(fd, position, size, chunk=1 << 20):
+        """Returns the position of the next MESSAGE_MAGIC in the pack from position on, or size"""
+        while position < size:
+            data = os.pread(fd, chunk + len(MESSAGE_MAGIC) - 1, position)
+            found = data.find(MESSAGE_MAGIC)
+            if found >= 0:
+                return position + found
+            position += chunk
+        return size
+
+    def get(self, offset):
+        """Returns the raw bytes and the pickled message at an offset in the corpus file, or None"""
+        if self.entries is None:
+            self._scan()
+        entry = self.entries.get(offset)
+        if entry is None:
+            return None
+        position, raw_length, pickle_length, crc = entry
+        # pread, as the file offset is shared with processes forked since it was opened (--shards)
+        data = os.pread(self.fh.fileno(), raw_length + pickle_length, position)
+        if len(data) != raw_length + pickle_length or zlib.crc32(data) != crc:
+            del self.entries[offset]
+            return None
+        return data[:raw_length], data[raw_length:]
+
+    def put(self, offset, message_raw, message):
+        """Adds a message, if there is room for it"""
+        if self.entries is None:
+            self._scan()
+        if offset in self.entries:
+            return
+        pickled = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        data = message_raw + pickled
+        record = MESSAGE_RECORD.pack(MESSAGE_MAGIC, offset, len(message_raw), len(pickled), zlib.crc32(data)) + data
+        if len(record) > self.room:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, record)
+            finally:
+                os.close(fd)
+        except OSError:
+            self.room = 0
+            return
+        self.room -= len(record)
+        # Not added to entries: the message is only read back by later runs
+
+    def close(self):
+        if self.fh:
+            self.fh.close()
+            self.fh = None
+
+
+def evict_messages(limit, keep):
+    """
+    Removes the least recently used message pack files until they take no more than limit bytes;
+    keep (the pack in use) counts as the most recently used. Returns how many bytes may still be added.
+    """
+    directory = os.path.dirname(keep)
+    packs = []
+    total = 0
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        names = []
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        total += stat.st_size
+        if name.endswith('.pack'):
+            packs.append((float('inf') if path == keep else stat.st_mtime, stat.st_size, path))
+    for _, size, path in sorted(packs):
+        if total <= limit:
+            break
+        try:
+            os.unlink(path)
+            total -= size
+        except OSError:
+            pass
+    return max(0, limit - total)
+
+
+class IndexedMbox(mailbox.mbox):
+    """mailbox.mbox which loads its table of contents from a sidecar index when possible"""
+
+    def __init__(self, path, factory=None, create=False):
+        self._message_ids = None
+        self._mmap = None
+        self._sha256 = None
+        self._cache = None
+        self._cached = None # (raw bytes, pickled message) returned by the cache for the last read()
+        self._uncached = None # (offset, raw bytes) read from the file by the last read()
+        super().__init__(path, factory, create)
+        import compressed
+        self._compressed = compressed.is_compressed(path)
+        if self._compressed:
+            # mailbox.mbox reads everything through self._file
+            self._file.close()
+            self._file = compressed.BlockFile(path)
+
+    def _generate_toc(self):
+        index = load_index('mbox', self._path, INDEX_VERSION)
+        if index:
+            self._toc = dict(enumerate(tuple(x) for x in index['toc']))
+            self._next_key = len(self._toc)
+            self._file_length = index['size']
+            self._message_ids = index['message_ids']
+        else:
+            super()._generate_toc()
+            self._message_ids = [self._read_message_id(key) for key in range(self._next_key)]
+            index = save_index('mbox', self._path, INDEX_VERSION, {
+                'toc': [self._toc[key] for key in range(self._next_key)],
+                'message_ids': self._message_ids,
+            })
+        self._sha256 = index['sha256']
+
+    def _read_message_id(self, key):
+        start, stop = self._toc[key]
+        self._file.seek(start)
+        self._file.readline() # From line
+        headers = []
+        while self._file.tell() < stop:
+            line = self._file.readline()
+            if not line.strip():
+                break
+            headers.append(line)
+        message = email.parser.BytesHeaderParser().parsebytes(b''.join(headers))
+        return str(message.get('message-id') or '').strip()
+
+    def load(self, key):
+        """
+        Returns the raw bytes (including the From line) and the mboxMessage of a message.
+        This gives the same result as reading the file with MboxoReader and calling get().
+        """
+        message_raw = self.read(key)
+        return message_raw, self.parse(message_raw)
+
+    def read(self, key):
+        """
+        Returns the raw bytes of a message, including the From line.
+        The bytes are read from the file once, with the mboxo fix applied by MboxoMmap
+        only if needed.
+        """
+        start, stop = self._lookup(key)
+        if self._cache is None and MESSAGE_CACHE_SIZE > 0:
+            self._cache = MessageCache(self._sha256, self._factory is None)
+        cached = self._cache.get(start) if self._cache else None
+        self._cached = cached
+        if cached:
+            self._uncached = None
+            return cached[0]
+        if self._factory is None:
+            self._file.seek(start)
+            message_raw = self._file.read(stop - start)
+        elif self._compressed:
+            # cannot mmap, but the block is decompressed into memory anyway
+            from mboxo_patch import FROM_MANGLED, FROM_UNMANGLED
+            self._file.seek(start)
+            message_raw = self._file.read(stop - start).replace(FROM_MANGLED, FROM_UNMANGLED)
+        else:
+            if self._mmap is None:
+                from mboxo_patch import MboxoMmap
+                self._mmap = MboxoMmap(self._path)
+            message_raw = self._mmap.get(start, stop)
+        self._uncached = (start, message_raw)
+        return message_raw
+
+    def parse(self, message_raw):
+        """
+        Returns the mboxMessage for the raw bytes of a message, as returned by read().
+        A message read from the cache is unpickled rather than parsed; a new one is added to the cache.
+        """
+        if self._cached and self._cached[0] is message_raw:
+            return pickle.loads(self._cached[1])
+        message = self._parse(message_raw)
+        if self._cache and self._uncached and self._uncached[1] is message_raw:
+            self._cache.put(self._uncached[0], message_raw, message)
+            self._uncached = None
+        return message
+
+    def _parse(self, message_raw):
+        eol = message_raw.find(b'\n') + 1 or len(message_raw) # end of the From line
+        if self._factory is None:
+            # as per mailbox.mbox.get_message()
+            message = mailbox.mboxMessage(message_raw[eol:].replace(mailbox.linesep, b'\n'))
+            message.set_from(message_raw[:eol].replace(mailbox.linesep, b'')[5:].decode('ascii'))
+            return message
+        body = message_raw[eol:]
+        if body.startswith(b'From '):
+            # Must have been mangled; MboxoFactory does not see the From line so cannot match it
+            body = b'>' + body
+        # as per MboxoFactory, which parses the file rather than the bytes
+        message = mailbox.mboxMessage(io.BytesIO(body))
+        # MboxoFactory leaves the from line as MAILER-DAEMON and the current time, which would be
+        # frozen in the cache, so use that of the message, as with nomboxo
+        message.set_from(message_raw[:eol].replace(mailbox.linesep, b'')[5:].decode('ascii'))
+        return message
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+        super().close()
+
+    def message_id(self, key):
+        """Returns the (stripped) message-id of a message, as recorded in the index"""
+        self._lookup()
+        return self._message_ids[key]
+
+
+def copy_message(message):
+    """
+    Cheap copy of a parsed message, e.g. one per generator.
+    The copy and each of its parts (copied recursively for multipart messages) have their own
+    header and defect lists, so changes to headers (such as MOCK_AAT), payloads or the part list
+    do not leak into other copies or into the cached message (see MessageCache).
+    Other attributes are shared, so changes inside them, e.g. to a Charset object, would still leak.
+    """
+    # pylint: disable=protected-access
+    copied = copy.copy(message)
+    copied._headers = list(message._headers)
+    copied.defects = list(message.defects)
+    if message.is_multipart():
+        copied._payload = [copy_message(part) for part in message._payload]
+    return copied
+
+
+def resolve_path(path):
+    """Returns the path of a corpus file, or of its compressed copy (.xz or .gz) if only that exists"""
+    if not os.path.exists(path):
+        for suffix in COMPRESSED_SUFFIXES:
+            if os.path.exists(path + suffix):
+                return path + suffix
+    return path
+
+
+def open_mbox(path, nomboxo=False):
+    """
+    Opens a corpus mbox file, using the mboxo patch unless nomboxo is set.
+    The file may be gzip or xz compressed; see compressed.py.
+    """
+    path = resolve_path(path)
+    factory = None
+    if not nomboxo:
+        # Temporary patch to fix Python email package limitation
+        # It must be removed when the Python package is fixed
+        from mboxo_patch import MboxoFactory
+        factory = MboxoFactory
+    return IndexedMbox(path, factory, create=False)
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+A fork server for runall.py --forkserver: it imports yaml, mailbox, email, the
+archiver, generators and its optional dependencies once, then forks a child per
+test script instead of starting a new interpreter for each.
+
+The server is forked from runall.py before it starts any threads, and itself stays
+single-threaded, so that it is safe to fork from. Each child sets up the environment
+of its job (including the args env of the spec), runs the test script as __main__
+with runpy, and writes its stdout (and stderr, unless it is inherited) to files,
+as the script would to the pipes of a separate process. It exits with the exit
+code of the script, so the test scripts stay isolated from each other.
+
+Jobs which would not behave the same in a forked child must not use the fork server,
+see forkable().
+"""
+
+import importlib
+import multiprocessing
+import os
+import runpy
+import select
+import signal
+import sys
+import threading
+import traceback
+
+# Imported once by the server; the archiver and generators are imported from the tools dir of --rootdir
+PRELOAD = ('yaml', 'mailbox', 'email.parser', 'email.policy', 'email.utils', 'email.header', 'hashlib', 'json',
+           'chardet', 'formatflowed', 'html2text', 'netaddr', 'elasticsearch')
+PRELOAD_ARCHIVER = ('archiver', 'generators', 'plugins.generators')
+# Test types which import the archiver themselves in a particular way (--diff imports two of them)
+UNFORKABLE_TYPES = ('ingest',)
+
+
+def forkable(test_type, env):
+    """
+    Returns whether a job can run in the fork server: variables such as PYTHONHASHSEED
+    only take effect when an interpreter starts, and test-ingest.py must redirect the
+    Elasticsearch client before the archiver is imported.
+    """
+    if test_type in UNFORKABLE_TYPES:
+        return False
+    return all(env.get(name) == os.environ.get(name) for name in set(env) | set(os.environ) if name.startswith('PYTHON'))
+
+
+class Job(object):
+    """A test script run by the fork server, with the parts of the subprocess.Popen API that runall.py uses"""
+
+    def __init__(self, server, stdout_path, stderr_path):
+        self.server = server
+        self.stdout_path = stdout_path
+        self.stderr_path = stderr_path
+        self.pid = None
+        self.returncode = None
+        self.finished = threading.Event()
+        self.killed = False # kill() was called, maybe before the server sent the pid
+        self.lock = threading.Lock()
+
+    def wait(self):
+        self.finished.wait()
+        return self.returncode
+
+    def communicate(self):
+        self.wait()
+        output = []
+        for path in (self.stdout_path, self.stderr_path):
+            data = b''
+            if path:
+                try:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                    os.unlink(path)
+                except OSError:
+                    pass
+            output.append(data)
+        return tuple(output)
+
+    def kill(self):
+        with self.lock:
+            self.killed = True
+            self._signal()
+
+    def started(self, pid):
+        """Called with the pid from the server; kills the job straight away if kill() came first"""
+        with self.lock:
+            self.pid = pid
+            if self.killed:
+                self._signal()
+
+    def _signal(self):
+        if self.pid and not self.finished.is_set():
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+
+class ForkServer(object):
+    def __init__(self, outdir, tools_dir=None, preload_archiver=True):
+        self.outdir = outdir
+        self.jobs = {}
+        self.count = 0
+        self.lock = threading.Lock()
+        conn, server_conn = multiprocessing.Pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.pid = os.fork()
+        if self.pid == 0:
+            conn.close()
+            _serve(server_conn, PRELOAD + (PRELOAD_ARCHIVER if preload_archiver else ()), tools_dir)
+        server_conn.close()
+        self.conn = conn
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def run(self, cliargs, env, capture_stderr=True):
+        """Starts a test script (cliargs as for subprocess, starting with the interpreter); returns its Job"""
+        with self.lock:
+            self.count += 1
+            job_id = self.count
+            job = Job(self, os.path.join(self.outdir, 'job-%u.out' % job_id),
+                      os.path.join(self.outdir, 'job-%u.err' % job_id) if capture_stderr else None)
+            self.jobs[job_id] = job
+            self.conn.send((job_id, cliargs[1:], dict(env), job.stdout_path, job.stderr_path))
+        return job
+
+    def _read(self):
+        """Passes the pid and exit code of each job on from the server"""
+        while True:
+            try:
+                event, job_id, value = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            job = self.jobs[job_id]
+            if event == 'started':
+                job.started(value)
+            else:
+                job.returncode = value
+                job.finished.set()
+                with self.lock:
+                    del self.jobs[job_id]
+        # The server has gone; fail any jobs still waiting for it
+        with self.lock:
+            for job in self.jobs.values():
+                job.returncode = -1
+                job.finished.set()
+
+    def close(self):
+        with self.lock:
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+        os.waitpid(self.pid, 0)
+        self.conn.close()
+
+
+def _serve(conn, preload, tools_dir):
+    """The server loop: forks a child per request, and reports when they start and finish"""
+    code = 0
+    try:
+        if tools_dir:
+            sys.path.append(tools_dir)
+        for name in preload:
+            try:
+                importlib.import_module(name)
+            except Exception: # pylint: disable=broad-except
+                pass # optional, or not in this version
+        # Wake up select() when a child exits
+        wakeup_r, wakeup_w = os.pipe()
+        os.set_blocking(wakeup_w, False)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.set_wakeup_fd(wakeup_w)
+        signal.signal(signal.SIGINT, signal.SIG_IGN) # ^C goes to runall.py and the jobs themselves
+        running = {}
+        accepting = True
+        while accepting or running:
+            try:
+                ready, _, _ = select.select([conn, wakeup_r] if accepting else [wakeup_r], [], [], 1.0)
+            except InterruptedError:
+                ready = []
+            if wakeup_r in ready:
+                os.read(wakeup_r, 4096)
+            if conn in ready:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    request = None
+                if request is None:
+                    accepting = False
+                else:
+                    job_id = request[0]
+                    pid = os.fork()
+                    if pid == 0:
+                        signal.set_wakeup_fd(-1)
+                        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                        signal.signal(signal.SIGINT, signal.default_int_handler)
+                        os.close(wakeup_r)
+                        os.close(wakeup_w)
+                        conn.close()
+                        _child(*request[1:])
+                    running[pid] = job_id
+                    conn.send(('started', job_id, pid))
+            while running:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if not pid:
+                    break
+                conn.send(('done', running.pop(pid), _exitcode(status)))
+    except BaseException: # pylint: disable=broad-except
+        traceback.print_exc()
+        code = 1
+    finally:
+        os._exit(code) # pylint: disable=protected-access
+
+
+def _exitcode(status):
+    """The exit code of a child as subprocess reports it: -N if killed by signal N (os.waitstatus_to_exitcode is 3.9+)"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _child(argv, env, stdout_path, stderr_path):
+    """Runs a test script in a forked child, as if it had been started by subprocess"""
+    code = 0
+    try:
+        for fd, path in ((1, stdout_path), (2, stderr_path)):
+            if path:
+                out = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                os.dup2(out, fd)
+                os.close(out)
+        os.environ.clear()
+        os.environ.update(env)
+        sys.argv = list(argv)
+        script_dir = os.path.dirname(os.path.realpath(argv[0]))
+        sys.path.insert(0, script_dir)
+        # The helper modules next to the script (phases, corpus, ...) keep state, and runall.py imports some too
+        for name, module in list(sys.modules.items()):
+            path = getattr(module, '__file__', None)
+            if path and os.path.dirname(os.path.realpath(path)) == script_dir:
+                del sys.modules[name]
+        runpy.run_path(argv[0], run_name='__main__')
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int):
+            code = e.code
+        else:
+            sys.stderr.write("%s\n" % e.code)
+            code = 1
+    except BaseException: # pylint: disable=broad-except
+        traceback.print_exc()
+        code = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code & 0xff) # pylint: disable=protected-access
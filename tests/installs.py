@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Loads more than one Apache Pony Mail installation into the same process (see test-diff.py).
+
+Every installation has an archiver module (and generators, plugins etc.) which is
+imported by the same name from <rootdir>/tools. Install imports them with its own
+tools directory first on sys.path, then moves them out of sys.modules so that the
+next installation gets its own copies. activate() puts them back while an
+installation is being called, so that any imports made by the archiver at run
+time also find the modules of its own installation.
+"""
+
+import contextlib
+import importlib
+import os
+import sys
+
+
+class Install(object):
+    def __init__(self, rootdir):
+        self.rootdir = os.path.realpath(rootdir)
+        self.tools_dir = os.path.join(self.rootdir, 'tools')
+        self.modules = {}
+        with self.activate():
+            self.archiver = importlib.import_module('archiver')
+            try:
+                generators = importlib.import_module('generators')
+            except ImportError:
+                generators = importlib.import_module('plugins.generators')
+        self.generator_names = generators.generator_names() if hasattr(generators, 'generator_names') else ['full', 'medium', 'cluster', 'legacy']
+
+    def _owns(self, module):
+        path = getattr(module, '__file__', None) or next(iter(getattr(module, '__path__', None) or []), None)
+        return bool(path) and os.path.realpath(path).startswith(self.rootdir + os.sep)
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Context manager which makes the modules of this installation importable"""
+        sys.path.insert(0, self.tools_dir)
+        saved = dict((name, sys.modules[name]) for name in self.modules if name in sys.modules)
+        sys.modules.update(self.modules)
+        count = len(sys.modules)
+        try:
+            yield
+        finally:
+            if len(sys.modules) != count:
+                # something was imported; keep any modules of this installation
+                for name, module in list(sys.modules.items()):
+                    if name not in self.modules and self._owns(module):
+                        self.modules[name] = module
+            for name in self.modules:
+                sys.modules.pop(name, None)
+            sys.modules.update(saved)
+            sys.path.remove(self.tools_dir)
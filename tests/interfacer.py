@@ -10,6 +10,8 @@ Foal:
 
     def compute_updates(self, lid, private, msg, raw_msg):
 
+    def archive_message(self, mlist, msg, raw_message=None, dry=False, dump=None, defaultepoch=None, digest=False):
+
 Ponymail 12:
     def __init__(
         self, generator=None, parse_html=False, ignore_body=None, dump_dir=None, verbose=False, skipff=False
@@ -17,11 +19,15 @@ Ponymail 12:
 
     def compute_updates(self, lid, private, msg):
 
+    def archive_message(self, args, mlist, msg, raw_message):
+
 0.11, 0.10:
     def __init__(self, parseHTML=False):
 
     def compute_updates(self, lid, private, msg):
 
+    def archive_message(self, mlist, msg[, raw_message]):
+
 """
 
 import sys
@@ -32,10 +38,12 @@ class Archiver(object):
         self.expected_archie_parameters = inspect.signature(archiver_.Archiver).parameters
         self.expected_compute_parameters = inspect.signature(archiver_.Archiver.compute_updates).parameters
 
+        self.archiver_ = archiver_
+        self.generator = getattr(args, 'generator', None)
         # <= 0.11:
         if 'parseHTML' in self.expected_archie_parameters:
-            if hasattr(args, 'generator'):
-                archiver_.archiver_generator = args.generator
+            if self.generator:
+                archiver_.archiver_generator = self.generator
             self.archie = archiver_.Archiver(parseHTML=args.parse_html)
             params = inspect.signature(archiver_.Archiver.list_url).parameters
             if '_mlist' in params:
@@ -73,7 +81,22 @@ class Archiver(object):
         return self.archie.compute_updates(fake_args, lid, private, message)[0]
 
     def _compute_11(self, fake_args, lid, private, message, message_raw):
+        # The generator is a module global here, so several Archivers may share it
+        if self.generator:
+            self.archiver_.archiver_generator = self.generator
         return self.archie.compute_updates(lid, private, message)[0]
 
     def compute_updates(self, fake_args, lid, private, message, message_raw):
         return self.compute(fake_args, lid, private, message, message_raw)
+
+    def archive_message(self, fake_args, list_data, message, message_raw):
+        """Stores a message through the archiver's own Elasticsearch path"""
+        params = list(inspect.signature(self.archiver_.Archiver.archive_message).parameters)[1:]
+        call_args = [list_data, message]
+        if params[:1] == ['args']: # PM 0.12
+            call_args.insert(0, fake_args)
+        if len(params) > len(call_args): # raw message, where supported
+            call_args.append(message_raw)
+        if self.generator and self.version in ('v0.10', 'v0.11', '?'):
+            self.archiver_.archiver_generator = self.generator
+        return self.archie.archive_message(*call_args)
@@ -28,6 +28,14 @@ from mboxo_patch import MboxoFactory
 ...
 messages = mailbox.mbox(filename, MboxoFactory)
 
+MboxoMmap is an alternative which memory-maps the whole mbox file.
+It finds all the mangled From lines in one pass when the file is opened,
+so a message that has none is returned as a plain slice of the file, and
+only the messages that need it are searched and unmangled:
+
+mm = MboxoMmap(filename)
+data = mm.get(start, stop) # e.g. offsets from mailbox.mbox._lookup(key)
+
 N.B.
 To simplify the code, the MboxoReader class changes the
 size parameter to 7 if (and only if): 0 <= size < 7
@@ -36,7 +44,9 @@ However this is only a theoretical possibility
 as the mailbox code uses a size of 8192 (or None)
 
 """
+import bisect
 import mailbox
+import mmap
 
 FROM_MANGLED  =b'\n>From '
 FROM_MANGLED_LEN=len(FROM_MANGLED)
@@ -95,3 +105,33 @@ class MboxoReader(mailbox._PartialFile): # pylint: disable=W0212
 class MboxoFactory(mailbox.mboxMessage):
     def __init__(self, message=None):
         super().__init__(message=MboxoReader(message))
+
+class MboxoMmap(object):
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # cannot map an empty file
+            self._map = b''
+        # offsets of the '>' of every mangled From line
+        self._mangled = []
+        pos = self._map.find(FROM_MANGLED)
+        while pos >= 0:
+            self._mangled.append(pos + 1)
+            pos = self._map.find(FROM_MANGLED, pos + 1)
+
+    def is_mangled(self, start, stop):
+        """Does the range contain a mangled From line (after its first byte)?"""
+        i = bisect.bisect_right(self._mangled, start)
+        return i < len(self._mangled) and self._mangled[i] < stop
+
+    def get(self, start, stop):
+        """Returns the unmangled bytes of the range"""
+        if not self.is_mangled(start, stop):
+            return self._map[start:stop]
+        return self._map[start:stop].replace(FROM_MANGLED, FROM_UNMANGLED)
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+The MOCK_GMTIME and MOCK_AAT overrides which specs can set in their args env.
+
+install_gmtime(True) makes time.gmtime() return the epoch when the archiver or
+generators call it without a time, so that IDs which depend on the current time
+are reproducible. It can be called again with False and True to turn it off and on,
+e.g. per spec; the patch itself stays in place once installed.
+
+apply_aat(message, env, gen_type) sets the archived-at header of a message to
+MOCK_AAT, for the medium generator, which uses that header when there is one.
+"""
+
+import email.utils
+import sys
+import time
+
+_gmtime = {'enabled': False, 'original': None}
+
+
+def install_gmtime(enabled=True):
+    _gmtime['enabled'] = enabled
+    if not enabled or _gmtime['original']:
+        return
+    save_gmtime = _gmtime['original'] = time.gmtime
+    def _time_gmtime(secs=None):
+        if secs is None and _gmtime['enabled']:
+            # Only look at the caller's frame; extracting the stack is much slower
+            filename = sys._getframe(1).f_code.co_filename # pylint: disable=protected-access
+            if filename.endswith("/tools/archiver.py") or filename.endswith("tools/generators.py"):
+                return save_gmtime(0)
+        return save_gmtime(secs)
+
+    time.gmtime = _time_gmtime
+
+
+def apply_aat(message, env, gen_type):
+    """Mocks archived-at for slightly broken medium generators, if the env has MOCK_AAT"""
+    if 'MOCK_AAT' in env and gen_type == 'medium':
+        mock_aat = email.utils.formatdate(int(env['MOCK_AAT']), False)
+        try:
+            message.replace_header('archived-at', mock_aat)
+        except KeyError:
+            message['archived-at'] = mock_aat
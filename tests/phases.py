@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Accounts for the wall time, CPU time and peak RSS growth of a test script by phase,
+for the summary printed by runall.py:
+
+startup   interpreter startup and imports, including importing the archiver
+yaml      loading the spec
+scan      opening the mbox files and reading their table of contents
+mboxo     reading the bytes of each message, with the mboxo fix
+parse     parsing the messages with the email package (and copying them per generator)
+compute   compute_updates
+compare   hashing the results and comparing them with the spec
+other     everything else (result records, waiting for --shards workers, ...)
+
+switch(phase) charges everything since the previous switch to the phase that was
+current, so the phases add up to the whole run without nesting. It only costs a
+few clock reads, so it can be called several times per message.
+
+Everything until the first switch() is charged to startup, and so is the time before
+this module is imported: the CPU time and RSS here, and the wall time by runall.py,
+which knows when it started the script.
+With --shards, the phases of the workers are added to those of the parent, so the
+wall times can add up to more than the elapsed time.
+
+The RSS growth of a phase is how much it raised the peak RSS, so it is only an
+indication of where the memory goes. On Linux the peak RSS also starts out as that
+of the parent process (runall.py), so the total peak is read from /proc instead.
+"""
+
+import os
+import sys
+import time
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+PHASES = ('startup', 'yaml', 'scan', 'mboxo', 'parse', 'compute', 'compare', 'other')
+
+
+def _maxrss(who=None):
+    """Peak RSS in bytes"""
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF if who is None else who).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _peak():
+    """Peak RSS of this process in bytes, not counting what was inherited through exec"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return _maxrss()
+
+
+_started = time.perf_counter()
+totals = dict((phase, [0.0, 0.0, 0]) for phase in PHASES) # phase: [wall, cpu, rss growth]
+_current = 'startup' # until the script switches to its first phase
+_last = (_started, time.process_time(), _maxrss())
+totals['startup'][1:] = [_last[1], _peak()]
+
+
+def switch(phase):
+    """Ends the current phase and starts the given one; returns the phase that was current"""
+    global _current, _last
+    now = (time.perf_counter(), time.process_time(), _maxrss())
+    total = totals[_current]
+    total[0] += now[0] - _last[0]
+    total[1] += now[1] - _last[1]
+    total[2] += now[2] - _last[2]
+    previous = _current
+    _current = phase
+    _last = now
+    return previous
+
+
+def snapshot():
+    """Returns a copy of the totals so far, e.g. to work out what a --shards task used"""
+    switch(_current)
+    return dict((phase, list(total)) for phase, total in totals.items())
+
+
+def since(before):
+    """Returns the totals used since the given snapshot"""
+    after = snapshot()
+    return dict((phase, [a - b for a, b in zip(after[phase], before[phase])]) for phase in PHASES)
+
+
+def add(used):
+    """Adds totals used elsewhere, e.g. in a --shards worker"""
+    for phase, values in used.items():
+        totals[phase] = [a + b for a, b in zip(totals[phase], values)]
+
+
+def report():
+    """Returns the totals for the result stream"""
+    switch(_current)
+    times = os.times()
+    return {
+        'elapsed': round(time.perf_counter() - _started, 6),
+        'cpu': round(times[0] + times[1] + times[2] + times[3], 6),
+        'maxrss': max(_peak(), _maxrss(resource.RUSAGE_CHILDREN) if resource else 0),
+        'phases': dict((phase, {'wall': round(wall, 6), 'cpu': round(cpu, 6), 'rss': rss})
+                       for phase, (wall, cpu, rss) in totals.items()),
+    }
+
+
+def format_size(size):
+    """Formats a size in bytes for the summaries, e.g. 1.5MB"""
+    for unit, shift in (('GB', 30), ('MB', 20), ('KB', 10)):
+        if size >= 1 << shift:
+            return "%.1f%s" % (size / (1 << shift), unit)
+    return "%uB" % size
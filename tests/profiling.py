@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Optional cProfile support for the test scripts (--profile DIR).
+
+Profiles are kept per section, i.e. per corpus file and generator (or
+'parsing', or 'harness' for the work shared by the generators), and written
+to DIR as <spec>-<corpus>-<section>.pstats at the end of the run.
+Sections may be nested; the outer profile is paused while the inner one runs.
+With --shards, each worker profiles the ranges it runs and sends the stats to the
+parent (see take() and add()), which merges them with its own.
+
+The report splits the time of each profile into the archiver (everything
+under interfacer.Archiver.compute_updates) and the harness (mbox scanning,
+mboxo filtering, yaml, hashing etc.), and lists the hottest functions,
+tagged by where they live.
+"""
+
+import contextlib
+import cProfile
+import os
+import pstats
+import sys
+
+HARNESS_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+class Profiler(object):
+    def __init__(self, outdir, spec, rootdir, top=15):
+        self.outdir = outdir
+        self.spec = os.path.splitext(os.path.basename(spec))[0] if spec else 'spec'
+        self.rootdir = os.path.realpath(rootdir)
+        self.top = top
+        self.profiles = {}
+        self.taken = {} # (mboxfile, name): [_Taken, ...] from the --shards workers
+        self.active = None
+
+    def section(self, mboxfile, name):
+        """Context manager which profiles its body as part of the given section"""
+        if not self.outdir:
+            return contextlib.nullcontext()
+        return self._section(mboxfile, name)
+
+    @contextlib.contextmanager
+    def _section(self, mboxfile, name):
+        profile = self.profiles.setdefault((mboxfile, name), cProfile.Profile())
+        outer = self.active
+        if outer:
+            outer.disable()
+        self.active = profile
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.active = outer
+            if outer:
+                outer.enable()
+
+    def take(self):
+        """Returns the stats of the profiles so far, which are then started afresh"""
+        taken = {}
+        for key, profile in self.profiles.items():
+            profile.create_stats()
+            taken[key] = profile.stats
+        self.profiles = {}
+        return taken
+
+    def add(self, taken):
+        """Adds the stats returned by take() in another process, to be merged in the report"""
+        for key, stats in taken.items():
+            self.taken.setdefault(key, []).append(_Taken(stats))
+
+    def _origin(self, filename):
+        filename = os.path.realpath(filename) if os.path.isabs(filename) else filename
+        if filename.startswith(self.rootdir + os.sep):
+            return 'archiver'
+        if filename.startswith(HARNESS_DIR + os.sep):
+            return 'harness'
+        return 'stdlib'
+
+    def report(self):
+        """Writes the pstats files and prints the hot functions of each profile"""
+        if not self.outdir:
+            return
+        os.makedirs(self.outdir, exist_ok=True)
+        keys = list(self.profiles) + [key for key in self.taken if key not in self.profiles]
+        for mboxfile, name in keys:
+            sources = [self.profiles[(mboxfile, name)]] if (mboxfile, name) in self.profiles else []
+            merged = pstats.Stats(*(sources + self.taken.get((mboxfile, name), [])))
+            parts = [self.spec]
+            if mboxfile:
+                parts.append(os.path.splitext(os.path.basename(mboxfile))[0])
+            parts.append(name)
+            filename = os.path.join(self.outdir, "%s.pstats" % '-'.join(parts))
+            merged.dump_stats(filename)
+            stats = merged.stats # {(file, line, func): (cc, nc, tt, ct, callers)}
+            total = sum(tt for _, _, tt, _, _ in stats.values())
+            archiver = sum(ct for (file, _, func), (_, _, _, ct, _) in stats.items()
+                           if func == 'compute_updates' and os.path.basename(file) == 'interfacer.py')
+            sys.stderr.write("[PROFILE] %s %s: %.3fs total, %.3fs in archiver, %.3fs in harness; written to %s\n" %
+                             (mboxfile or self.spec, name, total, archiver, total - archiver, filename))
+            hot = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:self.top]
+            for (file, line, func), (_, ncalls, tt, ct, _) in hot:
+                sys.stderr.write("    %8.3fs %8.3fs %8u  %-8s %s:%u(%s)\n" %
+                                 (tt, ct, ncalls, self._origin(file), os.path.basename(file), line, func))
+
+
+class _Taken(object):
+    """Stats from take(), in the form pstats.Stats loads from a profile"""
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
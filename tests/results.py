@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Machine-readable result stream for the test scripts.
+
+Each test writes one JSON record per line, e.g.:
+
+{"spec": "yaml/x.yaml", "corpus": "corpus/x.mbox", "index": 0, "generator": "full",
+ "message-id": "<...>", "status": "pass", "time": 0.0012}
+
+status is one of pass, fail, skip or seq (message-id mismatch).
+time is the time taken by compute_updates, in seconds (or by the test itself,
+for tests which do not get as far as calling it). perf tests are per corpus file and
+generator, so their index and message-id are null and time is that of the whole corpus.
+The final record has "status": "done" and the same counts as the [DONE] line,
+along with the time, CPU and memory used by phase (see phases.py).
+test-bycorpus.py runs several specs, so its records carry their own spec, and
+each spec and test type has a 'done' record with its counts and "type" before the
+final one (which has a null spec).
+"""
+
+import json
+import phases
+
+
+class ResultWriter(object):
+    def __init__(self, filename, spec):
+        self.spec = spec
+        self.fh = open(filename, 'w', encoding='utf-8') if filename else None
+
+    def _write(self, record):
+        if self.fh:
+            self.fh.write(json.dumps(record) + "\n")
+
+    def record(self, corpus, index, generator, msgid, status, elapsed, spec=None):
+        self._write({
+            'spec': spec or self.spec,
+            'corpus': corpus,
+            'index': index,
+            'generator': generator,
+            'message-id': msgid,
+            'status': status,
+            'time': round(elapsed, 6),
+        })
+
+    def spec_done(self, spec, test_type, tests_run, failed, skipped=0):
+        """Writes the counts of one of the specs of a test-bycorpus.py run"""
+        self._write({
+            'spec': spec,
+            'type': test_type,
+            'status': 'done',
+            'run': tests_run,
+            'failed': failed,
+            'skipped': skipped,
+        })
+
+    def done(self, tests_run, failed, skipped=0):
+        record = {
+            'spec': self.spec,
+            'status': 'done',
+            'run': tests_run,
+            'failed': failed,
+            'skipped': skipped,
+        }
+        record.update(phases.report())
+        self._write(record)
+        if self.fh:
+            self.fh.close()
+            self.fh = None
+
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Orders the jobs (spec file and test type) of runall.py by how long they took before.
+
+History keeps the duration of each job in a JSON file in the cache directory
+(see corpus.py), averaged with the previous duration so that a single slow run
+does not upset the order. Jobs without a history count as the longest ones, as
+they are usually new or large specs.
+
+With concurrent jobs, running the longest ones first keeps a slow spec from
+starting last and stretching the run. With --fof the fastest known ones run first
+instead, so that failures show up as soon as possible.
+
+Eta predicts the time left while a run is in progress, from the history scaled
+by how fast the jobs finished so far actually were compared to their history.
+"""
+
+import json
+import os
+import time
+import corpus
+
+HISTORY_FILE = corpus.cache_path('history', 'durations.json')
+
+
+class History(object):
+    def __init__(self, filename=HISTORY_FILE):
+        self.filename = filename
+        try:
+            with open(filename, 'r') as f:
+                self.durations = json.load(f)
+        except (OSError, ValueError):
+            self.durations = {}
+
+    @staticmethod
+    def key(spec_file, test_type):
+        return "%s %s" % (os.path.normpath(spec_file), test_type)
+
+    def get(self, spec_file, test_type):
+        """Returns the expected duration of a job in seconds, or None if it has not run before"""
+        return self.durations.get(self.key(spec_file, test_type))
+
+    def update(self, spec_file, test_type, seconds):
+        key = self.key(spec_file, test_type)
+        previous = self.durations.get(key)
+        self.durations[key] = round(seconds if previous is None else (previous + seconds) / 2, 3)
+
+    def save(self):
+        corpus.write_cache(self.filename, json.dumps(self.durations, indent=1, sort_keys=True))
+
+
+def order(jobs, predictions, fastest_first=False):
+    """
+    Returns the indexes of the jobs in the order to run them: longest first,
+    or fastest first if fastest_first is set. Jobs without a prediction
+    (None) come first, or last if fastest_first is set.
+    """
+    unknown = float('inf')
+    if fastest_first:
+        return sorted(range(len(jobs)), key=lambda i: unknown if predictions[i] is None else predictions[i])
+    return sorted(range(len(jobs)), key=lambda i: -(unknown if predictions[i] is None else predictions[i]))
+
+
+class Eta(object):
+    def __init__(self, predictions, workers):
+        self.predictions = predictions
+        self.workers = max(1, workers)
+        self.started = {}
+        self.finished = {}
+
+    def start(self, i):
+        self.started[i] = time.time()
+
+    def finish(self, i, seconds):
+        self.started.pop(i, None)
+        self.finished[i] = seconds
+
+    def remaining(self):
+        """Returns the predicted number of seconds until all jobs are done, or None if there is nothing to go by"""
+        known = [(self.predictions[i], seconds) for i, seconds in self.finished.items() if self.predictions[i] is not None]
+        known_predicted = sum(predicted for predicted, _ in known)
+        ratio = sum(seconds for _, seconds in known) / known_predicted if known_predicted else 1.0
+        history = [predicted for predicted in self.predictions if predicted is not None]
+        if history:
+            default = sum(history) / len(history)
+        elif self.finished:
+            default = sum(self.finished.values()) / len(self.finished)
+        else:
+            return None
+        now = time.time()
+        work = longest = 0.0
+        for i, predicted in enumerate(self.predictions):
+            if i in self.finished:
+                continue
+            left = (default if predicted is None else predicted) * ratio
+            if i in self.started:
+                left = max(0.0, left - (now - self.started[i]))
+            work += left
+            longest = max(longest, left)
+        return max(work / self.workers, longest)
+
+    def report(self):
+        """Returns a progress line for stderr"""
+        remaining = self.remaining()
+        line = "Progress: %u/%u test scripts done" % (len(self.finished), len(self.predictions))
+        if remaining is not None and len(self.finished) < len(self.predictions):
+            line += ", about %u:%02u left" % divmod(int(remaining + 0.5), 60)
+        return line + "\n"
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Splits the tests of a spec into ranges of messages and runs them in a process pool (--shards N).
+
+Each worker process calls the initializer once (e.g. to import the archiver and
+create the interfacer.Archiver instances) and then runs whole ranges, opening the
+mbox files it needs itself. The results of the ranges are returned in order,
+so they can be merged as if the tests had run serially. The output printed
+while running a range is captured and printed by the parent with its result,
+so that lines from different workers do not get mixed up, and the same goes
+for the time etc. used by each phase (see phases.py). For the archiver's log
+output to be captured too, it must go through a StderrHandler.
+"""
+
+import io
+import logging
+import multiprocessing
+import sys
+import phases
+
+# Ranges per worker; more than one so that a slow range does not hold up the others
+RANGES_PER_SHARD = 4
+
+
+class StderrHandler(logging.StreamHandler):
+    """logging handler which writes to sys.stderr as it is when a record is logged, rather than when the handler was made"""
+
+    def __init__(self):
+        super().__init__(sys.stderr)
+
+    @property
+    def stream(self):
+        return sys.stderr
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+def log_to_stderr(logger):
+    """Adds a StderrHandler to the logger, unless it has one already (e.g. inherited by a forked worker)"""
+    if not any(isinstance(handler, StderrHandler) for handler in logger.handlers):
+        logger.addHandler(StderrHandler())
+
+
+def split(items, shards):
+    """Splits a list into contiguous ranges for the given number of shards"""
+    items = list(items)
+    count = max(1, min(len(items), shards * RANGES_PER_SHARD))
+    size = -(-len(items) // count) if items else 1
+    return [items[n:n + size] for n in range(0, len(items), size)]
+
+
+def _context():
+    # fork keeps the state of the parent (sys.path, the MOCK_GMTIME patch, imported modules)
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+
+def run(shards, initializer, initargs, func, tasks):
+    """Runs func(*task) for each task in a pool of worker processes; yields the results in order"""
+    with _context().Pool(shards, initializer, initargs) as pool:
+        for result, out, err, used in pool.imap(_call, [(func, task) for task in tasks]):
+            sys.stdout.write(out)
+            sys.stderr.write(err)
+            phases.add(used)
+            yield result
+
+
+def _call(func_task):
+    func, task = func_task
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = io.StringIO(), io.StringIO()
+    before = phases.snapshot()
+    try:
+        result = func(*task)
+        return result, sys.stdout.getvalue(), sys.stderr.getvalue(), phases.since(before)
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
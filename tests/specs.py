@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Loads yaml test specifications.
+
+Parsing a large spec with the pure Python yaml loader takes a noticeable part of a
+test run, so load_spec() keeps a compiled copy of each spec in the cache directory
+(see corpus.py), keyed by the SHA-256 of the yaml file, and loads that instead.
+
+In the compiled copy each list of test entries is held as a TestList, which stores
+the entries by column (index array, message-id list, ...) rather than as one dict
+per entry. Iterating over a TestList yields a fresh dict per entry, so changes to
+those dicts are not kept; use compiled=False to get plain yaml data that can be
+edited and written back (e.g. for --dropin).
+
+SpecWriter writes a spec a test entry at a time, for --generate on large corpora.
+"""
+
+import array
+import collections
+import hashlib
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+import yaml
+
+import corpus
+
+SPEC_VERSION = 1
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+class TestList(object):
+    def __init__(self, tests):
+        fields = []
+        for test in tests:
+            for field in test:
+                if field not in fields:
+                    fields.append(field)
+        # Fields in every entry are stored as columns, the others sparsely by position
+        self.columns = {}
+        self.sparse = {}
+        for field in fields:
+            if all(field in test for test in tests):
+                self.columns[field] = [test[field] for test in tests]
+            else:
+                self.sparse[field] = dict((n, test[field]) for n, test in enumerate(tests) if field in test)
+        if 'index' in self.columns:
+            self.columns['index'] = array.array('q', self.columns['index'])
+        self.length = len(tests)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += self.length
+        if not 0 <= n < self.length:
+            raise IndexError('TestList index out of range')
+        test = dict((field, column[n]) for field, column in self.columns.items())
+        for field, values in self.sparse.items():
+            if n in values:
+                test[field] = values[n]
+        return test
+
+    def __iter__(self):
+        for n in range(self.length):
+            yield self[n]
+
+
+def _compile(data):
+    """Replaces the lists of test entries in the spec with TestLists"""
+    if isinstance(data, dict):
+        return dict((key, _compile(value)) for key, value in data.items())
+    if isinstance(data, list) and data and all(isinstance(x, dict) and 'index' in x for x in data):
+        return TestList(data)
+    return data
+
+
+def load_spec(filename, compiled=True):
+    """Loads a yaml spec, from the compiled cache if possible"""
+    with open(filename, 'rb') as f:
+        text = f.read()
+    if not compiled:
+        return yaml.load(text, Loader=Loader)
+    path = corpus.cache_path('specs', "%s-%u.pickle" % (hashlib.sha256(text).hexdigest(), SPEC_VERSION))
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        pass
+    spec = _compile(yaml.load(text, Loader=Loader))
+    corpus.write_cache(path, pickle.dumps(spec, pickle.HIGHEST_PROTOCOL), 'wb')
+    return spec
+
+
+def spec_runs(yml, test_type, generator_names=None):
+    """
+    Yields (mboxfile, generator name, [test, ...]) for the corpus files of a spec.
+    The generator name is None for parsing tests. Generators which are not in
+    generator_names (if given) are skipped with a warning.
+    """
+    mboxfiles = []
+    for file, run in yml[test_type].items():
+        mboxfiles.append(file)
+        if not run: # No tests under this filename, run same tests as next
+            continue
+        if test_type == 'parsing':
+            runs = [(None, run)]
+        else:
+            runs = []
+            for gen_type, tests in run.items():
+                if generator_names is not None and gen_type not in generator_names:
+                    sys.stderr.write("Warning: the '%s' generator is not available, skipping tests\n" % gen_type)
+                    continue
+                runs.append((gen_type, tests))
+        for mboxfile in mboxfiles:
+            for gen_type, tests in runs:
+                yield mboxfile, gen_type, tests
+        mboxfiles = []
+
+
+def _dump(path, value):
+    """yaml.dump of value nested under the keys of path, i.e. {path[0]: {path[1]: ... value}}"""
+    for key in reversed(path):
+        value = {key: value}
+    return yaml.dump(value, sort_keys=False)
+
+
+class SpecWriter(object):
+    """
+    Writes a spec file a test entry at a time, in the same layout as yaml.dump(spec, sort_keys=False).
+    The entries are lists under a path of keys, e.g. ('parsing', mboxfile) or
+    ('generators', mboxfile, gen_type). The list started first is written to the
+    file as its entries are added; entries for other lists are kept in temporary
+    files until flush() (e.g. at the end of each mbox file), to keep the order of the keys.
+    """
+
+    def __init__(self, filename, args):
+        self._file = open(filename, 'w')
+        self._file.write(_dump(['args'], args))
+        self._keys = [] # key path of the last list written to the file
+        self._direct = None # [path, entries] of the list written to the file as it goes
+        self._spools = collections.OrderedDict() # path: [temporary file, entries]
+
+    def _write_keys(self, path, empty):
+        """Writes the keys of path which differ from those of the last list written"""
+        lines = _dump(path, [] if empty else [None]).splitlines(True)[:len(path)]
+        common = 0
+        while common < min(len(path) - 1, len(self._keys)) and path[common] == self._keys[common]:
+            common += 1
+        self._file.write(''.join(lines[common:]))
+        self._keys = list(path)
+
+    def start(self, path):
+        """Starts a list of entries; an empty list is written as []"""
+        path = tuple(path)
+        if self._direct is None and not self._spools:
+            self._direct = [path, 0]
+        elif path not in self._spools and path != self._direct[0]:
+            self._spools[path] = [tempfile.TemporaryFile('w+'), 0]
+
+    def add(self, path, entry):
+        path = tuple(path)
+        self.start(path)
+        text = ''.join(_dump(path, [entry]).splitlines(True)[len(path):])
+        if self._direct and self._direct[0] == path:
+            if not self._direct[1]:
+                self._write_keys(path, False)
+            self._file.write(text)
+            self._direct[1] += 1
+        else:
+            self._spools[path][0].write(text)
+            self._spools[path][1] += 1
+
+    def flush(self):
+        """Finishes the current lists"""
+        if self._direct:
+            if not self._direct[1]:
+                self._write_keys(self._direct[0], True)
+            self._direct = None
+        for path, (f, entries) in self._spools.items():
+            self._write_keys(path, not entries)
+            f.seek(0)
+            shutil.copyfileobj(f, self._file)
+            f.close()
+        self._spools.clear()
+        self._file.flush()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+class Progress(object):
+    """Reports the progress of spec generation on stderr every few seconds"""
+
+    def __init__(self, name, total, interval=10):
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.started = self.reported = time.time()
+
+    def update(self, count=1):
+        self.done += count
+        now = time.time()
+        if now - self.reported >= self.interval or self.done == self.total:
+            self.reported = now
+            rate = self.done / (now - self.started) if now > self.started else 0.0
+            sys.stderr.write("%s: %u/%u messages (%.0f%%), %.1f messages/sec\n" %
+                             (self.name, self.done, self.total, self.done * 100.0 / self.total if self.total else 100.0, rate))
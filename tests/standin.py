@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+A local stand-in for the Elasticsearch APIs used when archiving (see test-ingest.py).
+
+It keeps the documents written with the index, create, update and bulk APIs in
+memory, answers searches with no hits, and counts the requests and the size of
+the bulk requests. That is enough for the archiver to store a corpus through its
+real path (archive_message, the Elasticsearch client, HTTP and JSON) without an
+Elasticsearch cluster, and for the documents to be checked afterwards.
+
+The server runs in a child process where possible, so that it does not compete
+with the archiver for the GIL, and has a few endpoints of its own:
+GET /_standin/stats, GET /_standin/documents?kind=mbox and POST /_standin/reset.
+
+redirect(url) makes every Elasticsearch client created afterwards connect to the
+stand-in, whatever the archiver configuration says. It must be called before the
+archiver is imported, as some versions create their client at import time.
+
+It can also be run on its own, e.g. to point a Pony Mail installation at it by
+hand: tests/standin.py --port 9200
+"""
+
+import argparse
+import http.server
+import json
+import multiprocessing
+import sys
+import threading
+import urllib.parse
+import urllib.request
+import uuid
+
+DEFAULT_VERSION = '7.10.2'
+
+
+class Store(object):
+    """The indexes, documents and request counts of the stand-in"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.indexes = {} # index: {id: (type, source)}
+        self.requests = {}
+        self.received = 0
+        self.writes = 0
+        self.bulk = [] # [bytes, actions] per bulk request
+
+    def count(self, kind, size):
+        self.requests[kind] = self.requests.get(kind, 0) + 1
+        self.received += size
+
+    def write(self, index, doc_type, doc_id, source, update=False):
+        docs = self.indexes.setdefault(index, {})
+        doc_id = doc_id or uuid.uuid4().hex
+        result = 'updated' if doc_id in docs else 'created'
+        if update:
+            if doc_id in docs:
+                merged = dict(docs[doc_id][1])
+                merged.update(source.get('doc') or {})
+                source = merged
+            elif source.get('doc_as_upsert'):
+                source = source.get('doc') or {}
+            elif 'upsert' in source:
+                source = source['upsert']
+            else:
+                return doc_id, 'not_found'
+        docs[doc_id] = (doc_type or docs.get(doc_id, ('_doc',))[0], source)
+        self.writes += 1
+        return doc_id, result
+
+    def documents(self, kind):
+        """Returns {id: source} of the documents whose index or type is kind, or whose index ends with -kind"""
+        found = {}
+        for index, docs in self.indexes.items():
+            for doc_id, (doc_type, source) in docs.items():
+                if kind in (index, doc_type) or index.endswith('-' + kind):
+                    found[doc_id] = source
+        return found
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'received': self.received,
+            'writes': self.writes,
+            'bulk': self.bulk,
+            'documents': sum(len(docs) for docs in self.indexes.values()),
+        }
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, as with a real cluster
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass
+
+    def _reply(self, status, body=None):
+        data = b'' if body is None else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('X-Elastic-Product', 'Elasticsearch') # checked by newer clients
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def do_HEAD(self):
+        self._handle()
+
+    def do_GET(self):
+        self._handle()
+
+    def do_PUT(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def do_DELETE(self):
+        self._handle()
+
+    def _handle(self):
+        url = urllib.parse.urlsplit(self.path)
+        parts = [urllib.parse.unquote(part) for part in url.path.split('/') if part]
+        data = self._body()
+        store = self.server.store
+        with self.server.lock:
+            if parts[:1] == ['_standin']:
+                return self._standin(parts[1:], urllib.parse.parse_qs(url.query))
+            endpoints = [part for part in parts if part.startswith('_')]
+            kind = endpoints[-1][1:] if endpoints else ('info' if not parts else 'document')
+            if kind == 'doc':
+                kind = 'document'
+            if kind in ('document', 'create') and self.command in ('PUT', 'POST'):
+                kind = 'index'
+            store.count(kind, len(data))
+            if kind == 'bulk':
+                return self._bulk(parts, data)
+            if not parts:
+                return self._reply(200, {
+                    'name': 'standin', 'cluster_name': 'standin', 'tagline': 'You Know, for Search',
+                    'version': {'number': self.server.version, 'build_flavor': 'default'},
+                })
+            index = parts[0]
+            if kind in ('search', 'count'):
+                return self._reply(200, {'took': 0, 'timed_out': False, 'count': 0,
+                                         'hits': {'total': {'value': 0, 'relation': 'eq'}, 'max_score': None, 'hits': []}})
+            if kind == 'mget':
+                request = json.loads(data or b'{}')
+                docs = [(index, doc_id) for doc_id in request.get('ids', [])] + \
+                    [(doc.get('_index', index), doc.get('_id')) for doc in request.get('docs', [])]
+                return self._reply(200, {'docs': [self._document(doc_index, None, doc_id) for doc_index, doc_id in docs]})
+            if kind in ('index', 'update'):
+                doc_type, doc_id = self._type_id(parts)
+                doc_id, result = store.write(index, doc_type, doc_id, json.loads(data or b'{}'), kind == 'update')
+                if result == 'not_found':
+                    return self._reply(404, {'error': {'type': 'document_missing_exception'}, 'status': 404})
+                return self._reply(201 if result == 'created' else 200, {
+                    '_index': index, '_type': doc_type or '_doc', '_id': doc_id, '_version': 1, 'result': result,
+                    '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+                })
+            if kind == 'document' and len(parts) > 1:
+                doc_type, doc_id = self._type_id(parts)
+                if self.command == 'DELETE':
+                    found = store.indexes.get(index, {}).pop(doc_id, None) is not None
+                    return self._reply(200 if found else 404, {'_index': index, '_id': doc_id,
+                                                               'result': 'deleted' if found else 'not_found'})
+                document = self._document(index, doc_type, doc_id)
+                return self._reply(200 if document['found'] else 404, document)
+            # creating or checking an index, mappings, refresh, cluster health etc.
+            if self.command in ('GET', 'HEAD') and kind == 'document':
+                return self._reply(200, {index: {'aliases': {}, 'mappings': {}, 'settings': {}}})
+            return self._reply(200, {'acknowledged': True, 'status': 'green'})
+
+    @staticmethod
+    def _type_id(parts):
+        """Returns the type and ID from /index/type/id, /index/_doc/id, /index/_create/id or /index/type/id/_update"""
+        rest = [part for part in parts[1:] if part not in ('_update', '_create', '_doc')]
+        if len(rest) >= 2:
+            return rest[0], rest[1]
+        return None, rest[0] if rest else None
+
+    def _document(self, index, doc_type, doc_id):
+        doc = self.server.store.indexes.get(index, {}).get(doc_id)
+        if doc is None:
+            return {'_index': index, '_id': doc_id, 'found': False}
+        return {'_index': index, '_type': doc_type or doc[0], '_id': doc_id, '_version': 1, 'found': True, '_source': doc[1]}
+
+    def _bulk(self, parts, data):
+        store = self.server.store
+        lines = [line for line in data.split(b'\n') if line.strip()]
+        items = []
+        i = 0
+        while i < len(lines):
+            (action, meta), = json.loads(lines[i]).items()
+            i += 1
+            index = meta.get('_index') or (parts[0] if parts[0] != '_bulk' else None)
+            doc_type = meta.get('_type') or (parts[1] if len(parts) > 2 else None)
+            doc_id = meta.get('_id')
+            if action == 'delete':
+                found = store.indexes.get(index, {}).pop(doc_id, None) is not None
+                items.append({action: {'_index': index, '_id': doc_id, 'status': 200 if found else 404}})
+                continue
+            source = json.loads(lines[i])
+            i += 1
+            doc_id, result = store.write(index, doc_type, doc_id, source, action == 'update')
+            status = {'created': 201, 'updated': 200}.get(result, 404)
+            items.append({action: {'_index': index, '_type': doc_type or '_doc', '_id': doc_id, 'status': status, 'result': result}})
+        store.bulk.append([len(data), len(items)])
+        return self._reply(200, {'took': 0, 'errors': any(item[action]['status'] >= 400 for item in items for action in item),
+                                 'items': items})
+
+    def _standin(self, parts, query):
+        store = self.server.store
+        if parts == ['stats']:
+            return self._reply(200, store.stats())
+        if parts == ['documents']:
+            return self._reply(200, store.documents(query.get('kind', ['mbox'])[0]))
+        if parts == ['reset'] and self.command == 'POST':
+            store.reset()
+            return self._reply(200, {'acknowledged': True})
+        return self._reply(404, {'error': 'unknown stand-in endpoint'})
+
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, version=DEFAULT_VERSION):
+        super().__init__(address, Handler)
+        self.version = version
+        self.store = Store()
+        self.lock = threading.Lock()
+
+
+class StandIn(object):
+    """Runs the stand-in on a free local port, in a child process if possible"""
+
+    def __init__(self, version=DEFAULT_VERSION, port=0):
+        self.server = Server(('127.0.0.1', port), version)
+        self.url = 'http://127.0.0.1:%u' % self.server.server_address[1]
+        self.process = None
+        self.thread = None
+
+    def start(self):
+        if 'fork' in multiprocessing.get_all_start_methods():
+            self.process = multiprocessing.get_context('fork').Process(target=self.server.serve_forever, daemon=True)
+            self.process.start()
+            self.server.socket.close() # the child has its own copy
+        else:
+            self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        if self.process:
+            self.process.terminate()
+            self.process.join()
+        elif self.thread:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def _call(self, path, method='GET'):
+        request = urllib.request.Request(self.url + path, method=method, data=b'' if method == 'POST' else None)
+        with urllib.request.urlopen(request) as f:
+            return json.load(f)
+
+    def stats(self):
+        return self._call('/_standin/stats')
+
+    def documents(self, kind='mbox'):
+        return self._call('/_standin/documents?kind=%s' % urllib.parse.quote(kind))
+
+    def reset(self):
+        self._call('/_standin/reset', 'POST')
+
+
+def redirect(url):
+    """Makes Elasticsearch clients connect to url instead of the configured cluster"""
+    import elasticsearch
+    for name in ('Elasticsearch', 'AsyncElasticsearch'):
+        cls = getattr(elasticsearch, name, None)
+        if cls is None or getattr(cls, '_standin', None):
+            continue
+        def __init__(self, hosts=None, *args, _init=cls.__init__, **kwargs): # pylint: disable=keyword-arg-before-vararg,unused-argument
+            for option in ('http_auth', 'basic_auth', 'api_key', 'use_ssl', 'verify_certs', 'ssl_context',
+                           'ca_certs', 'client_cert', 'client_key', 'scheme', 'port', 'url_prefix', 'cloud_id'):
+                kwargs.pop(option, None)
+            _init(self, [url], *args, **kwargs)
+        cls.__init__ = __init__
+        cls._standin = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Command line options.')
+    parser.add_argument('--port', dest='port', type=int, default=9200,
+                        help="Port to listen on (default 9200)")
+    parser.add_argument('--version', dest='version', type=str, default=DEFAULT_VERSION,
+                        help="Elasticsearch version to report (default %s)" % DEFAULT_VERSION)
+    args = parser.parse_args()
+    server = Server(('127.0.0.1', args.port), args.version)
+    sys.stderr.write("Elasticsearch stand-in listening on http://127.0.0.1:%u/\n" % args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
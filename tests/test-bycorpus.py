@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""
+This runs the parsing and generators tests of several specs by corpus file
+(runall.py --bycorpus), for specs which use the same mbox files, such as the
+par-* and gen-* specs of the maven-dev-2017-11 corpus.
+
+The expectations of all the specs are grouped by corpus file, and each corpus
+file is opened, and each of its messages read and parsed, once. The tests of
+every spec for a message are checked against their own copy of the parsed
+message (see corpus.copy_message), as test-generators.py does for its generators.
+The checks are the same as those of test-parsing.py and test-generators.py.
+
+The results are still reported per spec and test type: the output of each is
+printed in one piece at the end, with its slowest messages and a [DONE] line,
+and each result record has the spec it belongs to. A 'done' record with the
+counts of each spec and test type (and its "type") comes before the final 'done'
+record of the run. MOCK_GMTIME and MOCK_AAT are applied per spec from its args env
+(MOCK_GMTIME also from the environment, as in test-generators.py); the rest of the
+args env must be the same for all the specs, and runall.py only groups specs for which it is.
+"""
+import sys
+import os
+import argparse
+import collections
+import hashlib
+import time
+import phases
+import mock
+import interfacer
+import corpus
+import specs
+import watchdog
+from results import ResultWriter
+
+fake_args = collections.namedtuple('fakeargs', ['verbose', 'ibody'])(False, None)
+TEST_TYPES = ('parsing', 'generators')
+
+
+class SpecRun(object):
+    """The tests of one spec and test type, with their output and results"""
+
+    def __init__(self, spec_file, test_type, yml, slowest):
+        self.spec_file = spec_file
+        self.test_type = test_type
+        yml_args = yml.get('args', {})
+        self.parse_html = yml_args.get('parse_html', False)
+        self.env = yml_args.get('env') or {}
+        self.tests_run = 0
+        self.errors = 0
+        self.skipped = 0
+        self.output = [] # (stream, line), printed together at the end
+        self.records = []
+        self.slowest = watchdog.Slowest(slowest)
+
+    def write(self, stream, line):
+        self.output.append((stream, line))
+
+    def record(self, *record):
+        self.records.append(record)
+        self.slowest.add(*record)
+
+    def report(self):
+        sys.stderr.write("Results of '%s' tests from %s:\n" % (self.test_type, self.spec_file))
+        for stream, line in self.output:
+            stream.write(line)
+        sys.stdout.flush()
+        self.slowest.report()
+        print("[DONE] %s (%s): %u tests run, %u failed. Skipped %u." %
+              (self.spec_file, self.test_type, self.tests_run, self.errors, self.skipped))
+        sys.stdout.flush()
+
+
+def plan(args, generator_names):
+    """
+    Returns the SpecRuns of the specs, and the expectations grouped by corpus file:
+    {corpus path: (mboxfile, [(SpecRun, generator name, tests), ...])}, in the order the corpus files first appear.
+    """
+    runs = []
+    by_corpus = collections.OrderedDict()
+    for spec_file in args.load:
+        phases.switch('yaml')
+        yml = specs.load_spec(spec_file)
+        phases.switch('other')
+        for test_type in TEST_TYPES:
+            if test_type not in yml or (args.ttype and test_type not in args.ttype):
+                continue
+            run = SpecRun(spec_file, test_type, yml, args.slowest)
+            runs.append(run)
+            for mboxfile, gen_type, tests in specs.spec_runs(yml, test_type, generator_names):
+                path = os.path.realpath(corpus.resolve_path(mboxfile))
+                by_corpus.setdefault(path, (mboxfile, []))[1].append((run, gen_type, tests))
+    return runs, by_corpus
+
+
+def check_parsing(state, run, mboxfile, key, message, message_raw, test):
+    """As test-parsing.py check_range, for one test"""
+    started = time.time()
+    phases.switch('compare')
+    msgid = (message.get('message-id') or '').strip()
+    if msgid != test['message-id']:
+        run.write(sys.stderr, """[SEQ?] index %2u: Expected '%s', got '%s'!\n""" % (key, test['message-id'], msgid))
+        run.record(mboxfile, key, None, msgid, 'seq', time.time() - started)
+        return
+    archie = state['archie'](run.parse_html, None)
+    phases.switch('compute')
+    lid = state['archiver'].normalize_lid(message.get('list-id', '??'))
+    try:
+        json, elapsed = state['watchdog'].call(archie.compute_updates, fake_args, lid, False, message, message_raw)
+    except watchdog.MessageTimeout as e:
+        phases.switch('compare')
+        run.errors += 1
+        run.write(sys.stderr, """[FAIL] parsing index %2u: %s\n""" % (key, e))
+        run.record(mboxfile, key, None, msgid, 'fail', e.elapsed)
+        return
+    phases.switch('compare')
+    body_sha3_256 = None
+    if json and json.get('body') is not None:
+        if not json.get('html_source_only'):
+            body_sha3_256 = hashlib.sha3_256(json['body'].encode('utf-8')).hexdigest()
+    # get override for version (if any)
+    expected = test.get(archie.version, test['body_sha3_256'])
+    status = 'pass'
+    if body_sha3_256 != expected:
+        run.errors += 1
+        status = 'fail'
+        run.write(sys.stderr, """[FAIL] parsing index %2u: Expected: %s Got: %s\n""" % (key, expected, body_sha3_256))
+    att = json['attachments'] if json else []
+    att_expected = test['attachments'] or []
+    if att != att_expected:
+        run.errors += 1
+        status = 'fail'
+        run.write(sys.stderr, """[FAIL] attachments index %2u: Expected: %s Got: %s\n""" % (key, att_expected, att))
+    else:
+        run.write(sys.stdout, "[PASS] index %u\n" % key)
+    run.record(mboxfile, key, None, msgid, status, elapsed)
+
+
+def check_generator(state, run, gen_type, mboxfile, key, message, message_raw, test):
+    """As test-generators.py check_range, for one test"""
+    started = time.time()
+    mock.apply_aat(message, run.env, gen_type)
+    phases.switch('compare')
+    msgid = (message.get('message-id') or '').strip()
+    if state['args'].skipnodate and not message.get('date'):
+        run.skipped += 1
+        run.write(sys.stdout, """[SKIP] %s, index %2u: No date header found and --skipnodate specified, skipping this test!\n""" %
+                  (gen_type, key))
+        run.record(mboxfile, key, gen_type, msgid, 'skip', time.time() - started)
+        return
+    if msgid != test['message-id']:
+        run.write(sys.stderr, """[SEQ?] %s, index %2u: Expected '%s', got '%s'!\n""" % (gen_type, key, test['message-id'], msgid))
+        run.record(mboxfile, key, gen_type, msgid, 'seq', time.time() - started)
+        return
+    archie = state['archie'](False, gen_type)
+    phases.switch('compute')
+    lid = state['archiver'].normalize_lid(message.get('list-id', '??'))
+    mock.install_gmtime(bool(run.env.get('MOCK_GMTIME') or os.environ.get('MOCK_GMTIME')))
+    try:
+        json, elapsed = state['watchdog'].call(archie.compute_updates, fake_args, lid, False, message, message_raw)
+    except watchdog.MessageTimeout as e:
+        phases.switch('compare')
+        run.errors += 1
+        run.write(sys.stderr, """[FAIL] %s, index %2u: %s\n""" % (gen_type, key, e))
+        run.record(mboxfile, key, gen_type, msgid, 'fail', e.elapsed)
+        return
+    finally:
+        mock.install_gmtime(False)
+    phases.switch('compare')
+    # get override for version (if any)
+    expected = test.get(archie.version, test['generated'])
+    actual = json['mid']
+    if actual != expected:
+        run.errors += 1
+        run.write(sys.stderr, """[FAIL] %s, index %2u: Expected '%s', got '%s'!\n""" % (gen_type, key, expected, actual))
+        run.record(mboxfile, key, gen_type, msgid, 'fail', elapsed)
+    else:
+        run.write(sys.stdout, "[PASS] %s index %u\n" % (gen_type, key))
+        run.record(mboxfile, key, gen_type, msgid, 'pass', elapsed)
+
+
+def run_tests(args):
+    phases.switch('startup')
+    import archiver
+    try:
+        import generators
+    except ImportError:
+        import plugins.generators as generators
+    import logging
+    verbose_logger = logging.getLogger()
+    verbose_logger.setLevel(logging.WARN)
+    verbose_logger.addHandler(logging.StreamHandler(sys.stderr))
+    archiver.logger = verbose_logger
+    phases.switch('other')
+    generator_names = generators.generator_names() if hasattr(generators, 'generator_names') else ['full', 'medium', 'cluster', 'legacy']
+    if args.generators:
+        generator_names = args.generators
+
+    archies = {} # by parse_html and generator name (None for parsing)
+    def archie(parse_html, gen_type):
+        if (parse_html, gen_type) not in archies:
+            test_args = collections.namedtuple('testargs', ['parse_html', 'generator'])(parse_html, gen_type)
+            archies[(parse_html, gen_type)] = interfacer.Archiver(archiver, test_args)
+        return archies[(parse_html, gen_type)]
+    state = {'args': args, 'archiver': archiver, 'archie': archie, 'watchdog': watchdog.Watchdog(args.budget)}
+
+    runs, by_corpus = plan(args, generator_names)
+    for mboxfile, expectations in by_corpus.values():
+        sys.stderr.write("Starting to process %s for %s\n" % (mboxfile, ", ".join(
+            "%s (%s)" % (os.path.basename(run.spec_file), gen_type or 'parsing') for run, gen_type, _ in expectations)))
+        phases.switch('scan')
+        mbox = corpus.open_mbox(mboxfile, args.nomboxo)
+        no_messages = len(mbox.keys())
+        phases.switch('other')
+        # Parse each message once, and check the tests of all the specs against it
+        by_index = collections.OrderedDict()
+        for run, gen_type, tests in expectations:
+            no_tests = len(tests)
+            if no_messages != no_tests:
+                if gen_type is None:
+                    run.write(sys.stderr, "Warning: %s run for parsing test of %s contains %u tests, but mbox file has %u emails!\n" %
+                              ('TBA', mboxfile, no_tests, no_messages))
+                else:
+                    run.write(sys.stderr, "Warning: %s run for %s contains %u tests, but mbox file has %u emails!\n" %
+                              (gen_type, mboxfile, no_tests, no_messages))
+            run.tests_run += no_tests
+            for test in tests:
+                by_index.setdefault(test['index'], []).append((run, gen_type, test))
+        for key, checks in by_index.items():
+            phases.switch('mboxo')
+            message_raw = mbox.read(key)
+            phases.switch('parse')
+            parsed = mbox.parse(message_raw)
+            for run, gen_type, test in checks:
+                phases.switch('parse')
+                message = corpus.copy_message(parsed)
+                if gen_type is None:
+                    check_parsing(state, run, mboxfile, key, message, message_raw, test)
+                else:
+                    check_generator(state, run, gen_type, mboxfile, key, message, message_raw, test)
+        mbox.close()
+        phases.switch('other')
+
+    results = ResultWriter(args.results, None)
+    tests_run = errors = skipped = 0
+    for run in runs:
+        run.report()
+        for record in run.records:
+            results.record(*record, spec=run.spec_file)
+        results.spec_done(run.spec_file, run.test_type, run.tests_run, run.errors, run.skipped)
+        tests_run += run.tests_run
+        errors += run.errors
+        skipped += run.skipped
+    results.done(tests_run, errors, skipped)
+    # N.B. The following line is parsed by runall.py if no --results file is given
+    print("[DONE] %u tests run, %u failed. Skipped %u." % (tests_run, errors, skipped))
+    if errors:
+        sys.exit(-1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Command line options.')
+    parser.add_argument('--load', dest='load', type=str, nargs='+', required=True,
+                        help='Load and run tests from these yaml spec files')
+    parser.add_argument('--rootdir', dest='rootdir', type=str, required=True,
+                        help="Root directory of Apache Pony Mail")
+    parser.add_argument('--ttype', dest='ttype', type=str, nargs='+', choices=TEST_TYPES,
+                        help='Only run the tests of these test types')
+    parser.add_argument('--generators', dest='generators', nargs='+', type=str,
+                        help='Override the list of generator names')
+    parser.add_argument('--nomboxo', dest = 'nomboxo', action='store_true',
+                        help = 'Skip Mboxo processing')
+    parser.add_argument('--skipnodate', dest = 'skipnodate', action='store_true',
+                        help = 'Skip generator tests of emails with no Date: header')
+    parser.add_argument('--results', dest='results', type=str,
+                        help='Write a JSON record per test to this file')
+    parser.add_argument('--budget', dest='budget', type=float,
+                        help='Fail a test if compute_updates takes longer than this many seconds '
+                             '(best effort: long calls into C code, e.g. regex matching, are not interrupted)')
+    parser.add_argument('--slowest', dest='slowest', type=int, default=0,
+                        help='Number of slowest messages to list for each spec (default none)')
+    args = parser.parse_args()
+
+    tools_dir = os.path.join(args.rootdir, 'tools')
+    sys.path.append(tools_dir)
+
+    run_tests(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Checks the message cache of corpus.py, without needing a Pony Mail installation:
+records written after one which a killed process left partly written must still
+be found when the pack is scanned.
+
+Usage: tests/test-cache.py
+"""
+import sys
+import os
+import mailbox
+import pickle
+import tempfile
+import zlib
+import corpus
+
+
+def make_record(offset, message_raw):
+    """Returns the bytes MessageCache.put() appends for a message"""
+    pickled = pickle.dumps(mailbox.mboxMessage(message_raw), pickle.HIGHEST_PROTOCOL)
+    data = message_raw + pickled
+    return corpus.MESSAGE_RECORD.pack(corpus.MESSAGE_MAGIC, offset, len(message_raw), len(pickled), zlib.crc32(data)) + data
+
+
+def found(directory, records):
+    """Writes the records to a pack and returns the offsets a new MessageCache finds in it"""
+    cache = corpus.MessageCache('0' * 64, False, limit=1 << 30)
+    cache.path = os.path.join(directory, 'test.pack')
+    with open(cache.path, 'wb') as f:
+        f.write(b''.join(records))
+    offsets = sorted(offset for offset in (0, 1, 2, 3) if cache.get(offset))
+    cache.close()
+    os.unlink(cache.path)
+    return offsets
+
+
+def main():
+    short = b"Subject: short\n\nA\n"
+    long = b"Subject: long\n\n" + b"A longer body, to make the record longer than what is missing.\n" * 40
+    torn = make_record(1, long)
+    torn = torn[:len(torn) // 2]
+    cases = [
+        # name, records, offsets to be found
+        ('good records', [make_record(0, short), make_record(2, long)], [0, 2]),
+        ('torn record at the end', [make_record(0, short), torn], [0]),
+        ('torn record followed by a shorter one', [make_record(0, short), torn, make_record(2, short)], [0, 2]),
+        ('torn record followed by a longer one', [make_record(0, short), torn, make_record(2, long), make_record(3, short)], [0, 2, 3]),
+        ('torn record first', [torn, make_record(2, long), make_record(3, short)], [2, 3]),
+        ('torn header', [make_record(0, short), torn[:10], make_record(2, short)], [0, 2]),
+    ]
+    errors = 0
+    with tempfile.TemporaryDirectory() as directory:
+        for name, records, expected in cases:
+            offsets = found(directory, records)
+            if offsets != expected:
+                errors += 1
+                sys.stderr.write("[FAIL] %s: Expected offsets %s, got %s\n" % (name, expected, offsets))
+            else:
+                print("[PASS] %s" % name)
+    print("[DONE] %u tests run, %u failed." % (len(cases), errors))
+    if errors:
+        sys.exit(-1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+This is the differential test suite.
+It runs the messages of a parsing or generators spec through two Pony Mail
+installations (--rootdir and --other) side by side, and reports where they differ:
+the body SHA3-256 and attachments for parsing specs, and the generated IDs (mid)
+for each generator of generators specs. Each message is read and parsed once for both.
+
+Only the corpus files, message indexes, generators and args of the spec are used,
+not its expected values, so any spec can be used to compare e.g. 0.12 with Foal.
+"""
+import sys
+import os
+import argparse
+import collections
+import hashlib
+import time
+import phases
+import mock
+import interfacer
+import installs
+import corpus
+import specs
+from results import ResultWriter
+
+fake_args = collections.namedtuple('fakeargs', ['verbose', 'ibody'])(False, None)
+TEST_TYPES = ('parsing', 'generators')
+
+
+def compute(install, archie, message, message_raw):
+    """Returns the archiver output for a message, and a description of the error if it failed"""
+    previous = phases.switch('compute')
+    with install.activate():
+        try:
+            lid = install.archiver.normalize_lid(message.get('list-id', '??'))
+            return archie.compute_updates(fake_args, lid, False, message, message_raw), None
+        except Exception as e: # pylint: disable=broad-except
+            return None, "%s: %s" % (type(e).__name__, e)
+        finally:
+            phases.switch(previous)
+
+
+def parsing_fields(json, error):
+    if error:
+        return {'body_sha3_256': error, 'attachments': error}
+    body_sha3_256 = None
+    if json and json.get('body') is not None:
+        if not json.get('html_source_only'):
+            body_sha3_256 = hashlib.sha3_256(json['body'].encode('utf-8')).hexdigest()
+    return {'body_sha3_256': body_sha3_256, 'attachments': json['attachments'] if json else []}
+
+
+def generator_fields(json, error):
+    return {'mid': error or (json['mid'] if json else None)}
+
+
+def run_diff(args):
+    import logging
+    verbose_logger = logging.getLogger()
+    verbose_logger.setLevel(logging.WARN)
+    verbose_logger.addHandler(logging.StreamHandler(sys.stderr))
+    errors = 0
+    tests_run = 0
+    results = ResultWriter(args.results, args.load)
+    phases.switch('yaml')
+    yml = specs.load_spec(args.load)
+    yml_args = yml.get('args', {})
+    _env = yml_args.get('env') or {}
+    phases.switch('startup')
+    pair = [installs.Install(args.rootdir), installs.Install(args.other)]
+    generator_names = [name for name in pair[0].generator_names if name in pair[1].generator_names]
+    if args.generators:
+        generator_names = args.generators
+    archies = {} # by generator name (None for parsing), one per installation
+    for install in pair:
+        install.archiver.logger = verbose_logger
+        for gen_type in [None] + generator_names:
+            parse_html = yml_args.get('parse_html', False) if gen_type is None else False
+            test_args = collections.namedtuple('testargs', ['parse_html', 'generator'])(parse_html, gen_type)
+            with install.activate():
+                archies.setdefault(gen_type, []).append(interfacer.Archiver(install.archiver, test_args))
+    phases.switch('other')
+    sys.stderr.write("Comparing A = %s (%s) with B = %s (%s)\n" %
+                     (archies[None][0].version, pair[0].rootdir, archies[None][1].version, pair[1].rootdir))
+
+    for test_type in TEST_TYPES:
+        if test_type not in yml or (args.ttype and test_type != args.ttype):
+            continue
+        fields = parsing_fields if test_type == 'parsing' else generator_fields
+        by_corpus = collections.OrderedDict() # mboxfile: {index: [generator name, ...]}
+        for mboxfile, gen_type, tests in specs.spec_runs(yml, test_type, generator_names):
+            by_index = by_corpus.setdefault(mboxfile, collections.OrderedDict())
+            for test in tests:
+                by_index.setdefault(test['index'], []).append(gen_type)
+        for mboxfile, by_index in by_corpus.items():
+            sys.stderr.write("Starting to process %s\n" % mboxfile)
+            phases.switch('scan')
+            mbox = corpus.open_mbox(mboxfile, args.nomboxo)
+            for key, gen_types in by_index.items():
+                phases.switch('mboxo')
+                message_raw = mbox.read(key)
+                phases.switch('parse')
+                parsed = mbox.parse(message_raw)
+                phases.switch('compare')
+                msgid = (parsed.get('message-id') or '').strip()
+                for gen_type in gen_types:
+                    started = time.time()
+                    outputs = []
+                    for install, archie in zip(pair, archies[gen_type]):
+                        phases.switch('parse')
+                        message = corpus.copy_message(parsed)
+                        mock.apply_aat(message, _env, gen_type)
+                        phases.switch('compare')
+                        outputs.append(fields(*compute(install, archie, message, message_raw)))
+                    tests_run += 1
+                    status = 'pass'
+                    for field in outputs[0]:
+                        if outputs[0][field] != outputs[1][field]:
+                            status = 'fail'
+                            sys.stderr.write("""[DIFF] %s, index %2u: %s differs: A '%s', B '%s'\n""" %
+                                             (gen_type or test_type, key, field, outputs[0][field], outputs[1][field]))
+                    if status == 'fail':
+                        errors += 1
+                    else:
+                        print("[SAME] %s index %u" % (gen_type or test_type, key))
+                    results.record(mboxfile, key, gen_type, msgid, status, time.time() - started)
+                sys.stdout.flush()
+                sys.stderr.flush()
+            mbox.close()
+            phases.switch('other')
+    results.done(tests_run, errors)
+    # N.B. The following line is parsed by runall.py if no --results file is given
+    print("[DONE] %u tests run, %u failed." % (tests_run, errors))
+    if errors:
+        sys.exit(-1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Command line options.')
+    parser.add_argument('--load', dest='load', type=str, required=True,
+                        help='Load the corpus files and messages to compare from a yaml spec file')
+    parser.add_argument('--rootdir', dest='rootdir', type=str, required=True,
+                        help="Root directory of Apache Pony Mail (A)")
+    parser.add_argument('--other', dest='other', type=str, required=True,
+                        help="Root directory of the Apache Pony Mail installation to compare with (B)")
+    parser.add_argument('--ttype', dest='ttype', type=str, choices=TEST_TYPES,
+                        help='Only compare the tests of this type in the spec')
+    parser.add_argument('--generators', dest='generators', nargs='+', type=str,
+                        help='Override the list of generator names')
+    parser.add_argument('--nomboxo', dest = 'nomboxo', action='store_true',
+                        help = 'Skip Mboxo processing')
+    parser.add_argument('--results', dest='results', type=str,
+                        help='Write a JSON record per test to this file')
+    args = parser.parse_args()
+
+    if os.environ.get('MOCK_GMTIME'):
+        mock.install_gmtime()
+
+    run_diff(args)
+
+
+if __name__ == '__main__':
+    main()
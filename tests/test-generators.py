@@ -5,38 +5,78 @@ It tests live generated IDs against a set of predefined reference constants.
 """
 import sys
 import os
-import mailbox
 import yaml
 import argparse
 import collections
 import interfacer
+import corpus
+import specs
+import profiling
+import shards
+import watchdog
 import time
-import email.utils
+import phases
+import mock
+from results import ResultWriter
 
 parse_html = False
 nonce = None
+GENERATE_RANGE = 100 # messages per task when generating a spec with --shards
 fake_args = collections.namedtuple('fakeargs', ['verbose', 'ibody'])(False, None)
 
-# get raw message, allowing for mboxo translation
-def _raw(args, mbox, key):
-    if args.nomboxo: # No need to filter the data
-        file=mbox.get_file(key, True)
-        message_raw=file.read()
-        file.close()
-    else:
-        from mboxo_patch import MboxoReader
-        file=mbox.get_file(key, True)
-        file=MboxoReader(file)
-        message_raw=file.read()
-        file.close()
-    return message_raw
+# State of the test process, or of each worker process with --shards
+state = {}
 
-def generate_specs(args):
-    if not args.nomboxo:
-        # Temporary patch to fix Python email package limitation
-        # It must be removed when the Python package is fixed
-        from mboxo_patch import MboxoFactory
+def init_state(args, env, gen_types):
+    previous = phases.switch('startup')
     import archiver
+    import logging
+    verbose_logger = logging.getLogger()
+    verbose_logger.setLevel(logging.WARN)
+    shards.log_to_stderr(verbose_logger)
+    archiver.logger = verbose_logger
+    state['args'] = args
+    state['env'] = env
+    state['archiver'] = archiver
+    state['archies'] = {}
+    for gen_type in gen_types:
+        test_args = collections.namedtuple('testargs', ['parse_html', 'generator'])(parse_html, gen_type)
+        state['archies'][gen_type] = interfacer.Archiver(archiver, test_args)
+    state['mboxes'] = {}
+    state['profiler'] = profiling.Profiler(args.profile, args.load, args.rootdir)
+    state['watchdog'] = watchdog.Watchdog(args.budget)
+    phases.switch(previous)
+
+
+def generate_range(mboxfile, keys):
+    """Returns the (generator, spec entry) pairs for a range of messages of an mbox file"""
+    args = state['args']
+    archiver = state['archiver']
+    if mboxfile not in state['mboxes']:
+        state['mboxes'][mboxfile] = corpus.open_mbox(mboxfile, args.nomboxo)
+    mbox = state['mboxes'][mboxfile]
+    entries = []
+    for key in keys:
+        message_raw, parsed = mbox.load(key)
+        for gen_type, archie in state['archies'].items():
+            message = corpus.copy_message(parsed)
+            lid = args.lid or archiver.normalize_lid(message.get('list-id', '??'))
+            json = archie.compute_updates(fake_args, lid, False, message, message_raw)
+            mid = message.get('message-id','').strip()
+            if json:
+                entries.append((gen_type, {
+                    'index': key,
+                    'message-id': mid,
+                    'generated': json['mid'],
+                }))
+            else:
+                print("Cannot parse index %d: %s" % (key, mid))
+    sys.stdout.flush()
+    return entries
+
+
+def generate_specs(args):
+    """Writes the spec as the messages are processed; with --shards, ranges of messages are processed in parallel"""
     if args.generators:
         generator_names = args.generators
     else:
@@ -45,48 +85,110 @@ def generate_specs(args):
         except:
             import plugins.generators as generators
         generator_names = generators.generator_names() if hasattr(generators, 'generator_names') else ['full', 'medium', 'cluster', 'legacy']
-    yml = {}
     # sort so most recent generators come last to make comparisons easier
-    for gen_type in sorted(generator_names, key=lambda s: s.replace('dkim','zkim')):
-        test_args = collections.namedtuple('testargs', ['parse_html', 'generator'])(parse_html, gen_type)
-        archie = interfacer.Archiver(archiver, test_args)
-        sys.stderr.write("Generating specs for type '%s'...\n" % gen_type)
-
-        gen_spec = []
-        mbox = mailbox.mbox(args.mboxfile, None if args.nomboxo else MboxoFactory, create=False)
-        for key in mbox.keys():
-            message_raw = _raw(args, mbox, key)
-            message = mbox.get(key)
+    gen_types = sorted(generator_names, key=lambda s: s.replace('dkim','zkim'))
+    init_state(args, {}, gen_types)
+    sys.stderr.write("Generating specs for types '%s'...\n" % "', '".join(gen_types))
+
+    mbox = corpus.open_mbox(args.mboxfile, args.nomboxo)
+    state['mboxes'][args.mboxfile] = mbox
+    keys = mbox.keys()
+    if args.shards:
+        tasks = [(args.mboxfile, keys[n:n + GENERATE_RANGE]) for n in range(0, len(keys), GENERATE_RANGE)]
+        outcomes = shards.run(args.shards, init_state, (args, {}, gen_types), generate_range, tasks)
+    else:
+        tasks = [(args.mboxfile, [key]) for key in keys]
+        outcomes = (generate_range(*task) for task in tasks)
+    # don't sort keys here
+    writer = specs.SpecWriter(args.generate, {'cmd': " ".join(sys.argv)})
+    for gen_type in gen_types:
+        writer.start(('generators', args.mboxfile, gen_type))
+    progress = specs.Progress(args.mboxfile, len(keys))
+    for (_, task_keys), entries in zip(tasks, outcomes):
+        for gen_type, entry in entries:
+            writer.add(('generators', args.mboxfile, gen_type), entry)
+        progress.update(len(task_keys))
+    writer.close()
+
+
+def check_range(mboxfile, messages):
+    """
+    Runs the tests for a range of messages of an mbox file.
+    messages is a list of (index, [(gen_type, position in spec, test), ...]).
+    Returns a list of (record, dropin) per test, where record is the result record
+    and dropin the generated ID if it is to replace the expected one in the spec.
+    """
+    args = state['args']
+    _env = state['env']
+    archiver = state['archiver']
+    profiler = state['profiler']
+    if mboxfile not in state['mboxes']:
+        phases.switch('scan')
+        state['mboxes'][mboxfile] = corpus.open_mbox(mboxfile, args.nomboxo)
+    mbox = state['mboxes'][mboxfile]
+    outcomes = []
+    for key, gen_tests in messages:
+        phases.switch('mboxo')
+        message_raw = mbox.read(key)
+        phases.switch('parse')
+        parsed = mbox.parse(message_raw)
+        for gen_type, _, test in gen_tests:
+            phases.switch('parse')
+            started = time.time()
+            archie = state['archies'][gen_type]
+            message = corpus.copy_message(parsed)
+            mock.apply_aat(message, _env, gen_type)
+            phases.switch('compare')
+            msgid =(message.get('message-id') or '').strip()
+            dateheader = message.get('date')
+            if args.skipnodate and not dateheader:
+                print("""[SKIP] %s, index %2u: No date header found and --skipnodate specified, skipping this test!""" %
+                                 (gen_type, key, ))
+                outcomes.append(((mboxfile, key, gen_type, msgid, 'skip', time.time() - started), None))
+                continue
+            if msgid != test['message-id']:
+                sys.stderr.write("""[SEQ?] %s, index %2u: Expected '%s', got '%s'!\n""" %
+                                (gen_type, key, test['message-id'], msgid))
+                outcomes.append(((mboxfile, key, gen_type, msgid, 'seq', time.time() - started), None))
+                continue # no point continuing
+            phases.switch('compute')
             lid = args.lid or archiver.normalize_lid(message.get('list-id', '??'))
-            json = archie.compute_updates(fake_args, lid, False, message, message_raw)
-            mid = message.get('message-id','').strip()
-            if json:
-                gen_spec.append({
-                    'index': key,
-                    'message-id': mid,
-                    'generated': json['mid'],
-                })
+            try:
+                with profiler.section(mboxfile, gen_type):
+                    json, elapsed = state['watchdog'].call(archie.compute_updates, fake_args, lid, False, message, message_raw)
+            except watchdog.MessageTimeout as e:
+                phases.switch('compare')
+                sys.stderr.write("""[FAIL] %s, index %2u: %s\n""" % (gen_type, key, e))
+                outcomes.append(((mboxfile, key, gen_type, msgid, 'fail', e.elapsed), None))
+                continue
+            phases.switch('compare')
+
+            # get override for version (if any)
+            expected = test.get(archie.version, test['generated'])
+            actual = json['mid']
+            if actual != expected:
+                sys.stderr.write("""[FAIL] %s, index %2u: Expected '%s', got '%s'!\n""" %
+                                (gen_type, key, expected, actual))
+                dropin = actual if args.dropin and gen_type == args.dropin else None
+                outcomes.append(((mboxfile, key, gen_type, msgid, 'fail', elapsed), dropin))
             else:
-                print("Cannot parse index %d: %s" % (key, mid))
-        yml[gen_type] = gen_spec
-    with open(args.generate, 'w') as f:
-        # don't sort keys here
-        yaml.dump({'args': {'cmd': " ".join(sys.argv)}, 'generators': {args.mboxfile: yml}}, f, sort_keys=False)
-        f.close()
+                print("[PASS] %s index %u" % (gen_type, key))
+                outcomes.append(((mboxfile, key, gen_type, msgid, 'pass', elapsed), None))
+    sys.stdout.flush()
+    phases.switch('other')
+    return outcomes
+
+
+def check_shard(mboxfile, messages):
+    """check_range in a --shards worker; also returns what was profiled, for the parent to merge"""
+    profiler = state['profiler']
+    with profiler.section(mboxfile, 'harness'):
+        outcomes = check_range(mboxfile, messages)
+    return outcomes, profiler.take()
 
 
 def run_tests(args):
-    if not args.nomboxo:
-        # Temporary patch to fix Python email package limitation
-        # It must be removed when the Python package is fixed
-        from mboxo_patch import MboxoFactory
     import archiver
-    import logging
-    verbose_logger = logging.getLogger()
-    verbose_logger.setLevel(logging.WARN)
-    verbose_logger.addHandler(logging.StreamHandler(sys.stderr))
-    archiver.logger = verbose_logger
-
     try:
         import generators
     except:
@@ -94,77 +196,96 @@ def run_tests(args):
     errors = 0
     skipped = 0
     tests_run = 0
-    yml = yaml.safe_load(open(args.load, 'r'))
+    results = ResultWriter(args.results, args.load)
+    slowest = watchdog.Slowest(args.slowest)
+    profiler = profiling.Profiler(args.profile, args.load, args.rootdir)
+    with profiler.section(None, 'load'):
+        # --dropin rewrites the spec, so needs the plain yaml data
+        phases.switch('yaml')
+        yml = specs.load_spec(args.load, compiled=not args.dropin)
+        phases.switch('other')
     _env = {}
     if 'args' in yml and 'env' in yml['args']:
         _env = yml['args']['env']
     generator_names = generators.generator_names() if hasattr(generators, 'generator_names') else ['full', 'medium', 'cluster', 'legacy']
     if args.generators:
         generator_names = args.generators
+    gen_types = []
+    for run in yml['generators'].values():
+        for gen_type in run or []:
+            if gen_type in generator_names and gen_type not in gen_types:
+                gen_types.append(gen_type)
+    init_state(args, _env, gen_types)
+    state['profiler'] = profiler
+
+    def merge(outcomes, gen_runs):
+        nonlocal errors, skipped
+        for record, dropin in outcomes:
+            results.record(*record)
+            slowest.add(*record)
+            status = record[4]
+            if status == 'fail':
+                errors += 1
+            elif status == 'skip':
+                skipped += 1
+            if dropin is not None:
+                # the ID cannot also match here, else the test would have passed
+                gen_runs[record[2]][record[1]]['generated'] = dropin
+
     mboxfiles = []
+    ranges = [] # for --shards, as (mboxfile, messages, tests by generator and index)
     for file, run in yml['generators'].items():
         mboxfiles.append(file)
         if not run: # No tests under this filename, run same tests as next
             continue
-        for gen_type, tests in run.items():
+        run_types = []
+        for gen_type in run:
             if gen_type not in generator_names:
                 sys.stderr.write("Warning: generators.py does not have the '%s' generator, skipping tests\n" % gen_type)
                 continue
-            test_args = collections.namedtuple('testargs', ['parse_html', 'generator'])(parse_html, gen_type)
-            archie = interfacer.Archiver(archiver, test_args)
-            for mboxfile in mboxfiles:
-                sys.stderr.write("Starting to process %s using %s\n" % (mboxfile,gen_type))
-                mbox = mailbox.mbox(mboxfile, None if args.nomboxo else MboxoFactory, create=False)
+            run_types.append(gen_type)
+        if not run_types:
+            mboxfiles = []
+            continue
+        for mboxfile in mboxfiles:
+            sys.stderr.write("Starting to process %s using %s\n" % (mboxfile, ", ".join(run_types)))
+            with profiler.section(mboxfile, 'harness'):
+                phases.switch('scan')
+                mbox = corpus.open_mbox(mboxfile, args.nomboxo)
+                state['mboxes'][mboxfile] = mbox
                 no_messages = len(mbox.keys())
-                no_tests = len(tests)
-                if no_messages != no_tests:
-                    sys.stderr.write("Warning: %s run for %s contains %u tests, but mbox file has %u emails!\n" %
-                                    (gen_type, mboxfile, no_tests, no_messages))
-                for test in tests:
-                    tests_run += 1
-                    key = test['index']
-                    message_raw = _raw(args, mbox, key)
-                    message = mbox.get(key)
-                    # Mock archived-at for slightly broken medium generators
-                    if 'MOCK_AAT' in _env and gen_type == 'medium':
-                        mock_aat = email.utils.formatdate(int(_env['MOCK_AAT']), False)
-                        try:
-                            message.replace_header('archived-at', mock_aat)
-                        except:
-                            message['archived-at'] = mock_aat
-                    msgid =(message.get('message-id') or '').strip()
-                    dateheader = message.get('date')
-                    if args.skipnodate and not dateheader:
-                        print("""[SKIP] %s, index %2u: No date header found and --skipnodate specified, skipping this test!""" %
-                                         (gen_type, key, ))
-                        skipped += 1
-                        continue
-                    if msgid != test['message-id']:
-                        sys.stderr.write("""[SEQ?] %s, index %2u: Expected '%s', got '%s'!\n""" %
-                                        (gen_type, key, test['message-id'], msgid))
-                        continue # no point continuing
-                    lid = args.lid or archiver.normalize_lid(message.get('list-id', '??'))
-                    json = archie.compute_updates(fake_args, lid, False, message, message_raw)
-
-                    # get override for version (if any)
-                    expected = test.get(archie.version, test['generated'])
-                    actual = json['mid']
-                    if actual != expected:
-                        errors += 1
-                        sys.stderr.write("""[FAIL] %s, index %2u: Expected '%s', got '%s'!\n""" %
-                                        (gen_type, key, expected, actual))
-                        if args.dropin and gen_type == args.dropin:
-                            if expected != actual:
-                                test['generated'] = actual
-                            else:
-                                test['alternate'] = actual
-                    else:
-                        print("[PASS] %s index %u" % (gen_type, key))
+                phases.switch('other')
+                # Parse each message once, and run all the generators against it
+                by_index = collections.OrderedDict()
+                gen_runs = {} # the spec entries by generator and index, for --dropin
+                for gen_type in run_types:
+                    tests = run[gen_type]
+                    no_tests = len(tests)
+                    if no_messages != no_tests:
+                        sys.stderr.write("Warning: %s run for %s contains %u tests, but mbox file has %u emails!\n" %
+                                        (gen_type, mboxfile, no_tests, no_messages))
+                    gen_runs[gen_type] = {}
+                    for n, test in enumerate(tests):
+                        by_index.setdefault(test['index'], []).append((gen_type, n, test))
+                        gen_runs[gen_type][test['index']] = test
+                        tests_run += 1
+                if args.shards:
+                    ranges.extend((mboxfile, messages, gen_runs) for messages in shards.split(by_index.items(), args.shards))
+                    continue
+                merge(check_range(mboxfile, list(by_index.items())), gen_runs)
         mboxfiles = [] # reset for the next set of tests
+    if ranges:
+        tasks = [(mboxfile, messages) for mboxfile, messages, _ in ranges]
+        for (outcomes, profiles), (_, _, gen_runs) in zip(shards.run(args.shards, init_state, (args, _env, gen_types), check_shard, tasks), ranges):
+            profiler.add(profiles)
+            merge(outcomes, gen_runs)
+    slowest.report()
+    profiler.report()
     if args.dropin and errors:
         sys.stderr.write("Writing replacement yaml as --dropin was specified\n")
         yaml.safe_dump(yml, open(args.load, "w"), sort_keys=False)
-    # N.B. The following line is parsed by runall.py
+    results.done(tests_run, errors, skipped)
+    # N.B. The following line is parsed by runall.py if no --results file is given
     print("[DONE] %u tests run, %u failed. Skipped %u." % (tests_run, errors, skipped))
     if errors:
         sys.exit(-1)
@@ -190,6 +311,17 @@ def main():
                         help = 'Perform drop-in replacement of unit test results for the specified generator type [devs only!]')
     parser.add_argument('--skipnodate', dest = 'skipnodate', action='store_true',
                         help = 'Skip emails with no Date: header (useful for medium generator tests)')
+    parser.add_argument('--results', dest='results', type=str,
+                        help='Write a JSON record per test to this file')
+    parser.add_argument('--profile', dest='profile', type=str, nargs='?', const='profile',
+                        help='Profile the tests, writing pstats files to this directory (default profile/)')
+    parser.add_argument('--shards', dest='shards', type=int,
+                        help='Split the tests into ranges of messages and run them in this many worker processes')
+    parser.add_argument('--budget', dest='budget', type=float,
+                        help='Fail a test if compute_updates takes longer than this many seconds '
+                             '(best effort: long calls into C code, e.g. regex matching, are not interrupted)')
+    parser.add_argument('--slowest', dest='slowest', type=int, default=0,
+                        help='Number of slowest messages to list at the end (default none)')
     args = parser.parse_args()
 
     if args.rootdir:
@@ -199,18 +331,7 @@ def main():
     sys.path.append(tools_dir)
 
     if os.environ.get('MOCK_GMTIME'):
-        import time
-        import traceback
-        save_gmtime = time.gmtime
-        def _time_gmtime(secs=None):
-            if secs is None:
-                callers = traceback.extract_stack(limit=2) # want last-1 and last (i.e. here)
-                [filename, _, _, _] = callers[0] # This is last-1, i.e. my caller
-                if filename.endswith("/tools/archiver.py") or filename.endswith("tools/generators.py"):
-                    return save_gmtime(0)
-            return save_gmtime(secs)
-
-        time.gmtime = _time_gmtime
+        mock.install_gmtime()
     
     if args.generate:
         if not args.mboxfile:
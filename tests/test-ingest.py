@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+This is the archive ingestion test suite.
+It stores the messages of parsing and generators specs through the archiver's
+own write path (archive_message and the Elasticsearch client) into a local
+stand-in for Elasticsearch (see standin.py), checks that the stored mbox
+documents match the expected values of the specs, and reports the documents
+stored per second, the requests made and the size of any bulk requests:
+
+ingest:
+  yaml/pars-ponymail-dev-1079-1080.yaml:   # a parsing and/or generators spec
+  yaml/gens-ponymail-dev-1079-1080.yaml:
+    min_rate: 50                           # optional floor, in documents per second
+
+The stored documents are checked per corpus file (and generator); a test passes
+if one of the mbox documents with the message-id of the test has the expected body
+SHA3-256 and attachments (parsing), or if the expected generated ID was stored (generators).
+The args env of each spec (MOCK_GMTIME, MOCK_AAT) is applied while storing its messages.
+"""
+import sys
+import os
+import argparse
+import collections
+import hashlib
+import time
+import phases
+import mock
+import interfacer
+import corpus
+import specs
+import profiling
+import standin
+from results import ResultWriter
+
+# archive_message of 0.12 also looks at the dry run etc. options of archiver.py
+fake_args = collections.namedtuple('fakeargs', ['verbose', 'ibody', 'dry', 'dump', 'defaultepoch', 'digest'])(
+    False, None, False, None, None, False)
+list_tuple = collections.namedtuple('importmsg', ['list_id', 'archive_public', 'archive_policy', 'list_name', 'description'])
+TEST_TYPES = ('parsing', 'generators')
+
+
+def rate_line(name, messages, elapsed, stats):
+    """Returns the throughput summary of a run"""
+    rate = stats['writes'] / elapsed if elapsed else 0.0
+    line = "%s: %u messages, %u documents in %.3fs (%.1f documents/sec), %u requests (%s)" % (
+        name, messages, stats['writes'], elapsed, rate, sum(stats['requests'].values()),
+        ', '.join("%s %u" % item for item in sorted(stats['requests'].items())))
+    if stats['bulk']:
+        sizes = [size for size, _ in stats['bulk']]
+        actions = [count for _, count in stats['bulk']]
+        line += ", bulk requests mean %s/%.1f documents, max %s/%u documents" % (
+            phases.format_size(sum(sizes) / len(sizes)), sum(actions) / len(actions), phases.format_size(max(sizes)), max(actions))
+    return line, rate
+
+
+def store_messages(server, archie, archiver, mbox, tests, env, gen_type):
+    """
+    Stores the messages of the tests with archive_message.
+    Returns the message-id and time taken per test, and the stand-in stats.
+    """
+    server.reset()
+    stored = []
+    for test in tests:
+        key = test['index']
+        phases.switch('mboxo')
+        message_raw = mbox.read(key)
+        phases.switch('parse')
+        message = mbox.parse(message_raw)
+        mock.apply_aat(message, env, gen_type)
+        phases.switch('compute')
+        msgid = (message.get('message-id') or '').strip()
+        lid = archiver.normalize_lid(message.get('list-id', '??'))
+        list_data = list_tuple(lid, True, 'public', lid.strip('<>').split('.')[0], lid)
+        started = time.perf_counter()
+        error = None
+        try:
+            archie.archive_message(fake_args, list_data, message, message_raw)
+        except Exception as e: # pylint: disable=broad-except
+            error = "%s: %s" % (type(e).__name__, e)
+        stored.append((msgid, time.perf_counter() - started, error))
+    phases.switch('compare')
+    return stored, server.stats()
+
+
+def stored_parsing(documents):
+    """Returns {message-id: [(body SHA3-256, attachments), ...]} of the stored mbox documents"""
+    found = collections.defaultdict(list)
+    for doc in documents.values():
+        body_sha3_256 = None
+        if doc.get('body') is not None and not doc.get('html_source_only'):
+            body_sha3_256 = hashlib.sha3_256(doc['body'].encode('utf-8')).hexdigest()
+        found[(doc.get('message-id') or '').strip()].append((body_sha3_256, doc.get('attachments') or []))
+    return found
+
+
+def run_tests(args):
+    phases.switch('startup')
+    server = standin.StandIn(args.version).start()
+    standin.redirect(server.url)
+    import archiver
+    import logging
+    verbose_logger = logging.getLogger()
+    verbose_logger.setLevel(logging.WARN)
+    verbose_logger.addHandler(logging.StreamHandler(sys.stderr))
+    archiver.logger = verbose_logger
+    phases.switch('yaml')
+    yml = specs.load_spec(args.load)
+    phases.switch('other')
+    errors = 0
+    tests_run = 0
+    results = ResultWriter(args.results, args.load)
+    profiler = profiling.Profiler(args.profile, args.load, args.rootdir)
+    total_messages = 0
+    total_elapsed = 0.0
+    total_stats = {'writes': 0, 'requests': {}, 'bulk': []}
+    try:
+        for spec_file, options in yml['ingest'].items():
+            options = options or {}
+            phases.switch('yaml')
+            spec = specs.load_spec(spec_file)
+            phases.switch('other')
+            spec_args = spec.get('args', {})
+            env = dict(os.environ, **(spec_args.get('env') or {}))
+            mock.install_gmtime(bool(env.get('MOCK_GMTIME')))
+            spec_messages = 0
+            spec_elapsed = 0.0
+            spec_writes = 0
+            for test_type in TEST_TYPES:
+                if test_type not in spec:
+                    continue
+                for mboxfile, gen_type, tests in specs.spec_runs(spec, test_type):
+                    if args.generators and gen_type and gen_type not in args.generators:
+                        continue
+                    sys.stderr.write("Storing %s (%s) from %s\n" % (mboxfile, gen_type or test_type, spec_file))
+                    test_args = collections.namedtuple('testargs', ['parse_html', 'generator'])(
+                        spec_args.get('parse_html', False) if gen_type is None else False, gen_type)
+                    archie = interfacer.Archiver(archiver, test_args)
+                    with profiler.section(mboxfile, gen_type or test_type):
+                        phases.switch('scan')
+                        mbox = corpus.open_mbox(mboxfile, args.nomboxo)
+                        stored, stats = store_messages(server, archie, archiver, mbox, tests, env, gen_type)
+                        mbox.close()
+                    documents = server.documents('mbox')
+                    by_msgid = stored_parsing(documents) if gen_type is None else None
+                    mids = set(documents) | set(doc.get('mid') for doc in documents.values())
+                    for test, (msgid, elapsed, error) in zip(tests, stored):
+                        tests_run += 1
+                        key = test['index']
+                        name = gen_type or test_type
+                        status = 'pass'
+                        if msgid != test['message-id']:
+                            sys.stderr.write("""[SEQ?] %s, index %2u: Expected '%s', got '%s'!\n""" %
+                                             (name, key, test['message-id'], msgid))
+                            status = 'seq'
+                        elif error:
+                            status = 'fail'
+                            sys.stderr.write("""[FAIL] %s, index %2u: archive_message failed: %s\n""" % (name, key, error))
+                        elif gen_type is None:
+                            expected = (test.get(archie.version, test['body_sha3_256']), test['attachments'] or [])
+                            if expected not in by_msgid.get(msgid, []):
+                                status = 'fail'
+                                sys.stderr.write("""[FAIL] parsing index %2u: Expected: %s %s Stored: %s\n""" %
+                                                 (key, expected[0], expected[1], by_msgid.get(msgid, [])))
+                        else:
+                            expected = test.get(archie.version, test['generated'])
+                            if expected not in mids:
+                                status = 'fail'
+                                sys.stderr.write("""[FAIL] %s, index %2u: Expected '%s' to be stored\n""" % (gen_type, key, expected))
+                        if status == 'fail':
+                            errors += 1
+                        elif status == 'pass':
+                            print("[PASS] %s index %u" % (name, key))
+                        results.record(mboxfile, key, gen_type, msgid, status, elapsed)
+                    elapsed = sum(elapsed for _, elapsed, _ in stored)
+                    print("[RATE] %s" % rate_line("%s (%s)" % (mboxfile, gen_type or test_type), len(stored), elapsed, stats)[0])
+                    spec_messages += len(stored)
+                    spec_elapsed += elapsed
+                    spec_writes += stats['writes']
+                    total_stats['writes'] += stats['writes']
+                    total_stats['bulk'] += stats['bulk']
+                    for kind, count in stats['requests'].items():
+                        total_stats['requests'][kind] = total_stats['requests'].get(kind, 0) + count
+                    phases.switch('other')
+            total_messages += spec_messages
+            total_elapsed += spec_elapsed
+            if options.get('min_rate') is not None:
+                tests_run += 1
+                rate = spec_writes / spec_elapsed if spec_elapsed else 0.0
+                if rate < options['min_rate']:
+                    errors += 1
+                    sys.stderr.write("""[FAIL] %s: Stored %.1f documents/sec, expected at least %s\n""" %
+                                     (spec_file, rate, options['min_rate']))
+    finally:
+        server.stop()
+    print("[RATE] %s" % rate_line("Total", total_messages, total_elapsed, total_stats)[0])
+    profiler.report()
+    results.done(tests_run, errors)
+    # N.B. The following line is parsed by runall.py if no --results file is given
+    print("[DONE] %u tests run, %u failed." % (tests_run, errors))
+    if errors:
+        sys.exit(-1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Command line options.')
+    parser.add_argument('--load', dest='load', type=str, required=True,
+                        help='Load and run tests from a yaml spec file')
+    parser.add_argument('--rootdir', dest='rootdir', type=str, required=True,
+                        help="Root directory of Apache Pony Mail")
+    parser.add_argument('--generators', dest='generators', nargs='+', type=str,
+                        help='Only run the tests of these generators')
+    parser.add_argument('--nomboxo', dest = 'nomboxo', action='store_true',
+                        help = 'Skip Mboxo processing')
+    parser.add_argument('--version', dest='version', type=str, default=standin.DEFAULT_VERSION,
+                        help='Elasticsearch version reported by the stand-in (default %s)' % standin.DEFAULT_VERSION)
+    parser.add_argument('--results', dest='results', type=str,
+                        help='Write a JSON record per test to this file')
+    parser.add_argument('--profile', dest='profile', type=str, nargs='?', const='profile',
+                        help='Profile the tests, writing pstats files to this directory (default profile/)')
+    args = parser.parse_args()
+
+    tools_dir = os.path.join(args.rootdir, 'tools')
+    sys.path.append(tools_dir)
+
+    run_tests(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+This is the archiver memory budget test suite.
+It tracks the memory allocated by compute_updates for each message of a corpus
+and checks the peak and the retained (still allocated afterwards) memory
+against the budgets in the yaml spec:
+
+args:
+  parse_html: false
+  generator: full       # optional, as per test-generators.py
+memory:
+  corpus/example.mbox:
+    peak: 64MB          # per message budgets for this corpus file
+    retained: 8MB
+    messages:           # optional per message overrides
+    - index: 3
+      peak: 256MB
+
+Sizes are in bytes, or may use a KB, MB or GB suffix.
+Before measuring a corpus file, the first message is processed once untracked,
+so that lazy imports and caches in the archiver do not count as retained memory.
+"""
+import sys
+import os
+import argparse
+import collections
+import gc
+import re
+import time
+import tracemalloc
+import phases
+import interfacer
+import corpus
+import specs
+import profiling
+from results import ResultWriter
+
+fake_args = collections.namedtuple('fakeargs', ['verbose', 'ibody'])(False, None)
+SIZE_UNITS = {'': 1, 'B': 1, 'KB': 1 << 10, 'MB': 1 << 20, 'GB': 1 << 30}
+
+
+def parse_size(size):
+    """Converts a size such as 1048576, '512KB' or '64MB' to bytes"""
+    if size is None or isinstance(size, int):
+        return size
+    m = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMG]?B?)\s*$", str(size), re.IGNORECASE)
+    if not m:
+        raise ValueError("Invalid size '%s'" % size)
+    return int(float(m.group(1)) * SIZE_UNITS[m.group(2).upper()])
+
+
+def measure(archie, lid, message, message_raw):
+    """Returns the peak and retained bytes allocated by compute_updates"""
+    gc.collect()
+    tracemalloc.clear_traces() # also resets the peak
+    json = archie.compute_updates(fake_args, lid, False, message, message_raw)
+    del json
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    return peak, retained
+
+
+def run_tests(args):
+    phases.switch('startup')
+    import archiver
+    import logging
+    verbose_logger = logging.getLogger()
+    verbose_logger.setLevel(logging.WARN)
+    verbose_logger.addHandler(logging.StreamHandler(sys.stderr))
+    archiver.logger = verbose_logger
+    phases.switch('other')
+    errors = 0
+    tests_run = 0
+    results = ResultWriter(args.results, args.load)
+    profiler = profiling.Profiler(args.profile, args.load, args.rootdir)
+    with profiler.section(None, 'load'):
+        phases.switch('yaml')
+        yml = specs.load_spec(args.load)
+        phases.switch('other')
+    yml_args = yml.get('args', {})
+    generator = yml_args.get('generator')
+    test_args = collections.namedtuple('testargs', ['parse_html', 'generator'])(yml_args.get('parse_html', False), generator)
+    archie = interfacer.Archiver(archiver, test_args)
+
+    measured = []
+    tracemalloc.start()
+    for mboxfile, budget in yml['memory'].items():
+        budget = budget or {}
+        sys.stderr.write("Starting to process %s\n" % mboxfile)
+        peak_budget = parse_size(budget.get('peak'))
+        retained_budget = parse_size(budget.get('retained'))
+        overrides = dict((test['index'], test) for test in budget.get('messages') or [])
+        with profiler.section(mboxfile, 'memory'):
+            phases.switch('scan')
+            mbox = corpus.open_mbox(mboxfile, args.nomboxo)
+            warmed_up = False
+            for key in mbox.keys():
+                phases.switch('mboxo')
+                message_raw = mbox.read(key)
+                phases.switch('parse')
+                parsed = mbox.parse(message_raw)
+                message = corpus.copy_message(parsed)
+                phases.switch('compute')
+                lid = archiver.normalize_lid(message.get('list-id', '??'))
+                if not warmed_up:
+                    tracemalloc.stop()
+                    archie.compute_updates(fake_args, lid, False, corpus.copy_message(parsed), message_raw)
+                    tracemalloc.start()
+                    warmed_up = True
+                tests_run += 1
+                started = time.time()
+                msgid = (message.get('message-id') or '').strip()
+                peak, retained = measure(archie, lid, message, message_raw)
+                phases.switch('compare')
+                measured.append((peak, retained, mboxfile, key, msgid))
+                override = overrides.get(key, {})
+                allowed_peak = parse_size(override.get('peak', peak_budget))
+                allowed_retained = parse_size(override.get('retained', retained_budget))
+                status = 'pass'
+                if allowed_peak is not None and peak > allowed_peak:
+                    errors += 1
+                    status = 'fail'
+                    sys.stderr.write("""[FAIL] %s index %2u: Peak allocation %s exceeds budget of %s\n""" %
+                                     (mboxfile, key, phases.format_size(peak), phases.format_size(allowed_peak)))
+                if allowed_retained is not None and retained > allowed_retained:
+                    errors += 1
+                    status = 'fail'
+                    sys.stderr.write("""[FAIL] %s index %2u: Retained allocation %s exceeds budget of %s\n""" %
+                                     (mboxfile, key, phases.format_size(retained), phases.format_size(allowed_retained)))
+                if status == 'pass':
+                    print("[PASS] index %u peak %s retained %s" % (key, phases.format_size(peak), phases.format_size(retained)))
+                results.record(mboxfile, key, archie.generator, msgid, status, time.time() - started)
+            mbox.close()
+            phases.switch('other')
+    tracemalloc.stop()
+
+    if measured:
+        sys.stderr.write("Largest peak allocations:\n")
+        for peak, retained, mboxfile, key, msgid in sorted(measured, reverse=True)[:args.top]:
+            sys.stderr.write("    %10s peak %10s retained  %s index %u %s\n" %
+                             (phases.format_size(peak), phases.format_size(retained), mboxfile, key, msgid))
+    profiler.report()
+    results.done(tests_run, errors)
+    # N.B. The following line is parsed by runall.py if no --results file is given
+    print("[DONE] %u tests run, %u failed." % (tests_run, errors))
+    if errors:
+        sys.exit(-1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Command line options.')
+    parser.add_argument('--load', dest='load', type=str, required=True,
+                        help='Load and run tests from a yaml spec file')
+    parser.add_argument('--rootdir', dest='rootdir', type=str, required=True,
+                        help="Root directory of Apache Pony Mail")
+    parser.add_argument('--nomboxo', dest = 'nomboxo', action='store_true',
+                        help = 'Skip Mboxo processing')
+    parser.add_argument('--top', dest='top', type=int, default=10,
+                        help='Number of largest allocations to list (default 10)')
+    parser.add_argument('--results', dest='results', type=str,
+                        help='Write a JSON record per test to this file')
+    parser.add_argument('--profile', dest='profile', type=str, nargs='?', const='profile',
+                        help='Profile the tests, writing pstats files to this directory (default profile/)')
+    args = parser.parse_args()
+
+    if args.rootdir:
+        tools_dir = os.path.join(args.rootdir, 'tools')
+    else:
+        tools_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', "tools")
+    sys.path.append(tools_dir)
+
+    run_tests(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,132 +5,220 @@ It tests live parsings against a set of predefined reference constants.
 """
 import sys
 import os
-import mailbox
-import yaml
 import argparse
 import collections
 import hashlib
+import time
+import phases
 import interfacer
+import corpus
+import specs
+import profiling
+import shards
+import watchdog
+from results import ResultWriter
 
 nonce = None
+GENERATE_RANGE = 100 # messages per task when generating a spec with --shards
 fake_args = collections.namedtuple('fakeargs', ['verbose', 'ibody'])(False, None)
 
-# get raw message, allowing for mboxo translation
-def _raw(args, mbox, key):
-    if args.nomboxo: # No need to filter the data
-        file=mbox.get_file(key, True)
-        message_raw=file.read()
-        file.close()
-    else:
-        from mboxo_patch import MboxoReader
-        file=mbox.get_file(key, True)
-        file=MboxoReader(file)
-        message_raw=file.read()
-        file.close()
-    return message_raw
+# State of the test process, or of each worker process with --shards
+state = {}
 
-def generate_specs(args):
-    if not args.nomboxo:
-        # Temporary patch to fix Python email package limitation
-        # It must be removed when the Python package is fixed
-        from mboxo_patch import MboxoFactory
+def init_state(args, parse_html):
+    previous = phases.switch('startup')
     import archiver
-    cli_args = collections.namedtuple('testargs', ['parse_html'])(args.html)
-    archie = interfacer.Archiver(archiver, cli_args)
+    import logging
+    verbose_logger = logging.getLogger()
+    verbose_logger.setLevel(logging.WARN)
+    shards.log_to_stderr(verbose_logger)
+    archiver.logger = verbose_logger
+    test_args = collections.namedtuple('testargs', ['parse_html'])(parse_html)
+    state['args'] = args
+    state['archiver'] = archiver
+    state['archie'] = interfacer.Archiver(archiver, test_args)
+    state['mboxes'] = {}
+    state['watchdog'] = watchdog.Watchdog(args.budget)
+    state['profiler'] = profiling.Profiler(args.profile, args.load, args.rootdir)
+    phases.switch(previous)
 
+
+def generate_range(mboxfile, keys):
+    """Returns the spec entries for a range of messages of an mbox file"""
+    args = state['args']
+    archiver = state['archiver']
+    archie = state['archie']
+    if mboxfile not in state['mboxes']:
+        state['mboxes'][mboxfile] = corpus.open_mbox(mboxfile, args.nomboxo)
+    mbox = state['mboxes'][mboxfile]
+    tests = []
+    for key in keys:
+        message_raw, message = mbox.load(key)
+        lid = archiver.normalize_lid(message.get('list-id', '??'))
+        json = archie.compute_updates(fake_args, lid, False, message, message_raw)
+        body_sha3_256 = None
+        if json and json.get('body') is not None:
+            body_sha3_256 = hashlib.sha3_256(json['body'].encode('utf-8')).hexdigest()
+        tests.append({
+            'index': key,
+            'message-id': message.get('message-id', '').strip(),
+            'body_sha3_256': body_sha3_256,
+            'attachments': json['attachments'] if json else [],
+        })
+    return tests
+
+
+def generate_specs(args):
+    """Writes the spec as the messages are processed; with --shards, ranges of messages are processed in parallel"""
+    init_state(args, args.html)
     sys.stderr.write("Generating parsing specs for file '%s'...\n" % args.mboxfile)
-    items = {}
+    tasks = []
     for mboxfile in args.mboxfile:
-        tests = []
-        mbox = mailbox.mbox(mboxfile, None if args.nomboxo else MboxoFactory, create=False)
-        for key in mbox.keys():
-            message_raw = _raw(args, mbox, key)
-            message = mbox.get(key)
-            lid = archiver.normalize_lid(message.get('list-id', '??'))
-            json = archie.compute_updates(fake_args, lid, False, message, message_raw)
-            body_sha3_256 = None
-            if json and json.get('body') is not None:
+        mbox = corpus.open_mbox(mboxfile, args.nomboxo)
+        state['mboxes'][mboxfile] = mbox
+        keys = mbox.keys()
+        size = GENERATE_RANGE if args.shards else 1
+        tasks.extend([(mboxfile, keys[n:n + size]) for n in range(0, len(keys), size)] or [(mboxfile, [])])
+    if args.shards:
+        outcomes = shards.run(args.shards, init_state, (args, args.html), generate_range, tasks)
+    else:
+        outcomes = (generate_range(*task) for task in tasks)
+    writer = specs.SpecWriter(args.generate, {'cmd': " ".join(sys.argv), 'parse_html': True if args.html else False})
+    progress = None
+    for (mboxfile, keys), tests in zip(tasks, outcomes):
+        if not progress or progress.name != mboxfile:
+            writer.flush()
+            writer.start(('parsing', mboxfile))
+            progress = specs.Progress(mboxfile, len(state['mboxes'][mboxfile].keys()))
+        for test in tests:
+            writer.add(('parsing', mboxfile), test)
+        progress.update(len(keys))
+    writer.close()
+
+
+def check_range(mboxfile, tests):
+    """Runs the tests for a range of messages of an mbox file; returns the error count and result records"""
+    args = state['args']
+    archiver = state['archiver']
+    archie = state['archie']
+    if mboxfile not in state['mboxes']:
+        phases.switch('scan')
+        state['mboxes'][mboxfile] = corpus.open_mbox(mboxfile, args.nomboxo)
+    mbox = state['mboxes'][mboxfile]
+    errors = 0
+    records = []
+    for test in tests:
+        started = time.time()
+        key = test['index']
+        phases.switch('mboxo')
+        message_raw = mbox.read(key)
+        phases.switch('parse')
+        message = mbox.parse(message_raw)
+        phases.switch('compare')
+        msgid =(message.get('message-id') or '').strip()
+        if msgid != test['message-id']:
+            sys.stderr.write("""[SEQ?] index %2u: Expected '%s', got '%s'!\n""" %
+                            (key, test['message-id'], msgid))
+            records.append((mboxfile, key, None, msgid, 'seq', time.time() - started))
+            continue # no point continuing
+        phases.switch('compute')
+        lid = archiver.normalize_lid(message.get('list-id', '??'))
+        try:
+            json, elapsed = state['watchdog'].call(archie.compute_updates, fake_args, lid, False, message, message_raw)
+        except watchdog.MessageTimeout as e:
+            phases.switch('compare')
+            errors += 1
+            sys.stderr.write("""[FAIL] parsing index %2u: %s\n""" % (key, e))
+            records.append((mboxfile, key, None, msgid, 'fail', e.elapsed))
+            continue
+        phases.switch('compare')
+        body_sha3_256 = None
+        if json and json.get('body') is not None:
+            if not json.get('html_source_only'):
                 body_sha3_256 = hashlib.sha3_256(json['body'].encode('utf-8')).hexdigest()
-            tests.append({
-                'index': key,
-                'message-id': message.get('message-id', '').strip(),
-                'body_sha3_256': body_sha3_256,
-                'attachments': json['attachments'] if json else [],
-            })
-        items[mboxfile] = tests
-    with open(args.generate, 'w') as f:
-        yaml.dump({'args': {'cmd': " ".join(sys.argv), 'parse_html': True if args.html else False}, 'parsing': items}, f, sort_keys=False)
-        f.close()
+        # get override for version (if any)
+        expected = test.get(archie.version, test['body_sha3_256'])
+        status = 'pass'
+        if body_sha3_256 != expected:
+            errors += 1
+            status = 'fail'
+            sys.stderr.write("""[FAIL] parsing index %2u: Expected: %s Got: %s\n""" %
+                            (key, expected, body_sha3_256))
+        att = json['attachments'] if json else []
+        att_expected = test['attachments'] or []
+        if att != att_expected:
+            errors += 1
+            status = 'fail'
+            sys.stderr.write("""[FAIL] attachments index %2u: Expected: %s Got: %s\n""" %
+                            (key, att_expected, att))
+        else:
+            print("[PASS] index %u" % (key))
+        records.append((mboxfile, key, None, msgid, status, elapsed))
+    sys.stdout.flush()
+    phases.switch('other')
+    return errors, records
+
+
+def check_shard(mboxfile, tests):
+    """check_range in a --shards worker; also returns what was profiled, for the parent to merge"""
+    profiler = state['profiler']
+    with profiler.section(mboxfile, 'parsing'):
+        outcome = check_range(mboxfile, tests)
+    return outcome, profiler.take()
 
 
 def run_tests(args):
-    if not args.nomboxo:
-        # Temporary patch to fix Python email package limitation
-        # It must be removed when the Python package is fixed
-        from mboxo_patch import MboxoFactory
-    import archiver    
-    import logging
-    verbose_logger = logging.getLogger()
-    verbose_logger.setLevel(logging.WARN)
-    verbose_logger.addHandler(logging.StreamHandler(sys.stderr))
-    archiver.logger = verbose_logger
     errors = 0
     tests_run = 0
-    yml = yaml.safe_load(open(args.load, 'r'))
+    results = ResultWriter(args.results, args.load)
+    slowest = watchdog.Slowest(args.slowest)
+    profiler = profiling.Profiler(args.profile, args.load, args.rootdir)
+    with profiler.section(None, 'load'):
+        phases.switch('yaml')
+        yml = specs.load_spec(args.load)
+        phases.switch('other')
     parse_html = yml.get('args', {}).get('parse_html', False)
-
-    test_args = collections.namedtuple('testargs', ['parse_html'])(parse_html)
-    archie = interfacer.Archiver(archiver, test_args)
-    _env = {}
-    if 'args' in yml and 'env' in yml['args']:
-        _env = yml['args']['env']
+    init_state(args, parse_html)
 
     mboxfiles = []
-
+    ranges = [] # for --shards
     for file, tests in yml['parsing'].items():
         mboxfiles.append(file)
         if not tests: # No tests under this filename, run same tests as next
             continue
         for mboxfile in mboxfiles:
             sys.stderr.write("Starting to process %s\n" % mboxfile)
-            mbox = mailbox.mbox(mboxfile, None if args.nomboxo else MboxoFactory, create=False)
-            no_messages = len(mbox.keys())
-            no_tests = len(tests)
-            if no_messages != no_tests:
-                sys.stderr.write("Warning: %s run for parsing test of %s contains %u tests, but mbox file has %u emails!\n" %
-                                ('TBA', mboxfile, no_tests, no_messages))
-            for test in tests:
-                tests_run += 1
-                key = test['index']
-                message_raw = _raw(args, mbox, key)
-                message = mbox.get(key)
-                msgid =(message.get('message-id') or '').strip()
-                if msgid != test['message-id']:
-                    sys.stderr.write("""[SEQ?] index %2u: Expected '%s', got '%s'!\n""" %
-                                    (key, test['message-id'], msgid))
-                    continue # no point continuing
-                lid = archiver.normalize_lid(message.get('list-id', '??'))
-                json = archie.compute_updates(fake_args, lid, False, message, message_raw)
-                body_sha3_256 = None
-                if json and json.get('body') is not None:
-                    if not json.get('html_source_only'):
-                        body_sha3_256 = hashlib.sha3_256(json['body'].encode('utf-8')).hexdigest()
-                # get override for version (if any)
-                expected = test.get(archie.version, test['body_sha3_256'])
-                if body_sha3_256 != expected:
-                    errors += 1
-                    sys.stderr.write("""[FAIL] parsing index %2u: Expected: %s Got: %s\n""" %
-                                    (key, expected, body_sha3_256))
-                att = json['attachments'] if json else []
-                att_expected = test['attachments'] or []
-                if att != att_expected:
-                    errors += 1
-                    sys.stderr.write("""[FAIL] attachments index %2u: Expected: %s Got: %s\n""" %
-                                    (key, att_expected, att))
-                else:
-                    print("[PASS] index %u" % (key))
+            with profiler.section(mboxfile, 'parsing'):
+                phases.switch('scan')
+                mbox = corpus.open_mbox(mboxfile, args.nomboxo)
+                state['mboxes'][mboxfile] = mbox
+                no_messages = len(mbox.keys())
+                phases.switch('other')
+                no_tests = len(tests)
+                if no_messages != no_tests:
+                    sys.stderr.write("Warning: %s run for parsing test of %s contains %u tests, but mbox file has %u emails!\n" %
+                                    ('TBA', mboxfile, no_tests, no_messages))
+                tests_run += no_tests
+                if args.shards:
+                    ranges.extend((mboxfile, tests_range) for tests_range in shards.split(tests, args.shards))
+                    continue
+                range_errors, records = check_range(mboxfile, tests)
+                errors += range_errors
+                for record in records:
+                    results.record(*record)
+                    slowest.add(*record)
         mboxfiles = []
-    # N.B. The following line is parsed by runall.py
+    if ranges:
+        for (range_errors, records), profiles in shards.run(args.shards, init_state, (args, parse_html), check_shard, ranges):
+            profiler.add(profiles)
+            errors += range_errors
+            for record in records:
+                results.record(*record)
+                slowest.add(*record)
+    slowest.report()
+    profiler.report()
+    results.done(tests_run, errors)
+    # N.B. The following line is parsed by runall.py if no --results file is given
     print("[DONE] %u tests run, %u failed." % (tests_run, errors))
     if errors:
         sys.exit(-1)
@@ -150,6 +238,17 @@ def main():
                         help="Enable HTML parsing if generating test specs")
     parser.add_argument('--nomboxo', dest = 'nomboxo', action='store_true',
                         help = 'Skip Mboxo processing')
+    parser.add_argument('--results', dest='results', type=str,
+                        help='Write a JSON record per test to this file')
+    parser.add_argument('--profile', dest='profile', type=str, nargs='?', const='profile',
+                        help='Profile the tests, writing pstats files to this directory (default profile/)')
+    parser.add_argument('--shards', dest='shards', type=int,
+                        help='Split the tests into ranges of messages and run them in this many worker processes')
+    parser.add_argument('--budget', dest='budget', type=float,
+                        help='Fail a test if compute_updates takes longer than this many seconds '
+                             '(best effort: long calls into C code, e.g. regex matching, are not interrupted)')
+    parser.add_argument('--slowest', dest='slowest', type=int, default=0,
+                        help='Number of slowest messages to list at the end (default none)')
     args = parser.parse_args()
 
     if args.rootdir:
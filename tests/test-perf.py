@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+This is the archiver performance test suite.
+It times compute_updates for each message of a corpus and checks the throughput
+and the 95th percentile of the time per message against the limits in the yaml spec:
+
+args:
+  parse_html: false
+perf:
+  corpus/example.mbox:
+    generators: [full, medium]  # optional, the default generator otherwise
+    min_rate: 200               # messages per second
+    max_p95: 20ms               # per message; may use a ms or s suffix (default seconds)
+    repeat: 3                   # optional, the fastest of this many passes counts
+
+The limits are for a machine on which a short CPU calibration loop takes
+REFERENCE_SECONDS. Before the tests, the loop is run on this machine and the
+limits are scaled by how much faster or slower it is, so that the same spec
+works on a laptop and on CI hardware. --factor overrides the calibration.
+Each corpus file is processed once before it is timed, so that imports and caches
+in the archiver are warmed up; reading and parsing the messages is not timed.
+"""
+import sys
+import os
+import argparse
+import collections
+import email
+import email.policy
+import hashlib
+import re
+import time
+import phases
+import interfacer
+import corpus
+import specs
+import profiling
+import watchdog
+from results import ResultWriter
+
+fake_args = collections.namedtuple('fakeargs', ['verbose', 'ibody'])(False, None)
+# How long the calibration loop takes on the machine the limits in the specs are for
+REFERENCE_SECONDS = 0.16
+CALIBRATION_MESSAGE = b"\r\n".join([
+    b"From: Calibration <calibration@example.org>",
+    b"To: dev@example.org",
+    b"Subject: =?utf-8?q?Calibration_=C3=A9?=",
+    b"Message-ID: <calibration@example.org>",
+    b"Date: Thu, 1 Oct 2020 12:00:00 +0000",
+    b"Content-Type: text/plain; charset=utf-8",
+    b"Content-Transfer-Encoding: quoted-printable",
+    b"",
+    b"Calibration body with some =C3=A9 encoded text, repeated to make it a typical size.\r\n" * 40,
+])
+DURATION_UNITS = {'': 1.0, 's': 1.0, 'ms': 0.001}
+
+
+def calibrate(rounds=5, iterations=100):
+    """Returns how much faster this machine is than the reference machine, from the fastest of a few rounds"""
+    fastest = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            message = email.message_from_bytes(CALIBRATION_MESSAGE, policy=email.policy.default)
+            body = message.get_body().get_content()
+            str(message['subject'])
+            hashlib.sha3_256(body.encode('utf-8')).hexdigest()
+            re.findall(r"\w+", body)
+        elapsed = time.perf_counter() - started
+        fastest = elapsed if fastest is None else min(fastest, elapsed)
+    return REFERENCE_SECONDS / fastest
+
+
+def parse_duration(duration):
+    """Converts a duration such as 0.02, '20ms' or '0.5s' to seconds"""
+    if duration is None or isinstance(duration, (int, float)):
+        return duration
+    m = re.match(r"^\s*(\d+(?:\.\d+)?)\s*(m?s)?\s*$", str(duration), re.IGNORECASE)
+    if not m:
+        raise ValueError("Invalid duration '%s'" % duration)
+    return float(m.group(1)) * DURATION_UNITS[(m.group(2) or '').lower()]
+
+
+def time_messages(archie, lid_of, messages):
+    """Returns the time taken by compute_updates for each message"""
+    times = []
+    for message, message_raw in messages:
+        lid = lid_of(message)
+        started = time.perf_counter()
+        archie.compute_updates(fake_args, lid, False, corpus.copy_message(message), message_raw)
+        times.append(time.perf_counter() - started)
+    return times
+
+
+def run_tests(args):
+    phases.switch('startup')
+    import archiver
+    try:
+        import generators
+    except ImportError:
+        import plugins.generators as generators
+    import logging
+    verbose_logger = logging.getLogger()
+    verbose_logger.setLevel(logging.WARN)
+    verbose_logger.addHandler(logging.StreamHandler(sys.stderr))
+    archiver.logger = verbose_logger
+    phases.switch('other')
+    errors = 0
+    tests_run = 0
+    skipped = 0
+    results = ResultWriter(args.results, args.load)
+    profiler = profiling.Profiler(args.profile, args.load, args.rootdir)
+    with profiler.section(None, 'load'):
+        phases.switch('yaml')
+        yml = specs.load_spec(args.load)
+        phases.switch('other')
+    yml_args = yml.get('args', {})
+    factor = args.factor or calibrate()
+    sys.stderr.write("Calibration: this machine is %.2fx the speed of the reference machine%s\n" %
+                     (factor, " (--factor)" if args.factor else ""))
+    if args.profile:
+        sys.stderr.write("Warning: the limits are not checked with --profile, as profiling slows the archiver down\n")
+    lid_of = lambda message: archiver.normalize_lid(message.get('list-id', '??'))
+    generator_names = generators.generator_names() if hasattr(generators, 'generator_names') else ['full', 'medium', 'cluster', 'legacy']
+
+    for mboxfile, limits in yml['perf'].items():
+        limits = limits or {}
+        min_rate = limits.get('min_rate')
+        max_p95 = parse_duration(limits.get('max_p95'))
+        repeat = max(1, int(limits.get('repeat', 1)))
+        sys.stderr.write("Starting to process %s\n" % mboxfile)
+        phases.switch('scan')
+        mbox = corpus.open_mbox(mboxfile, args.nomboxo)
+        messages = []
+        for key in mbox.keys():
+            phases.switch('mboxo')
+            message_raw = mbox.read(key)
+            phases.switch('parse')
+            messages.append((mbox.parse(message_raw), message_raw))
+        mbox.close()
+        phases.switch('other')
+        if not messages:
+            sys.stderr.write("Warning: %s has no messages, skipping\n" % mboxfile)
+            continue
+        gen_types = limits.get('generators') or [None]
+        if args.generators:
+            gen_types = [gen_type for gen_type in gen_types if gen_type in args.generators]
+        for gen_type in gen_types:
+            if gen_type is not None and gen_type not in generator_names:
+                sys.stderr.write("Warning: generators.py does not have the '%s' generator, skipping tests\n" % gen_type)
+                continue
+            test_args = collections.namedtuple('testargs', ['parse_html', 'generator'])(yml_args.get('parse_html', False), gen_type)
+            archie = interfacer.Archiver(archiver, test_args)
+            name = "%s (%s)" % (mboxfile, gen_type or 'default generator')
+            phases.switch('compute')
+            with profiler.section(mboxfile, gen_type or 'perf'):
+                time_messages(archie, lid_of, messages) # warm-up
+                passes = [time_messages(archie, lid_of, messages) for _ in range(repeat)]
+            phases.switch('compare')
+            times = min(passes, key=sum)
+            elapsed = sum(times)
+            rate = len(times) / elapsed if elapsed else float('inf')
+            p95 = watchdog.percentile(times, 95)
+            tests_run += 1
+            measured = "%.1f messages/sec, p95 %.2fms over %u messages" % (rate, p95 * 1000, len(times))
+            phases.switch('other')
+            if args.profile:
+                skipped += 1
+                print("[SKIP] %s: %s" % (name, measured))
+                results.record(mboxfile, None, gen_type, None, 'skip', elapsed)
+                continue
+            failures = []
+            if min_rate is not None and rate < min_rate * factor:
+                failures.append("%.1f messages/sec, allowed at least %.1f (%s at the reference speed)" %
+                                (rate, min_rate * factor, min_rate))
+            if max_p95 is not None and p95 > max_p95 / factor:
+                failures.append("p95 %.2fms per message, allowed at most %.2fms (%.2fms at the reference speed)" %
+                                (p95 * 1000, max_p95 / factor * 1000, max_p95 * 1000))
+            for failure in failures:
+                sys.stderr.write("[FAIL] %s: %s\n" % (name, failure))
+            if failures:
+                errors += 1
+            else:
+                print("[PASS] %s: %s" % (name, measured))
+            results.record(mboxfile, None, gen_type, None, 'fail' if failures else 'pass', elapsed)
+
+    profiler.report()
+    results.done(tests_run, errors, skipped)
+    # N.B. The following line is parsed by runall.py if no --results file is given
+    print("[DONE] %u tests run, %u failed. Skipped %u." % (tests_run, errors, skipped))
+    if errors:
+        sys.exit(-1)
+
+
+def main():
+    # --calibrate needs neither a spec nor an installation, so is handled before the other options
+    calibration = argparse.ArgumentParser(add_help=False)
+    calibration.add_argument('--calibrate', dest='calibrate', action='store_true',
+                             help='Only print the time the calibration loop takes on this machine')
+    if calibration.parse_known_args()[0].calibrate:
+        print("Calibration loop: %.3fs (reference %.3fs)" % (REFERENCE_SECONDS / calibrate(), REFERENCE_SECONDS))
+        return
+
+    parser = argparse.ArgumentParser(description='Command line options.', parents=[calibration])
+    parser.add_argument('--load', dest='load', type=str, required=True,
+                        help='Load and run tests from a yaml spec file')
+    parser.add_argument('--rootdir', dest='rootdir', type=str, required=True,
+                        help="Root directory of Apache Pony Mail")
+    parser.add_argument('--generators', dest='generators', nargs='+', type=str,
+                        help='Only run the tests of these generators')
+    parser.add_argument('--nomboxo', dest = 'nomboxo', action='store_true',
+                        help = 'Skip Mboxo processing')
+    parser.add_argument('--factor', dest='factor', type=float,
+                        help='Speed of this machine relative to the reference machine, instead of calibrating')
+    parser.add_argument('--results', dest='results', type=str,
+                        help='Write a JSON record per test to this file')
+    parser.add_argument('--profile', dest='profile', type=str, nargs='?', const='profile',
+                        help='Profile the tests, writing pstats files to this directory (default profile/)')
+    args = parser.parse_args()
+
+    tools_dir = os.path.join(args.rootdir, 'tools')
+    sys.path.append(tools_dir)
+
+    run_tests(args)
+
+
+if __name__ == '__main__':
+    main()
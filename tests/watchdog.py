@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Times the compute_updates() calls of the test scripts, and enforces an optional
+time budget per message (--budget SECONDS), so that a pathological message makes
+its test fail instead of hanging the spec.
+
+The budget is enforced with SIGALRM, which interrupts the archiver by raising
+MessageTimeout. Where that is not available (Windows, or not in the main thread),
+or if the archiver swallows the exception with a bare except, a call over budget
+still fails, but only once it has returned. The same goes for a long call into C
+code, such as a regular expression match, as Python only runs signal handlers
+between bytecodes; so the budget is a best-effort limit.
+
+Slowest keeps the N slowest tests of a spec, from the same tuples as the result
+records, so it works the same with --shards.
+
+percentile() is the nearest-rank percentile of the times, for test-perf.py and
+tools/bench-archiver.py.
+"""
+
+import heapq
+import math
+import signal
+import sys
+import threading
+import time
+
+
+class MessageTimeout(Exception):
+    def __init__(self, elapsed):
+        super().__init__("Took longer than the time budget (%.3fs)" % elapsed)
+        self.elapsed = elapsed
+
+
+class Watchdog(object):
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.alarm = bool(budget) and hasattr(signal, 'setitimer') and \
+            threading.current_thread() is threading.main_thread()
+        if self.alarm:
+            signal.signal(signal.SIGALRM, self._expired)
+
+    def _expired(self, signum, frame):
+        raise MessageTimeout(self.budget)
+
+    def call(self, func, *args):
+        """Returns func(*args) and the time it took; raises MessageTimeout if that exceeds the budget"""
+        if self.alarm:
+            signal.setitimer(signal.ITIMER_REAL, self.budget)
+        started = time.perf_counter()
+        try:
+            result = func(*args)
+        except MessageTimeout:
+            raise MessageTimeout(time.perf_counter() - started)
+        finally:
+            if self.alarm:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+        elapsed = time.perf_counter() - started
+        if self.budget and elapsed > self.budget:
+            raise MessageTimeout(elapsed)
+        return result, elapsed
+
+
+class Slowest(object):
+    def __init__(self, n):
+        self.n = n
+        self.heap = []
+        self.count = 0 # tie-breaker, so that the records themselves are never compared
+
+    def add(self, corpus, index, generator, msgid, status, elapsed):
+        if self.n <= 0:
+            return
+        self.count += 1
+        item = (elapsed, self.count, (corpus, index, generator, msgid))
+        if len(self.heap) < self.n:
+            heapq.heappush(self.heap, item)
+        elif item > self.heap[0]:
+            heapq.heapreplace(self.heap, item)
+
+    def report(self):
+        if not self.heap:
+            return
+        sys.stderr.write("Slowest messages:\n")
+        for elapsed, _, (corpus, index, generator, msgid) in sorted(self.heap, reverse=True):
+            sys.stderr.write("    %8.3fs  %s index %u%s %s\n" %
+                             (elapsed, corpus, index, " (%s)" % generator if generator else "", msgid))
+
+
+def percentile(times, percent):
+    """Nearest-rank percentile of the times, e.g. percentile(times, 95) for the p95"""
+    if not times:
+        return 0.0
+    ordered = sorted(times)
+    return ordered[max(0, math.ceil(len(ordered) * percent / 100.0) - 1)]
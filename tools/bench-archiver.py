@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Archiver throughput benchmark.
+
+Measures compute_updates() for each generator and corpus file, using
+tests/interfacer.py so that any Pony Mail version can be benchmarked,
+and reports messages/second and per-message latency percentiles.
+
+Each --rootdir is benchmarked in its own Python process, so that several
+installations can be compared in one run. A rootdir may be given a label
+as label=path; the default label is the name of the directory.
+
+Usage:
+tools/bench-archiver.py --rootdir ../ponymail foal=../ponymail-foal --output bench.json
+tools/bench-archiver.py --rootdir foal=../ponymail-foal --baseline bench.json --threshold 10
+
+With --baseline, exits with a non-zero status if messages/second for any
+label/corpus/generator dropped by more than --threshold percent.
+"""
+
+import argparse
+import collections
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'tests'))
+import interfacer # pylint: disable=wrong-import-position
+import corpus # pylint: disable=wrong-import-position
+from watchdog import percentile # pylint: disable=wrong-import-position
+
+fake_args = collections.namedtuple('fakeargs', ['verbose', 'ibody'])(False, None)
+
+
+def summarise(latencies):
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    return {
+        'messages': len(latencies),
+        'seconds': round(total, 6),
+        'msgs_per_sec': round(len(latencies) / total, 2) if total else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 4),
+        'p90_ms': round(percentile(latencies, 90) * 1000, 4),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 4),
+        'max_ms': round(latencies[-1] * 1000, 4) if latencies else 0.0,
+    }
+
+
+def bench_rootdir(args):
+    """Benchmarks a single installation; runs in its own process"""
+    sys.path.append(os.path.join(args.rootdir[0], 'tools'))
+    import archiver
+    import logging
+    archiver.logger = logging.getLogger()
+    archiver.logger.setLevel(logging.ERROR)
+    if args.generators:
+        generator_names = args.generators
+    else:
+        try:
+            import generators
+        except ImportError:
+            import plugins.generators as generators
+        generator_names = generators.generator_names() if hasattr(generators, 'generator_names') else ['full', 'medium', 'cluster', 'legacy']
+
+    archies = {}
+    for gen_type in generator_names:
+        test_args = collections.namedtuple('testargs', ['parse_html', 'generator'])(args.html, gen_type)
+        archies[gen_type] = interfacer.Archiver(archiver, test_args)
+    version = None
+    corpora = {}
+    for mboxfile in args.mboxfiles:
+        mbox = corpus.open_mbox(mboxfile, args.nomboxo)
+        messages = [mbox.load(key) for key in mbox.keys()]
+        mbox.close()
+        results = {}
+        for gen_type, archie in archies.items():
+            version = archie.version
+            latencies = []
+            for _ in range(args.repeat):
+                for message_raw, parsed in messages:
+                    message = corpus.copy_message(parsed)
+                    lid = archiver.normalize_lid(message.get('list-id', '??'))
+                    started = time.perf_counter()
+                    archie.compute_updates(fake_args, lid, False, message, message_raw)
+                    latencies.append(time.perf_counter() - started)
+            results[gen_type] = summarise(latencies)
+            sys.stderr.write("%-8s %-48s %-8s %8.1f msgs/sec p99 %.3fms\n" % (
+                version, os.path.basename(mboxfile), gen_type, results[gen_type]['msgs_per_sec'], results[gen_type]['p99_ms']))
+        corpora[mboxfile] = results
+    return {'rootdir': args.rootdir[0], 'version': version, 'corpora': corpora}
+
+
+def compare(results, baseline, threshold):
+    """Returns a list of regressions of more than threshold percent"""
+    regressions = []
+    for label, result in results.items():
+        base = baseline.get(label)
+        if not base:
+            print("No baseline for %s" % label)
+            continue
+        for mboxfile, gens in result['corpora'].items():
+            for gen_type, stats in gens.items():
+                old = base['corpora'].get(mboxfile, {}).get(gen_type)
+                if not old or not old['msgs_per_sec']:
+                    continue
+                change = (stats['msgs_per_sec'] - old['msgs_per_sec']) * 100.0 / old['msgs_per_sec']
+                line = "%-10s %-48s %-8s %10.1f -> %10.1f msgs/sec (%+.1f%%)" % (
+                    label, os.path.basename(mboxfile), gen_type, old['msgs_per_sec'], stats['msgs_per_sec'], change)
+                if change < -threshold:
+                    regressions.append(line)
+                    print("[SLOW] " + line)
+                else:
+                    print("[OK]   " + line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Command line options.')
+    parser.add_argument('--rootdir', dest='rootdir', type=str, nargs='+', required=True,
+                        help="Root directories of Apache Pony Mail installs to benchmark, optionally as label=path")
+    parser.add_argument('--mbox', dest='mboxfiles', type=str, nargs='+',
+                        help="mbox files to use (default corpus/*.mbox)")
+    parser.add_argument('--generators', dest='generators', type=str, nargs='+',
+                        help="Override the list of generator names")
+    parser.add_argument('--html', dest='html', action='store_true',
+                        help="Enable HTML parsing")
+    parser.add_argument('--nomboxo', dest='nomboxo', action='store_true',
+                        help='Skip Mboxo processing')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=1,
+                        help="Number of passes over each corpus file")
+    parser.add_argument('--output', dest='output', type=str,
+                        help="Write the JSON results to this file")
+    parser.add_argument('--baseline', dest='baseline', type=str,
+                        help="Compare against JSON results from an earlier run")
+    parser.add_argument('--threshold', dest='threshold', type=float, default=10.0,
+                        help="Maximum allowed drop in messages/second versus the baseline, in percent (default 10)")
+    parser.add_argument('--worker', dest='worker', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.mboxfiles = args.mboxfiles or sorted(glob.glob(os.path.join('corpus', '*.mbox')))
+
+    if args.worker:
+        with open(args.output, 'w') as f:
+            json.dump(bench_rootdir(args), f)
+        return
+
+    results = {}
+    for rootdir in args.rootdir:
+        label, _, path = rootdir.rpartition('=')
+        label = label or os.path.basename(os.path.normpath(path))
+        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as tmp:
+            output = tmp.name
+        try:
+            cliargs = [sys.executable, __file__, '--worker', '--rootdir', path, '--output', output,
+                       '--repeat', str(args.repeat), '--mbox'] + args.mboxfiles
+            if args.generators:
+                cliargs.extend(['--generators'] + args.generators)
+            if args.html:
+                cliargs.append('--html')
+            if args.nomboxo:
+                cliargs.append('--nomboxo')
+            subprocess.check_call(cliargs)
+            with open(output, 'r') as f:
+                results[label] = json.load(f)
+        finally:
+            os.unlink(output)
+
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline['results'], args.threshold)
+        if regressions:
+            print("%u regression%s of more than %.1f%%" % (len(regressions), '' if len(regressions) == 1 else 's', args.threshold))
+            sys.exit(-1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the mboxo readers in tests/mboxo_patch.py.
+
+For each mbox file, reads every message with:
+- MboxoReader, reading in 8192 byte chunks (as the email parser does)
+- MboxoReader, reading the whole message at once
+- MboxoMmap
+
+Usage: tools/bench-mboxo.py [--repeat N] [mboxfile ...] (defaults to corpus/*.mbox)
+"""
+
+import argparse
+import glob
+import mailbox
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'tests'))
+from mboxo_patch import MboxoReader, MboxoMmap # pylint: disable=wrong-import-position
+
+
+def read_chunked(mbox, key):
+    file = MboxoReader(mbox.get_file(key, True))
+    data = b''
+    while True:
+        chunk = file.read(8192)
+        if not chunk:
+            break
+        data += chunk
+    file.close()
+    return data
+
+def read_whole(mbox, key):
+    file = MboxoReader(mbox.get_file(key, True))
+    data = file.read()
+    file.close()
+    return data
+
+
+def bench(func, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Command line options.')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=5,
+                        help="Number of timing runs per reader; the best is reported")
+    parser.add_argument('mboxfiles', nargs='*',
+                        help="mbox files to read (default corpus/*.mbox)")
+    args = parser.parse_args()
+    mboxfiles = args.mboxfiles or sorted(glob.glob(os.path.join('corpus', '*.mbox')))
+
+    totals = [0.0] * 3
+    print("%-48s %8s %10s %10s %10s" % ('file', 'messages', 'chunked', 'whole', 'mmap'))
+    for mboxfile in mboxfiles:
+        mbox = mailbox.mbox(mboxfile, None, create=False)
+        toc = [mbox._lookup(key) for key in mbox.keys()] # pylint: disable=protected-access
+        mm = MboxoMmap(mboxfile)
+        # Check that the readers agree before timing them
+        for key, (start, stop) in enumerate(toc):
+            assert read_whole(mbox, key) == mm.get(start, stop), "%s: mismatch at index %u" % (mboxfile, key)
+        timings = [
+            bench(lambda: [read_chunked(mbox, key) for key in range(len(toc))], args.repeat),
+            bench(lambda: [read_whole(mbox, key) for key in range(len(toc))], args.repeat),
+            bench(lambda: [mm.get(start, stop) for start, stop in toc], args.repeat),
+        ]
+        print("%-48s %8u %8.2fms %8.2fms %8.2fms" % ((os.path.basename(mboxfile), len(toc)) + tuple(t * 1000 for t in timings)))
+        totals = [a + b for a, b in zip(totals, timings)]
+        mm.close()
+        mbox.close()
+    print("%-48s %8s %8.2fms %8.2fms %8.2fms" % (('total', '') + tuple(t * 1000 for t in totals)))
+
+
+if __name__ == '__main__':
+    main()
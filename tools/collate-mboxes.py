@@ -13,40 +13,59 @@ However duplicates can occur in archive files if:
 Used for multi-import tests where you wish to check that multiple sources give the same ID
 
 Emails with duplicate sort keys are logged and dropped
+
+Only a compact index of (sort key, file, start, stop) is kept per message, and the
+message bytes are copied straight from the input files to the output file.
+If there are more than --max-entries messages, sorted runs of the index are spilled
+to temporary files and merged, so memory use does not depend on the size of the input.
+With --jobs, the input files are indexed in parallel.
 """
 
 import argparse
+import concurrent.futures
+import email.parser
+import heapq
+import json
 import mailbox
+import os
 import re
-import sys
-
-parser = argparse.ArgumentParser(description='Command line options.')
-parser.add_argument('--ezmlm', dest='ezmlm', action='store_true',
-                    help="Use ezmlm numbering for sorting")
-parser.add_argument('args', nargs=argparse.REMAINDER)
-args = parser.parse_args()
-
-outmbox = args.args[0]
-msgfiles = args.args[1:] # multiple input files allowed
-
-allmessages = {}
-noid = 0
-skipped = 0
-crlf = None # assume that all emails have the same EOL
-for msgfile in msgfiles:
-    messages = mailbox.mbox(
-        msgfile, None, create=False
-    )
-    sortkey = None
+import tempfile
+
+COPY_SIZE = 1 << 20
+
+
+def index_mbox(fileno, msgfile, ezmlm):
+    """
+    Returns the CRLF setting of the first message, the index entries
+    (sort key, fileno, start, stop) and the log lines and counts for the file
+    """
+    messages = mailbox.mbox(msgfile, None, create=False)
+    entries = []
+    log = []
+    noid = 0
+    skipped = 0
+    crlf = None
+    f = messages._file # pylint: disable=protected-access
     for key in messages.iterkeys():
-        message = messages.get(key)
-        if args.ezmlm:
-            from_ = message.get_from()
+        start, stop = messages._lookup(key) # pylint: disable=protected-access
+        f.seek(start)
+        from_line = f.readline()
+        if crlf is None:
+            crlf = (from_line.endswith(b'\r\n'))
+        headers = []
+        while f.tell() < stop:
+            line = f.readline()
+            if not line.strip():
+                break
+            headers.append(line)
+        message = email.parser.BytesHeaderParser().parsebytes(b''.join(headers))
+        if ezmlm:
+            from_ = from_line.replace(mailbox.linesep, b'')[5:].decode('ascii')
             m = re.search(r"return-(\d+)-", from_)
             if m:
                 sortkey = m.group(1)
             else:
-                print("Failed to find ezmlm id in %s" % from_)
+                log.append("Failed to find ezmlm id in %s" % from_)
                 skipped += 1
                 continue
         else:
@@ -54,32 +73,115 @@ for msgfile in msgfiles:
             if msgid:
                 sortkey = msgid.strip()
             else:
-                print("No message id, sorting by date or subject: ", message.get_from())
+                log.append("No message id, sorting by date or subject:  %s" % from_line.replace(mailbox.linesep, b'')[5:].decode('ascii'))
                 noid += 1
                 altid = message.get('date') or message.get('subject')
                 sortkey = "~" + altid.strip() # try to ensure it sorts last
-        # store the data
-        file = messages.get_file(key, True)
-        message_raw = b''
-        if crlf is None:
-            message_raw = file.readline()
-            crlf = (message_raw.endswith(b'\r\n'))
-        message_raw += file.read()
-        file.close()
-        if sortkey in allmessages:
-            print("Duplicate sort key: %s" % sortkey)
-            skipped += 1
-        allmessages[sortkey] = message_raw
-
-
-nw = 0
-with open(outmbox, "wb") as f:
-    for key in sorted(allmessages.keys()):
-        f.write(allmessages[key])
-        if crlf:
-            f.write(b'\r\n')
-        else:
-            f.write(b'\n')
-        nw += 1
+        entries.append((sortkey, fileno, start, stop))
+    messages.close()
+    return crlf, entries, log, noid, skipped
+
+
+def spill(entries):
+    """Writes a sorted run of entries to a temporary file and returns its name"""
+    entries.sort()
+    fd, name = tempfile.mkstemp(prefix='collate-', suffix='.jsonl')
+    with os.fdopen(fd, 'w') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + "\n")
+    return name
+
+
+def read_run(name):
+    with open(name, 'r') as f:
+        for line in f:
+            yield tuple(json.loads(line))
+
+
+def copy_message(infiles, entry, f, crlf):
+    """Copies the bytes of a message from its input file to the output file"""
+    _, fileno, start, stop = entry
+    infile = infiles[fileno]
+    infile.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        data = infile.read(min(remaining, COPY_SIZE))
+        if not data:
+            break
+        f.write(data)
+        remaining -= len(data)
+    if crlf:
+        f.write(b'\r\n')
+    else:
+        f.write(b'\n')
+    return 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Command line options.')
+    parser.add_argument('--ezmlm', dest='ezmlm', action='store_true',
+                        help="Use ezmlm numbering for sorting")
+    parser.add_argument('--max-entries', dest='max_entries', type=int, default=1000000,
+                        help="Maximum number of index entries to sort in memory before spilling to disk")
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+                        help="Number of input files to index in parallel")
+    parser.add_argument('args', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    outmbox = args.args[0]
+    msgfiles = args.args[1:] # multiple input files allowed
+
+    noid = 0
+    skipped = 0
+    crlf = None # assume that all emails have the same EOL
+    entries = []
+    runs = []
+    if args.jobs > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs)
+        indexed = executor.map(index_mbox, range(len(msgfiles)), msgfiles, [args.ezmlm] * len(msgfiles))
+    else:
+        executor = None
+        indexed = map(index_mbox, range(len(msgfiles)), msgfiles, [args.ezmlm] * len(msgfiles))
+    nw = 0
+    infiles = []
+    try:
+        for file_crlf, file_entries, log, file_noid, file_skipped in indexed:
+            for line in log:
+                print(line)
+            if crlf is None:
+                crlf = file_crlf
+            noid += file_noid
+            skipped += file_skipped
+            entries.extend(file_entries)
+            if len(entries) >= args.max_entries:
+                runs.append(spill(entries))
+                entries = []
+
+        entries.sort()
+        merged = heapq.merge(entries, *[read_run(name) for name in runs]) if runs else iter(entries)
+        infiles = [open(msgfile, 'rb') for msgfile in msgfiles]
+        with open(outmbox, "wb") as f:
+            pending = next(merged, None)
+            for entry in merged:
+                if entry[0] == pending[0]:
+                    # the last duplicate (in input order) is kept
+                    print("Duplicate sort key: %s" % entry[0])
+                    skipped += 1
+                else:
+                    nw += copy_message(infiles, pending, f, crlf)
+                pending = entry
+            if pending:
+                nw += copy_message(infiles, pending, f, crlf)
+    finally:
+        if executor:
+            executor.shutdown()
+        for infile in infiles:
+            infile.close()
+        for name in runs:
+            os.unlink(name)
+
+    print("Wrote %u emails to %s with CRLF %s (%u without message-id) WARN: %u skipped" % (nw, outmbox, crlf, noid, skipped))
+
 
-print("Wrote %u emails to %s with CRLF %s (%u without message-id) WARN: %u skipped" % (nw, outmbox, crlf, noid, skipped))
+if __name__ == '__main__':
+    main()
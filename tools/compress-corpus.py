@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Compresses corpus mbox files for random access by the tests (see tests/compressed.py).
+
+The file is split into blocks of whole messages, of at least --block-size bytes
+(uncompressed), and each block is compressed separately. The result is written
+to <file>.xz (or <file>.gz with --format gz) and checked against the original,
+which is left in place; once the compressed copy is checked in, the original
+can be removed, and specs that name <file> will use the compressed copy.
+
+Smaller blocks make fetching a single message cheaper; larger blocks compress better.
+
+Usage: tools/compress-corpus.py [--format xz|gz] [--block-size N] mboxfile ...
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'tests'))
+import corpus # pylint: disable=wrong-import-position
+import compressed # pylint: disable=wrong-import-position
+
+
+def block_ranges(mboxfile, block_size):
+    """Returns the (start, stop) offsets of the blocks, which always start at a message"""
+    mbox = corpus.open_mbox(mboxfile, True)
+    starts = [mbox._lookup(key)[0] for key in mbox.keys()] # pylint: disable=protected-access
+    mbox.close()
+    ranges = []
+    begin = 0
+    for start in starts[1:]:
+        if start - begin >= block_size:
+            ranges.append((begin, start))
+            begin = start
+    ranges.append((begin, os.path.getsize(mboxfile)))
+    return ranges
+
+
+def compress(mboxfile, outfile, block_size):
+    digest = hashlib.sha256()
+    ranges = block_ranges(mboxfile, block_size)
+    tmp = "%s.%u.tmp" % (outfile, os.getpid())
+    with open(mboxfile, 'rb') as f, open(tmp, 'wb') as out:
+        for start, stop in ranges:
+            f.seek(start)
+            data = f.read(stop - start)
+            digest.update(data)
+            out.write(compressed.compress_block(outfile, data))
+    os.replace(tmp, outfile)
+    # Check that the blocks read back as the original file
+    check = hashlib.sha256()
+    blocks = compressed.BlockFile(outfile)
+    for chunk in iter(lambda: blocks.read(1 << 20), b''):
+        check.update(chunk)
+    blocks.close()
+    if check.digest() != digest.digest():
+        os.unlink(outfile)
+        raise ValueError("%s does not match %s after compression" % (outfile, mboxfile))
+    return len(ranges)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Command line options.')
+    parser.add_argument('--format', dest='format', choices=['xz', 'gz'], default='xz',
+                        help="Compression format (default xz)")
+    parser.add_argument('--block-size', dest='block_size', type=int, default=256 * 1024,
+                        help="Minimum uncompressed size of a block in bytes (default 256KB)")
+    parser.add_argument('mboxfiles', nargs='+',
+                        help="mbox files to compress")
+    args = parser.parse_args()
+
+    for mboxfile in args.mboxfiles:
+        outfile = "%s.%s" % (mboxfile, args.format)
+        blocks = compress(mboxfile, outfile, args.block_size)
+        size = os.path.getsize(mboxfile)
+        csize = os.path.getsize(outfile)
+        print("Wrote %s: %u block%s, %u -> %u bytes (%.1f%%)" % (
+            outfile, blocks, '' if blocks == 1 else 's', size, csize, csize * 100.0 / size if size else 0.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Builds a large synthetic mbox file for load testing, using the messages of the
+corpus as templates.
+
+Each output message is a copy of a randomly chosen template, with:
+- a new Message-ID, and a Date (and From line) that increases through the file
+- a List-Id picked from --lists synthetic lists
+- for a share of the messages (--replies), In-Reply-To/References/Subject making it
+  a reply to a recent message of the same list
+- for a share of the messages (--attachments), an extra attachment of random size
+  (log-uniformly distributed up to --attachment-max bytes)
+The body of the template is otherwise copied unchanged, including any mboxo ('>From ') lines.
+
+The output only depends on the templates, the options and --seed.
+If the output file name ends in .gz or .xz, it is compressed in blocks as per
+tools/compress-corpus.py.
+
+With --parsing and/or --generators, a matching test spec is generated with
+tests/test-parsing.py or tests/test-generators.py, using the archiver in --rootdir.
+
+Usage: tools/synth-corpus.py --count 100000 [--seed 0] [--parsing yaml/synth.yaml --rootdir ../ponymail] out.mbox
+"""
+
+import argparse
+import base64
+import collections
+import email.utils
+import glob
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+
+TESTS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'tests')
+sys.path.insert(0, TESTS_DIR)
+import corpus # pylint: disable=wrong-import-position
+import compressed # pylint: disable=wrong-import-position
+
+# headers which are replaced in every message; the mime headers are only replaced when adding an attachment
+REPLACED = (b'message-id', b'date', b'list-id', b'in-reply-to', b'references')
+MIME = (b'mime-version', b'content-type', b'content-transfer-encoding')
+RECENT = 1000 # messages per list which may be replied to
+MAX_REFERENCES = 10
+
+
+def load_templates(patterns):
+    """Returns (from line, [(header name, header bytes)], body, eol) for each message of the template files"""
+    paths = set()
+    for pattern in patterns:
+        for path in glob.glob(pattern):
+            for suffix in corpus.COMPRESSED_SUFFIXES:
+                if path.endswith(suffix):
+                    path = path[:-len(suffix)]
+            paths.add(path)
+    templates = []
+    for path in sorted(paths):
+        mbox = corpus.open_mbox(path, True)
+        for key in mbox.keys():
+            raw, _ = mbox.load(key)
+            eol = b'\r\n' if b'\r\n' in raw[:raw.find(b'\n') + 1] else b'\n'
+            from_line, _, rest = raw.partition(eol)
+            head, sep, body = rest.partition(eol + eol)
+            if not sep: # no body
+                head = rest.rstrip(b'\r\n')
+            headers = []
+            for line in head.split(eol):
+                if line[:1] in (b' ', b'\t') and headers:
+                    headers[-1] = (headers[-1][0], headers[-1][1] + eol + line)
+                else:
+                    headers.append((line.split(b':', 1)[0].strip().lower(), line))
+            templates.append((from_line, headers, body, eol))
+        mbox.close()
+    return templates
+
+
+def header_value(headers, name):
+    for hname, line in headers:
+        if hname == name:
+            return re.sub(rb'\s+', b' ', line.split(b':', 1)[1]).strip()
+    return None
+
+
+def add_attachment(rng, headers, body, eol, n, size):
+    """Turns the message into multipart/mixed, with the original body as the first part"""
+    boundary = b"synth-boundary-%u" % n
+    part_headers = [line for hname, line in headers if hname in MIME[1:]] or [b'Content-Type: text/plain']
+    # the same bytes as rng.randbytes(size), which is 3.9+ (getrandbits(0) fails before 3.9)
+    payload = rng.getrandbits(size * 8).to_bytes(size, 'little') if size else b''
+    data = base64.encodebytes(payload).replace(b'\n', eol)
+    body = eol.join([
+        b'--' + boundary,
+    ] + part_headers + [
+        b'',
+        body.rstrip(b'\r\n'),
+        b'--' + boundary,
+        b'Content-Type: application/octet-stream; name="synth-%u.bin"' % n,
+        b'Content-Disposition: attachment; filename="synth-%u.bin"' % n,
+        b'Content-Transfer-Encoding: base64',
+        b'',
+        data.rstrip(b'\r\n'),
+        b'--' + boundary + b'--',
+        b'',
+    ])
+    headers = [(hname, line) for hname, line in headers if hname not in MIME] + [
+        (b'mime-version', b'MIME-Version: 1.0'),
+        (b'content-type', b'Content-Type: multipart/mixed; boundary="' + boundary + b'"'),
+    ]
+    return headers, body
+
+
+def synthesise(args, templates, out):
+    rng = random.Random(args.seed)
+    recent = collections.defaultdict(lambda: collections.deque(maxlen=RECENT))
+    timestamp = float(args.start)
+    for n in range(args.count):
+        from_line, headers, body, eol = rng.choice(templates)
+        timestamp += rng.expovariate(1.0 / args.interval)
+        lid = b"list%u.synth.example.org" % rng.randrange(args.lists)
+        msgid = b"<synth.%u.%u@synth.example.org>" % (args.seed, n)
+        subject = header_value(headers, b'subject') or b''
+        added = [
+            (b'message-id', b'Message-ID: ' + msgid),
+            (b'date', b'Date: ' + email.utils.formatdate(int(timestamp)).encode('ascii')),
+            (b'list-id', b'List-Id: <' + lid + b'>'),
+        ]
+        if recent[lid] and rng.random() < args.replies:
+            parent_id, parent_refs, parent_subject = rng.choice(recent[lid])
+            refs = (parent_refs + [parent_id])[-MAX_REFERENCES:]
+            subject = parent_subject if parent_subject.lower().startswith(b're:') else b'Re: ' + parent_subject
+            added += [
+                (b'in-reply-to', b'In-Reply-To: ' + parent_id),
+                (b'references', b'References: ' + b' '.join(refs)),
+                (b'subject', b'Subject: ' + subject),
+            ]
+        else:
+            refs = []
+        recent[lid].append((msgid, refs, subject))
+        replaced = REPLACED + tuple(hname for hname, _ in added)
+        headers = [(hname, line) for hname, line in headers if hname not in replaced] + added
+        if rng.random() < args.attachments:
+            size = int(math.exp(rng.uniform(math.log(args.attachment_min), math.log(args.attachment_max))))
+            headers, body = add_attachment(rng, headers, body, eol, n, size)
+        sender = from_line[5:].split(b' ', 1)[0] or b'MAILER-DAEMON'
+        from_line = b'From ' + sender + b' ' + time.asctime(time.gmtime(timestamp)).encode('ascii')
+        if not body.endswith(eol):
+            body += eol
+        out.write(eol.join([from_line] + [line for _, line in headers]) + eol + eol + body + eol)
+
+
+class BlockWriter(object):
+    """Writes whole messages to a compressed file in blocks of at least block_size bytes"""
+
+    def __init__(self, f, path, block_size):
+        self._file = f
+        self._path = path
+        self._block_size = block_size
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self._block_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self._file.write(compressed.compress_block(self._path, b''.join(self._buffer)))
+            self._buffer = []
+            self._buffered = 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Command line options.')
+    parser.add_argument('--count', dest='count', type=int, required=True,
+                        help="Number of messages to write")
+    parser.add_argument('--seed', dest='seed', type=int, default=0,
+                        help="Random seed (default 0)")
+    # One file per option, so that it cannot swallow the outfile
+    parser.add_argument('--templates', dest='templates', type=str, action='append',
+                        help="mbox file or glob pattern to use as templates; may be given more than once "
+                             "(default corpus/*.mbox, or their compressed copies)")
+    parser.add_argument('--lists', dest='lists', type=int, default=5,
+                        help="Number of List-Ids to spread the messages over (default 5)")
+    parser.add_argument('--replies', dest='replies', type=float, default=0.5,
+                        help="Share of messages which are replies (default 0.5)")
+    parser.add_argument('--attachments', dest='attachments', type=float, default=0.1,
+                        help="Share of messages which get an extra attachment (default 0.1)")
+    parser.add_argument('--attachment-min', dest='attachment_min', type=int, default=1024,
+                        help="Minimum size of an extra attachment in bytes (default 1KB)")
+    parser.add_argument('--attachment-max', dest='attachment_max', type=int, default=256 * 1024,
+                        help="Maximum size of an extra attachment in bytes (default 256KB)")
+    parser.add_argument('--start', dest='start', type=int, default=1577836800,
+                        help="Unix time of the first message (default 2020-01-01)")
+    parser.add_argument('--interval', dest='interval', type=float, default=60.0,
+                        help="Mean number of seconds between messages (default 60)")
+    parser.add_argument('--block-size', dest='block_size', type=int, default=256 * 1024,
+                        help="Minimum uncompressed block size when writing a .gz or .xz file (default 256KB)")
+    parser.add_argument('--parsing', dest='parsing', type=str,
+                        help="Also generate a parsing spec for the output in this file (needs --rootdir)")
+    parser.add_argument('--generators', dest='generators', type=str,
+                        help="Also generate a generators spec for the output in this file (needs --rootdir)")
+    parser.add_argument('--rootdir', dest='rootdir', type=str,
+                        help="Root directory of Apache Pony Mail, for generating specs")
+    parser.add_argument('--html', dest='html', action='store_true',
+                        help="Enable HTML parsing when generating a parsing spec")
+    parser.add_argument('outfile',
+                        help="mbox file to write")
+    args = parser.parse_args()
+    if (args.parsing or args.generators) and not args.rootdir:
+        parser.error("--parsing and --generators need --rootdir")
+
+    templates = load_templates(args.templates or [os.path.join('corpus', '*.mbox*')])
+    if not templates:
+        parser.error("No template messages found")
+    with open(args.outfile, 'wb') as f:
+        if compressed.is_compressed(args.outfile):
+            out = BlockWriter(f, args.outfile, args.block_size)
+            synthesise(args, templates, out)
+            out.flush()
+        else:
+            synthesise(args, templates, f)
+    print("Wrote %u emails to %s from %u templates (%u bytes)" % (args.count, args.outfile, len(templates), os.path.getsize(args.outfile)))
+
+    if args.parsing:
+        cliargs = [sys.executable, os.path.join(TESTS_DIR, 'test-parsing.py'), '--rootdir', args.rootdir,
+                   '--mbox', args.outfile, '--generate', args.parsing]
+        if args.html:
+            cliargs.append('--html')
+        subprocess.check_call(cliargs)
+    if args.generators:
+        subprocess.check_call([sys.executable, os.path.join(TESTS_DIR, 'test-generators.py'), '--rootdir', args.rootdir,
+                               '--mbox', args.outfile, '--generate', args.generators])
+
+
+if __name__ == '__main__':
+    main()